@@ -10,8 +10,14 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # Apache License for more details.
 
-from subprocess import check_call, check_output
+from subprocess import check_call, check_output, CalledProcessError
+import os
+import re
+import json
+import functools
+import tarfile
 import time
+import yaml
 
 from path import Path
 
@@ -30,6 +36,13 @@ except ImportError:
 from jujubigdata import utils
 
 
+# OS settings managed by HadoopBase.tune_os
+THP_DIR = Path('/sys/kernel/mm/transparent_hugepage')
+SYSCTL_CONF = Path('/etc/sysctl.d/60-hadoop.conf')
+LIMITS_CONF = Path('/etc/security/limits.d/hadoop.conf')
+THP_UNIT = 'hadoop-disable-thp.service'
+
+
 class HadoopBase(object):
     def __init__(self, dist_config):
         self.dist_config = dist_config
@@ -67,8 +80,23 @@ class HadoopBase(object):
         except KeyError:
             pass
 
-        # Verify and fetch the required hadoop resources
-        self.verify_conditional_resources = utils.verify_resources(*hadoop_resources)
+        # Verify and fetch the required hadoop resources, preferring any peers
+        # that are sharing them (see share_resources)
+        self.verify_conditional_resources = utils.verify_resources(*hadoop_resources,
+                                                                   peers=utils.get_resource_peers)
+
+    def share_resources(self):
+        """
+        Serve this unit's verified Hadoop resources to peer units, if the
+        ``resources_sharing`` config option is set.
+
+        Related units with a matching spec learn the URL through the relation
+        data and fetch from it before falling back to the ``resources_mirror``.
+        """
+        if not self.charm_config.get('resources_sharing'):
+            utils.stop_serving_resources()
+        elif self.verify_conditional_resources():
+            utils.serve_resources(int(self.charm_config.get('resources_sharing_port', 8099)))
 
     def spec(self):
         """
@@ -97,17 +125,174 @@ class HadoopBase(object):
         if not force and self.is_installed():
             return
         hookenv.status_set('maintenance', 'Installing Apache Hadoop base')
-        self.configure_hosts_file()
-        self.dist_config.add_users()
-        self.dist_config.add_dirs()
-        self.dist_config.add_packages()
-        self.install_base_packages()
+        # Steps that don't depend on each other (e.g., extracting Hadoop and
+        # installing packages) are run concurrently, and each completed step
+        # is recorded so that it is skipped if the install is re-run.
+        steps = {
+            'hosts': (self.configure_hosts_file, []),
+            'users': (self.dist_config.add_users, []),
+            'dirs': (self.dist_config.add_dirs, ['users']),
+            'packages': (self.dist_config.add_packages, []),
+            # the java-installer may use apt, so it must wait for add_packages
+            'java': (self._install_java, ['packages']),
+            'hadoop': (self._install_hadoop, ['dirs']),
+        }
+        if self.charm_config.get('os_tuning'):
+            previous = unitdata.kv().get('hadoop.os.previous') or {}
+            steps['os'] = (lambda: self._tune_os(previous), [])
+        with utils.disable_firewall():
+            utils.run_steps(steps, kv_prefix='hadoop.base.install.', force=force)
         self.setup_hadoop_config()
         self.configure_hadoop()
         unitdata.kv().set('hadoop.base.installed', True)
         unitdata.kv().flush(True)
         hookenv.status_set('waiting', 'Apache Hadoop base installed')
 
+    def tune_os(self):
+        """
+        Apply the kernel and OS settings which Hadoop throughput depends on:
+
+        * Disable transparent hugepages and their defragmentation, now and,
+          via a systemd unit run at boot, after a reboot
+        * Minimize swapping, and size the TCP buffers and listen backlog for
+          the shuffle, via a sysctl.d file
+        * Raise the open file and process limits of the Hadoop users
+        * Set the readahead of, and remount with ``noatime``, the data disks
+
+        The readahead and ``noatime`` settings do not survive a reboot, so
+        this should be re-run (e.g., from ``config-changed``) to reapply them.
+        Settings which are already as desired are left alone, and the original
+        value of each changed setting is recorded so that it can be restored
+        by :meth:`revert_os_tuning`.
+
+        :returns: A list describing each change made
+        """
+        data = self._tune_os(unitdata.kv().get('hadoop.os.previous') or {})
+        unitdata.kv().update(data)
+        unitdata.kv().flush(True)
+        return data['hadoop.os.changes']
+
+    def _tune_os(self, previous):
+        """
+        Apply the OS settings, returning the details to be stored in unitdata
+        (so that it can be run in a separate thread).
+        """
+        cfg = self.charm_config
+        previous = dict(previous)
+        changes = []
+
+        for setting in ('enabled', 'defrag'):
+            thp = THP_DIR / setting
+            if not thp.exists():
+                continue
+            current = utils.read_kernel_choice(thp)
+            if current != 'never':
+                previous.setdefault('thp.' + setting, current)
+                thp.write_text('never')
+                changes.append('{}: {} -> never'.format(thp, current))
+        if THP_DIR.exists():
+            if not Path('/run/systemd/system').exists():
+                hookenv.log('OS tuning: no systemd, transparent hugepages will be re-enabled on reboot',
+                            hookenv.WARNING)
+            elif utils.install_systemd_unit(THP_UNIT, '\n'.join([
+                    '[Unit]',
+                    'Description=Disable transparent hugepages for Apache Hadoop',
+                    'DefaultDependencies=no',
+                    'After=sysinit.target local-fs.target',
+                    'Before=basic.target',
+                    '',
+                    '[Service]',
+                    'Type=oneshot',
+                    "ExecStart=/bin/sh -c '{}'".format('; '.join(
+                        'echo never > {}'.format(THP_DIR / setting) for setting in ('enabled', 'defrag'))),
+                    '',
+                    '[Install]',
+                    'WantedBy=basic.target',
+                    ''])):
+                changes.append('{}: installed'.format(THP_UNIT))
+
+        sysctls = {
+            'vm.swappiness': cfg.get('vm_swappiness', 1),
+            'net.core.somaxconn': 1024,
+            'net.core.rmem_max': 16777216,
+            'net.core.wmem_max': 16777216,
+            'net.ipv4.tcp_rmem': '4096 87380 16777216',
+            'net.ipv4.tcp_wmem': '4096 65536 16777216',
+        }
+        content = ''.join('{} = {}\n'.format(key, value) for key, value in sorted(sysctls.items()))
+        if not SYSCTL_CONF.exists() or SYSCTL_CONF.text() != content:
+            for key in sysctls:
+                previous.setdefault('sysctl.' + key, check_output(['sysctl', '-n', key]).strip())
+            SYSCTL_CONF.write_text(content)
+            check_call(['sysctl', '-p', SYSCTL_CONF])
+            changes.append('{}: {}'.format(SYSCTL_CONF, ', '.join(sorted(sysctls))))
+
+        content = ''.join('{} - {} 65536\n'.format(user, item)
+                          for user in ('hdfs', 'yarn', 'mapred')
+                          for item in ('nofile', 'nproc'))
+        if not LIMITS_CONF.exists() or LIMITS_CONF.text() != content:
+            LIMITS_CONF.write_text(content)
+            changes.append('{}: nofile, nproc'.format(LIMITS_CONF))
+
+        readahead = int(cfg.get('data_disk_readahead', 8192))  # in 512 byte sectors
+        mounts = {mount_point: (device, options) for device, mount_point, fstype, options in utils.read_mounts()}
+        for disk in self.data_disks():
+            if disk not in mounts:
+                continue
+            device, options = mounts[disk]
+            current = int(check_output(['blockdev', '--getra', device]))
+            if current != readahead:
+                previous.setdefault('readahead.' + device, current)
+                check_call(['blockdev', '--setra', str(readahead), device])
+                changes.append('{}: readahead {} -> {}'.format(device, current, readahead))
+            if 'noatime' not in options:
+                current = next((o for o in options if o in ('atime', 'relatime', 'strictatime')), 'relatime')
+                previous.setdefault('atime.' + disk, current)
+                check_call(['mount', '-o', 'remount,noatime', disk])
+                changes.append('{}: {} -> noatime'.format(disk, current))
+
+        for change in changes:
+            hookenv.log('OS tuning: {}'.format(change))
+        return {
+            'hadoop.os.previous': previous,
+            'hadoop.os.changes': changes,
+        }
+
+    def revert_os_tuning(self):
+        """
+        Restore the OS settings changed by :meth:`tune_os` to their original values.
+
+        :returns: A list describing each change made
+        """
+        changes = []
+        for conf in (SYSCTL_CONF, LIMITS_CONF):
+            if conf.exists():
+                conf.remove()
+                changes.append('{}: removed'.format(conf))
+        thp_unit = utils.SYSTEMD_UNIT_DIR / THP_UNIT
+        if thp_unit.exists():
+            check_call(['systemctl', 'disable', THP_UNIT])
+            thp_unit.remove()
+            check_call(['systemctl', 'daemon-reload'])
+            changes.append('{}: removed'.format(THP_UNIT))
+        for key, value in sorted((unitdata.kv().get('hadoop.os.previous') or {}).items()):
+            kind, name = key.split('.', 1)
+            if kind == 'thp':
+                (THP_DIR / name).write_text(value)
+            elif kind == 'sysctl':
+                check_call(['sysctl', '-w', '{}={}'.format(name, value)])
+            elif kind == 'readahead':
+                check_call(['blockdev', '--setra', str(value), name])
+            elif kind == 'atime':
+                check_call(['mount', '-o', 'remount,{}'.format(value), name])
+            changes.append('{}: restored {}'.format(name, value))
+        for change in changes:
+            hookenv.log('OS tuning reverted: {}'.format(change))
+        unitdata.kv().unset('hadoop.os.previous')
+        unitdata.kv().set('hadoop.os.changes', [])
+        unitdata.kv().flush(True)
+        return changes
+
     def configure_hosts_file(self):
         """
         Add the unit's private-address to /etc/hosts to ensure that Java
@@ -142,6 +327,13 @@ class HadoopBase(object):
         If there is an error installing Java, the installer should exit
         with a non-zero exit code.
         """
+        unitdata.kv().update(self._install_java())
+
+    def _install_java(self):
+        """
+        Run the java-installer, returning the Java details to be stored in
+        unitdata (so that it can be run in a separate thread).
+        """
         env = utils.read_etc_env()
         java_installer = Path(jujuresources.resource_path('java-installer'))
         java_installer.chmod(0o755)
@@ -151,42 +343,89 @@ class HadoopBase(object):
             raise ValueError('Unexpected output from java-installer: %s' % output)
         java_home, java_version = lines
         java_major, java_release = java_version.split("_")
-        unitdata.kv().set('java.home', java_home)
-        unitdata.kv().set('java.version', java_major)
-        unitdata.kv().set('java.version.release', java_release)
+        return {
+            'java.home': java_home,
+            'java.version': java_major,
+            'java.version.release': java_release,
+        }
 
     def install_hadoop(self):
+        unitdata.kv().update(self._install_hadoop())
+
+    def native_libraries(self, refresh=False):
+        """
+        Report which native libraries Hadoop can load, as a mapping of each
+        library (e.g., ``hadoop``, ``snappy``, ``zstd``) to its availability.
+
+        The ``hadoop checknative`` probe starts a JVM, so its result is cached
+        until Hadoop is reinstalled, or ``refresh`` is given.
+        """
+        native = unitdata.kv().get('hadoop.native.libraries')
+        if native is None or refresh:
+            try:
+                output = self.run('hdfs', 'bin/hadoop', 'checknative', '-a', capture_output=True)
+            except CalledProcessError as e:
+                output = e.output or ''  # -a fails if any library is missing
+            native = utils.parse_checknative(output)
+            unitdata.kv().set('hadoop.native.libraries', native)
+            unitdata.kv().flush(True)
+        return native
+
+    def _install_hadoop(self):
+        """
+        Install Hadoop and LZO, returning the details to be stored in
+        unitdata (so that it can be run in a separate thread).
+        """
         hadoop_version = self.dist_config.hadoop_version
         try:
-            jujuresources.install('hadoop-%s-%s' %
-                                  (hadoop_version,
-                                   self.cpu_arch),
-                                  destination=self.dist_config.path('hadoop'),
+            self._install_archive('hadoop-%s-%s' % (hadoop_version, self.cpu_arch),
                                   skip_top_level=True)
         except KeyError:
             hookenv.log("Falling back to non-version specific download of hadoop...")
-            jujuresources.install('hadoop-%s' %
-                                  (self.cpu_arch),
-                                  destination=self.dist_config.path('hadoop'),
+            self._install_archive('hadoop-%s' % (self.cpu_arch),
                                   skip_top_level=True)
 
         # Install our lzo compression codec if it's defined in resources.yaml
         try:
-            jujuresources.install('hadoop-lzo-%s' % self.cpu_arch,
-                                  destination=self.dist_config.path('hadoop'),
+            self._install_archive('hadoop-lzo-%s' % self.cpu_arch,
                                   skip_top_level=False)
-            unitdata.kv().set('hadoop.lzo.installed', True)
         except KeyError:
             msg = ("The hadoop-lzo-%s resource was not found."
                    "LZO compression will not be available." % self.cpu_arch)
             hookenv.log(msg)
+            return {'hadoop.native.libraries': None}
+        return {'hadoop.lzo.installed': True, 'hadoop.native.libraries': None}
+
+    def _install_archive(self, resource, skip_top_level):
+        """
+        Extract a tarball resource into the Hadoop dir, streaming it through
+        a parallel decompressor and only writing the files which have changed
+        since it was last installed.
+
+        The resource must already have been fetched and verified (see
+        :class:`~jujubigdata.utils.verify_resources`), so it is not hashed again.
+
+        Raises KeyError if the resource is not defined.
+        """
+        archive = jujuresources.resource_path(resource)
+        if not archive or not os.path.isfile(archive):
+            raise ValueError('Resource %s is missing' % resource)
+        if not tarfile.is_tarfile(archive):
+            jujuresources.install(resource,
+                                  destination=self.dist_config.path('hadoop'),
+                                  skip_top_level=skip_top_level)
+            return
+        hadoop_dir = self.dist_config.path('hadoop')
+        utils.install_archive(archive, hadoop_dir,
+                              skip_top_level=skip_top_level,
+                              manifest=hadoop_dir / ('.%s.manifest' % resource))
 
     def setup_hadoop_config(self):
-        # copy default config into alternate dir
+        # sync default config into alternate dir, preserving the properties
+        # we manage so that they don't all have to be rebuilt
         conf_dir = self.dist_config.path('hadoop') / 'etc/hadoop'
-        self.dist_config.path('hadoop_conf').rmtree_p()
-        conf_dir.copytree(self.dist_config.path('hadoop_conf'))
-        (self.dist_config.path('hadoop_conf') / 'slaves').remove_p()
+        utils.sync_config_dir(conf_dir, self.dist_config.path('hadoop_conf'),
+                              exclude=['slaves'])
         mapred_site = self.dist_config.path('hadoop_conf') / 'mapred-site.xml'
         if not mapred_site.exists():
             (self.dist_config.path('hadoop_conf') / 'mapred-site.xml.template').copy(mapred_site)
@@ -224,22 +463,360 @@ class HadoopBase(object):
         utils.re_edit_in_place(hadoop_env, {
             r'export JAVA_HOME *=.*': 'export JAVA_HOME=%s' % java_home,
         })
+        self.configure_jvm_profiles()
+
+    def configure_jvm_profiles(self):
+        """
+        Set the heap and GC options of each Hadoop daemon, in a managed block
+        of hadoop-env.sh, yarn-env.sh, and mapred-env.sh.
+
+        Heaps are sized by :func:`~jujubigdata.utils.jvm_heap_mb`, and can be
+        overridden via ``<daemon>_heap_mb`` charm config options (e.g.,
+        ``namenode_heap_mb``).  The collector and its pause target come from
+        the ``jvm_gc`` and ``jvm_gc_pause_ms`` options.
+
+        :returns: The list of env files which were changed
+        """
+        cfg = self.charm_config
+        conf_dir = self.dist_config.path('hadoop_conf')
+        total_mb = utils.get_total_memory_mb()
+        blocks = int(cfg.get('namenode_expected_blocks', 1000000))
+        # the JobHistoryServer runs as mapred, and the JVM won't start if its GC log dir is missing
+        history_log_dir, = utils.ensure_dirs([self.dist_config.path('yarn_log_dir') / 'mapred'],
+                                             owner='mapred', group='hadoop')
+        daemons = [
+            # daemon, env file, env var, log dir
+            ('namenode', 'hadoop-env.sh', 'HADOOP_NAMENODE_OPTS', self.dist_config.path('hdfs_log_dir')),
+            ('secondarynamenode', 'hadoop-env.sh', 'HADOOP_SECONDARYNAMENODE_OPTS',
+             self.dist_config.path('hdfs_log_dir')),
+            ('datanode', 'hadoop-env.sh', 'HADOOP_DATANODE_OPTS', self.dist_config.path('hdfs_log_dir')),
+            ('resourcemanager', 'yarn-env.sh', 'YARN_RESOURCEMANAGER_OPTS', self.dist_config.path('yarn_log_dir')),
+            ('nodemanager', 'yarn-env.sh', 'YARN_NODEMANAGER_OPTS', self.dist_config.path('yarn_log_dir')),
+            ('historyserver', 'mapred-env.sh', 'HADOOP_JOB_HISTORYSERVER_OPTS', history_log_dir),
+        ]
+        blocks_by_file = {}
+        for daemon, env_file, env_var, log_dir in daemons:
+            heap_mb = int(cfg.get('{}_heap_mb'.format(daemon)) or utils.jvm_heap_mb(daemon, total_mb, blocks))
+            opts = utils.jvm_opts(heap_mb,
+                                  gc=cfg.get('jvm_gc') or 'auto',
+                                  pause_ms=cfg.get('jvm_gc_pause_ms', 200),
+                                  gc_log=log_dir / 'gc-{}.log'.format(daemon),
+                                  java_version=unitdata.kv().get('java.version', '1.8'))
+            # appended, so that our heap wins over HADOOP_HEAPSIZE and the defaults
+            blocks_by_file.setdefault(env_file, []).append(
+                'export {var}="${var} {opts}"'.format(var=env_var, opts=opts))
+        changed = []
+        for env_file, lines in sorted(blocks_by_file.items()):
+            if (conf_dir / env_file).exists() and utils.managed_block_edit(conf_dir / env_file, 'jvm', lines):
+                changed.append(env_file)
+        if changed:
+            hookenv.log('JVM profiles updated in {}; restart the daemons to apply them'.format(
+                ', '.join(changed)))
+        return changed
+
+    def configure_metrics(self, sinks=None):
+        """
+        Push the metrics of each Hadoop daemon to the related collectors, via
+        a managed block of hadoop-metrics2.properties.
+
+        The sampling period comes from the ``metrics_period`` charm config
+        option (default 10 seconds), and the filters from ``metrics_filters``,
+        as YAML; see :func:`~jujubigdata.utils.metrics2_properties`.  Invalid
+        filters are refused, leaving the current sinks in place.
+
+        :param dict sinks: Mapping of sink types (``ganglia``, ``graphite``, or
+            ``statsd``) to the ``(host, port)`` of their collector; if empty,
+            the sinks are removed
+        :returns: True if the metrics config was changed
+        """
+        cfg = self.charm_config
+        sinks = sinks or {}
+        try:
+            filters = yaml.safe_load(cfg.get('metrics_filters') or '') or {}
+            lines = utils.metrics2_properties(sinks, period=cfg.get('metrics_period', 10),
+                                              filters=filters) if sinks else []
+        except (ValueError, AttributeError, yaml.YAMLError) as e:
+            hookenv.log('Invalid metrics config: {}'.format(e), hookenv.ERROR)
+            return False
+        filename = self.dist_config.path('hadoop_conf') / 'hadoop-metrics2.properties'
+        changed = utils.managed_block_edit(filename, 'metrics2 sinks', lines)
+        unitdata.kv().set('hadoop.metrics.sinks', sorted(sinks))
+        unitdata.kv().flush(True)
+        if changed:
+            hookenv.log('Metrics sinks set to {}; restart the daemons to apply them'.format(
+                ', '.join(sorted(sinks)) or 'none'))
+        return changed
+
+    def service_backend(self):
+        """
+        Return how the Hadoop daemons are managed, from the ``service_backend``
+        charm config option: ``scripts`` (the default), for the ``*-daemon.sh``
+        scripts, or ``systemd``, for systemd units.
+
+        Daemons should be stopped before the backend is changed.
+        """
+        return self.charm_config.get('service_backend') or 'scripts'
+
+    def is_running(self, service, java_name):
+        """
+        Check whether a Hadoop daemon is running.
+
+        :param str service: Name of the daemon, e.g. ``namenode``
+        :param str java_name: Java class name of the daemon, e.g. ``NameNode``
+        """
+        if self.service_backend() == 'systemd':
+            return utils.systemd_active('hadoop-{}.service'.format(service))
+        return bool(utils.jps(java_name))
+
+    def systemd_daemon(self, command, service, user, script, port=None):
+        """
+        Run a systemctl ``command`` (e.g., ``start`` or ``stop``) for a Hadoop
+        daemon, installing or updating its unit first.
+
+        :param str service: Name of the daemon, e.g. ``namenode``
+        :param str user: User to run the daemon as
+        :param str script: Script which runs the daemon, e.g. ``bin/hdfs``
+        :param int port: Port to wait for the daemon to listen on when starting
+        """
+        unit = 'hadoop-{}.service'.format(service)
+        log_file = '{}-{}-{}-%H.log'.format('hadoop' if script == 'bin/hdfs' else user, user, service)
+        utils.install_systemd_unit(unit, utils.systemd_unit(
+            description='Apache Hadoop {}'.format(service),
+            user=user,
+            group='hadoop',
+            exec_start=' '.join([self.dist_config.path('hadoop') / script,
+                                 '--config', self.dist_config.path('hadoop_conf'), service]),
+            environment={
+                # log to files, as the *-daemon.sh scripts do, rather than the console
+                'HADOOP_ROOT_LOGGER': 'INFO,RFA',
+                'HADOOP_LOGFILE': log_file,
+                'YARN_ROOT_LOGGER': 'INFO,RFA',
+                'YARN_LOGFILE': log_file,
+            },
+            wait_for_port=port))
+        check_call(['systemctl', command, unit])
+
+    def data_disks(self):
+        """
+        Return the mount points to spread Hadoop data across.
+
+        These come from the ``data_mounts`` charm config option, as a space or
+        comma separated list, if set, or are discovered from the mounted block
+        devices otherwise. An empty list means there are no dedicated data
+        disks, and data should be kept under ``hdfs_dir_base``.
+        """
+        mounts = self.charm_config.get('data_mounts')
+        if mounts:
+            return [Path(m) for m in mounts.replace(',', ' ').split()]
+        return [Path(m) for m in utils.get_data_mounts()]
+
+    def compression_codecs(self):
+        """
+        Return the compression codecs available on this unit, as a list of
+        ``(name, class)`` tuples; see :func:`~jujubigdata.utils.available_codecs`.
+        """
+        return utils.available_codecs(self.native_libraries(),
+                                      lzo=unitdata.kv().get('hadoop.lzo.installed'))
+
+    def compression_codec(self, name):
+        """
+        Return the class of the named compression codec, or None if ``name``
+        is empty or ``none``, or the codec is refused because it is unknown or
+        its native library is unavailable.
+        """
+        if not name or name == 'none':
+            return None
+        codecs = dict(self.compression_codecs())
+        if name not in codecs:
+            hookenv.log('Compression codec {} is unknown or its native library is '
+                        'not available; refusing to use it'.format(name), hookenv.ERROR)
+            return None
+        return codecs[name]
 
     def register_slaves(self, slaves):
         """
-        Add slaves to a hdfs or yarn master, determined by the relation name.
+        Add slaves to a hdfs or yarn master.
 
-        :param str relation: 'datanode' for registering HDFS slaves;
-                             'nodemanager' for registering YARN slaves.
+        The slaves file is kept sorted and de-duplicated, and is only rewritten
+        when the membership actually changes.
+
+        :param list slaves: Hostnames of all of the slaves
+        :returns: A :class:`~jujubigdata.utils.HostsDelta` of the slaves
+            that were added and removed
         """
         slaves_file = self.dist_config.path('hadoop_conf') / 'slaves'
-        slaves_file.write_lines(
-            [
-                '# DO NOT EDIT',
-                '# This file is automatically managed by Juju',
-            ] + slaves
-        )
-        slaves_file.chown('ubuntu', 'hadoop')
+        created = not slaves_file.exists()
+        delta = utils.write_hosts_file(slaves_file, slaves, header=[
+            '# DO NOT EDIT',
+            '# This file is automatically managed by Juju',
+        ])
+        if delta.added or delta.removed:
+            hookenv.log('Slaves added: {}; removed: {}'.format(
+                ', '.join(delta.added) or 'none',
+                ', '.join(delta.removed) or 'none'))
+        if created or delta.added or delta.removed:
+            slaves_file.chown('ubuntu', 'hadoop')
+        return delta
+
+    def register_topology(self, racks=None, role=None):
+        """
+        Record the racks of hosts for rack awareness, and configure the
+        topology script which looks them up.
+
+        The racks of each ``role`` replace those previously registered for it,
+        so that a unit running both HDFS and YARN masters keeps the slaves of
+        both, and the topology is rewritten from the current racks of every
+        role, so that departed slaves are dropped from it.
+
+        Racks given by the ``rack_mapping`` charm config option, as a YAML
+        mapping of hostnames or IPs to racks, take precedence; if it is
+        invalid, the unit is set to blocked and the topology is left as is.
+        Hosts which are not known are placed in ``/default-rack``.
+
+        Hadoop caches the rack of each node once it registers, so moving an
+        existing node to another rack requires a restart of the master.
+
+        :param dict racks: Mapping of hostnames and IPs to racks
+        :param str role: Which slaves the racks are for, e.g. ``datanode``; if
+            not given, the topology is only rewritten
+        :returns: True if the topology changed
+        """
+        role_racks = unitdata.kv().get('hadoop.topology.racks') or {}
+        if role:
+            role_racks[role] = dict(racks or {})
+            unitdata.kv().set('hadoop.topology.racks', role_racks)
+            unitdata.kv().flush(True)
+        try:
+            mapping = utils.parse_rack_mapping(self.charm_config.get('rack_mapping'))
+        except ValueError as e:
+            hookenv.status_set('blocked', 'Invalid rack_mapping: {}'.format(e))
+            return False
+        racks = {}
+        for name in sorted(role_racks):
+            racks.update(role_racks[name])
+        racks.update(mapping)
+        conf_dir = self.dist_config.path('hadoop_conf')
+        changed = utils.write_topology(conf_dir, racks)
+        with utils.xmlpropmap_edit_in_place(conf_dir / 'core-site.xml') as props:
+            props['net.topology.script.file.name'] = conf_dir / 'topology.sh'
+        if changed:
+            hookenv.log('Rack topology updated: {}'.format(', '.join(
+                '{}={}'.format(host, rack) for host, rack in sorted(racks.items()))))
+        return changed
+
+    def _slave_racks(self, units):
+        """
+        Map the hostname and address of each related slave unit to the rack it
+        reported, if any.
+        """
+        racks = {}
+        for unit, data in units:
+            if data.get('rack'):
+                racks[data['hostname']] = data['rack']
+                if data.get('private-address'):
+                    racks[data['private-address']] = data['rack']
+        return racks
+
+    def request_restart(self, kv_prefix):
+        """
+        Ask the master for permission to restart a slave daemon; see
+        :meth:`coordinated_restart`.
+
+        :param str kv_prefix: Prefix of the unitdata keys tracking the request,
+            which are published on the relation to the master
+        """
+        unitdata.kv().set(kv_prefix + 'request', '{:.6f}'.format(time.time()))
+        unitdata.kv().flush(True)
+
+    def coordinated_restart(self, kv_prefix, relation, restart):
+        """
+        Restart a slave daemon, as asked for by :meth:`request_restart`, once
+        the master hands this unit a restart token, and finish once the master
+        has seen it healthy again and taken the token back.
+
+        This should be called on each hook, until it returns ``idle`` or ``done``.
+
+        :param str kv_prefix: Prefix of the unitdata keys tracking the request
+        :param str relation: Name of the relation to the master
+        :param callable restart: Restarts the daemon, and waits for it to be ready
+        :returns: One of ``idle`` (no restart was requested), ``waiting`` (for a
+            token), ``restarted`` (waiting for the master to see us healthy),
+            or ``done``
+        """
+        kv = unitdata.kv()
+        request = kv.get(kv_prefix + 'request')
+        if not request:
+            return 'idle'
+        unit, data = helpers.any_ready_unit(relation)
+        tokens = json.loads((data or {}).get('restart-tokens') or '[]')
+        hostname = hookenv.local_unit().replace('/', '-')
+        if kv.get(kv_prefix + 'done') != request:
+            if hostname not in tokens:
+                return 'waiting'
+            restart()
+            kv.set(kv_prefix + 'done', request)
+            kv.flush(True)
+            return 'restarted'
+        if hostname in tokens:
+            return 'restarted'
+        kv.unset(kv_prefix + 'request')
+        kv.unset(kv_prefix + 'done')
+        kv.flush(True)
+        return 'done'
+
+    def grant_restart_tokens(self, kv_key, relation, healthy):
+        """
+        Hand out restart tokens to the slaves which asked to be restarted,
+        as decided by :func:`~jujubigdata.utils.restart_tokens`.
+
+        The number of slaves restarting at once is limited by the
+        ``restart_concurrency`` charm config option (default 1), and to a
+        single rack at a time if ``restart_by_rack`` is set.
+
+        :param str kv_key: Unitdata key of the granted tokens, which are
+            published on the relation to the slaves
+        :param str relation: Name of the relation to the slaves
+        :param callable healthy: Called with a hostname, to check if that slave is healthy
+        :returns: The hostnames holding a token
+        """
+        requests, done, racks = {}, {}, {}
+        for unit, data in helpers.all_ready_units(relation):
+            hostname = data['hostname']
+            if data.get('restart-request'):
+                requests[hostname] = data['restart-request']
+            if data.get('restart-done'):
+                done[hostname] = data['restart-done']
+            racks[hostname] = utils.normalize_rack(data.get('rack'))
+        previous = unitdata.kv().get(kv_key) or []
+        granted = utils.restart_tokens(requests, done, previous, healthy,
+                                       concurrency=int(self.charm_config.get('restart_concurrency', 1)),
+                                       racks=racks if self.charm_config.get('restart_by_rack') else None)
+        if granted != previous:
+            hookenv.log('Restart tokens on {}: {}'.format(relation, ', '.join(granted) or 'none'))
+        unitdata.kv().set(kv_key, granted)
+        unitdata.kv().flush(True)
+        return granted
+
+    def exclude_hosts(self, filename, add=None, remove=None):
+        """
+        Add hosts to, or remove hosts from, an excludes file (such as the one
+        given by ``dfs.hosts.exclude``) in the Hadoop config dir.
+
+        :param str filename: Name of the excludes file, relative to ``hadoop_conf``
+        :param list add: Hosts to be excluded
+        :param list remove: Hosts to no longer be excluded
+        :returns: A :class:`~jujubigdata.utils.HostsDelta` of the hosts
+            that were added and removed
+        """
+        exclude_file = self.dist_config.path('hadoop_conf') / filename
+        hosts = set(utils.read_hosts_file(exclude_file)) | set(add or [])
+        hosts -= set(remove or [])
+        delta = utils.write_hosts_file(exclude_file, hosts, header=[
+            '# DO NOT EDIT',
+            '# This file is automatically managed by Juju',
+        ])
+        exclude_file.chown('ubuntu', 'hadoop')
+        return delta
 
     def run(self, user, command, *args, **kwargs):
         """
@@ -260,31 +837,95 @@ class HDFS(object):
     def stop_namenode(self):
         self._hadoop_daemon('stop', 'namenode')
 
-    def start_namenode(self):
-        if not utils.jps('NameNode'):
+    def start_namenode(self, wait=True, timeout=300):
+        """
+        Start the NameNode, if it's not already running.
+
+        :param bool wait: Wait until the NameNode accepts connections
+        :param int timeout: Seconds to wait
+        """
+        if not self.hadoop_base.is_running('namenode', 'NameNode'):
             self._hadoop_daemon('start', 'namenode')
-            # Some hadoop processes take a bit of time to start
-            # we need to let them get to a point where they are
-            # ready to accept connections - increase the value for hadoop 2.4.1
-            time.sleep(30)
+            if wait:
+                utils.wait_for(self.namenode_ready, timeout, 'NameNode')
 
     def stop_secondarynamenode(self):
         self._hadoop_daemon('stop', 'secondarynamenode')
 
-    def start_secondarynamenode(self):
-        if not utils.jps('SecondaryNameNode'):
+    def start_secondarynamenode(self, wait=True, timeout=300):
+        """
+        Start the SecondaryNameNode, if it's not already running.
+
+        :param bool wait: Wait until the SecondaryNameNode accepts connections
+        :param int timeout: Seconds to wait
+        """
+        if not self.hadoop_base.is_running('secondarynamenode', 'SecondaryNameNode'):
             self._hadoop_daemon('start', 'secondarynamenode')
-            # Some hadoop processes take a bit of time to start
-            # we need to let them get to a point where they are
-            # ready to accept connections - increase the value for hadoop 2.4.1
-            time.sleep(30)
+            if wait:
+                utils.wait_for(self.secondarynamenode_ready, timeout, 'SecondaryNameNode')
 
     def stop_datanode(self):
         self._hadoop_daemon('stop', 'datanode')
 
-    def start_datanode(self):
-        if not utils.jps('DataNode'):
+    def start_datanode(self, wait=False, timeout=300):
+        if not self.hadoop_base.is_running('datanode', 'DataNode'):
             self._hadoop_daemon('start', 'datanode')
+            if wait:
+                utils.wait_for(self.datanode_ready, timeout, 'DataNode')
+
+    def request_datanode_restart(self):
+        """
+        Ask the NameNode for a turn to restart the DataNode, so that only a
+        few DataNodes are down at once; see :meth:`restart_datanode_when_granted`.
+        """
+        self.hadoop_base.request_restart('hdfs.datanode.restart.')
+
+    def restart_datanode_when_granted(self):
+        """
+        Restart the DataNode once the NameNode grants it a turn, if requested.
+
+        :returns: The state of the restart; see :meth:`HadoopBase.coordinated_restart`
+        """
+        def restart():
+            self.stop_datanode()
+            self.start_datanode(wait=True)
+        return self.hadoop_base.coordinated_restart('hdfs.datanode.restart.', 'datanode', restart)
+
+    def grant_datanode_restarts(self):
+        """
+        Hand out turns to restart to the DataNodes which asked for one, taking
+        them back once the NameNode sees the DataNode in service again.
+        """
+        def healthy(host):
+            return self.decommission_status([host])[host]['state'] == 'in-service'
+        return self.hadoop_base.grant_restart_tokens('hdfs.restart.tokens', 'datanode', healthy)
+
+    def namenode_ready(self):
+        """
+        Check whether the NameNode is accepting RPC connections.
+        """
+        host = hookenv.local_unit().replace('/', '-')
+        return utils.port_open(host, self.hadoop_base.dist_config.port('namenode'))
+
+    def secondarynamenode_ready(self):
+        port = self.hadoop_base.dist_config.port('secondarynamenode')
+        if port:
+            return utils.port_open('127.0.0.1', port)
+        return self.hadoop_base.is_running('secondarynamenode', 'SecondaryNameNode')
+
+    def datanode_ready(self):
+        return utils.port_open('127.0.0.1', self.hadoop_base.dist_config.port('dn_webapp_http'))
+
+    def hdfs_writable(self):
+        """
+        Check whether HDFS is out of safe mode, and thus writable.
+        """
+        try:
+            output = self.hadoop_base.run('hdfs', 'bin/hdfs', 'dfsadmin', '-safemode', 'get',
+                                          capture_output=True)
+        except CalledProcessError:
+            return False
+        return 'Safe mode is OFF' in output
 
     def _remote(self, relation):
         """
@@ -312,6 +953,19 @@ class HDFS(object):
             props['dfs.blocksize'] = int(cfg['dfs_blocksize'])
             props['dfs.namenode.datanode.registration.ip-hostname-check'] = 'true'
             props['dfs.namenode.http-address'] = '0.0.0.0:{}'.format(dc.port('nn_webapp_http'))
+            # Decommissioning is driven by the excludes file; the replication
+            # stream limits throttle how fast decommissioning nodes are drained.
+            props['dfs.hosts.exclude'] = dc.path('hadoop_conf') / 'dfs.exclude'
+            max_streams = int(cfg.get('dfs_replication_max_streams', 2))
+            props['dfs.namenode.replication.max-streams'] = max_streams
+            props['dfs.namenode.replication.max-streams-hard-limit'] = max_streams * 2
+            props['dfs.namenode.replication.work.multiplier.per.iteration'] = \
+                cfg.get('dfs_replication_work_multiplier', 2)
+            servicerpc_port = dc.port('namenode_servicerpc')
+            if servicerpc_port:
+                # DataNode heartbeats and block reports get their own RPC queue
+                props['dfs.namenode.servicerpc-address'] = '{}:{}'.format(host, servicerpc_port)
+                props['dfs.namenode.servicerpc-bind-host'] = '0.0.0.0'
             # TODO: support SSL
             # props['dfs.namenode.https-address'] = '0.0.0.0:{}'.format(dc.port('nn_webapp_https'))
 
@@ -326,6 +980,42 @@ class HDFS(object):
                     host=secondary_host,
                     port=secondary_port,
                 )
+        self.hadoop_base.exclude_hosts('dfs.exclude')  # must exist for the NameNode to start
+        self.hadoop_base.register_topology()
+        self.configure_namenode_rpc()
+
+    def configure_namenode_rpc(self, datanodes=None):
+        """
+        Size the NameNode RPC handler pools to the number of DataNodes, and
+        optionally enable fair scheduling of the client RPC call queue (via
+        the ``namenode_fair_call_queue`` charm config option), so that a few
+        heavy users cannot starve the others.
+
+        Changes take effect the next time the NameNode is restarted.
+
+        :param int datanodes: Number of DataNodes (default: from the slaves file)
+        """
+        dc = self.hadoop_base.dist_config
+        cfg = self.hadoop_base.charm_config
+        if datanodes is None:
+            slaves_file = dc.path('hadoop_conf') / 'slaves'
+            datanodes = len(utils.read_hosts_file(slaves_file)) if slaves_file.exists() else 1
+        handlers = int(cfg.get('dfs_namenode_handler_count') or utils.rpc_handler_count(datanodes))
+        hdfs_site = dc.path('hadoop_conf') / 'hdfs-site.xml'
+        with utils.xmlpropmap_edit_in_place(hdfs_site) as props:
+            props['dfs.namenode.handler.count'] = handlers
+            if dc.port('namenode_servicerpc'):
+                props['dfs.namenode.service.handler.count'] = max(10, handlers // 2)
+        port = dc.port('namenode')
+        core_site = dc.path('hadoop_conf') / 'core-site.xml'
+        with utils.xmlpropmap_edit_in_place(core_site) as props:
+            if cfg.get('namenode_fair_call_queue'):
+                props['ipc.{}.callqueue.impl'.format(port)] = 'org.apache.hadoop.ipc.FairCallQueue'
+                props['ipc.{}.backoff.enable'.format(port)] = 'true'
+            else:
+                props.pop('ipc.{}.callqueue.impl'.format(port), None)
+                props.pop('ipc.{}.backoff.enable'.format(port), None)
+        return handlers
 
     def configure_secondarynamenode(self, host=None, port=None):
         """
@@ -341,16 +1031,124 @@ class HDFS(object):
             host, port = self._remote("secondary")
         self.configure_hdfs_base(host, port)
 
-    def configure_datanode(self, host=None, port=None):
+    def configure_datanode(self, host=None, port=None, servicerpc_port=None):
+        """
+        Configure this unit as a DataNode of the NameNode at the given host and port.
+
+        :returns: True if the DataNode's tuning changed (see
+            :meth:`configure_datanode_tuning`), in which case a running
+            DataNode should be restarted (e.g., via :meth:`request_datanode_restart`)
+        """
         if not (host and port):
             host, port = self._remote("datanode")
+        if not servicerpc_port and helpers:  # FIXME hack-around until transition to layers is complete
+            unit, data = helpers.any_ready_unit('datanode')
+            servicerpc_port = (data or {}).get('servicerpc-port')
         self.configure_hdfs_base(host, port)
         dc = self.hadoop_base.dist_config
+        cfg = self.hadoop_base.charm_config
+        data_dirs = utils.ensure_dirs(self.datanode_data_dirs(), owner='hdfs', group='hadoop', perms=0o700)
+        socket = self.short_circuit_socket()
+        if socket:
+            # the socket dir must only be writable by the DataNode user
+            utils.ensure_dirs([socket.dirname()], owner='hdfs', group='hadoop', perms=0o755)
         hdfs_site = dc.path('hadoop_conf') / 'hdfs-site.xml'
         with utils.xmlpropmap_edit_in_place(hdfs_site) as props:
             props['dfs.datanode.http.address'] = '0.0.0.0:{}'.format(dc.port('dn_webapp_http'))
+            if host and servicerpc_port:
+                props['dfs.namenode.servicerpc-address'] = '{}:{}'.format(host, servicerpc_port)
+            else:
+                props.pop('dfs.namenode.servicerpc-address', None)
+            props['dfs.datanode.data.dir'] = ','.join(data_dirs)
+            if len(data_dirs) > 1:
+                props['dfs.datanode.fsdataset.volume.choosing.policy'] = \
+                    'org.apache.hadoop.hdfs.server.datanode.fsdataset.AvailableSpaceVolumeChoosingPolicy'
+            du_reserved = cfg.get('dfs_datanode_du_reserved')
+            if not du_reserved:
+                # 5% of the smallest volume, up to 10GB, for non-HDFS use
+                smallest = min(stat.f_frsize * stat.f_blocks for stat in map(os.statvfs, data_dirs))
+                du_reserved = min(10 * 1024 ** 3, smallest // 20)
+            props['dfs.datanode.du.reserved'] = int(du_reserved)
+            failed_tolerated = cfg.get('dfs_datanode_failed_volumes_tolerated')
+            if failed_tolerated is None:
+                failed_tolerated = len(data_dirs) // 4
+            props['dfs.datanode.failed.volumes.tolerated'] = min(int(failed_tolerated), len(data_dirs) - 1)
             # TODO: support SSL
             # props['dfs.datanode.https.address'] = '0.0.0.0:{}'.format(dc.port('dn_webapp_https'))
+        return self.configure_datanode_tuning(len(data_dirs))
+
+    def configure_datanode_tuning(self, disks=None):
+        """
+        Tune the DataNode transfer threads, handlers, and page cache
+        behaviour to the cores and data disks of this unit, and to whether a
+        NodeManager is co-located with it.
+
+        :param int disks: Number of data dirs (default: as from :meth:`datanode_data_dirs`)
+        :returns: True if the tuning changed since it was last applied, in
+            which case the DataNode should be restarted
+        """
+        dc = self.hadoop_base.dist_config
+        if disks is None:
+            disks = len(self.datanode_data_dirs())
+        fingerprint = {
+            'cores': utils.get_cpu_count(),
+            'disks': disks,
+            'nodemanager': bool(unitdata.kv().get('yarn.nodemanager.configured')),
+        }
+        tuning = utils.datanode_tuning(**fingerprint)
+        hdfs_site = dc.path('hadoop_conf') / 'hdfs-site.xml'
+        with utils.xmlpropmap_edit_in_place(hdfs_site) as props:
+            props.update(tuning)
+        previous = unitdata.kv().get('hdfs.datanode.tuning')
+        changed = previous is not None and previous != fingerprint
+        if changed:
+            hookenv.log('DataNode hardware or role changed from {} to {}; retuned'.format(
+                previous, fingerprint))
+        unitdata.kv().set('hdfs.datanode.tuning', fingerprint)
+        unitdata.kv().flush(True)
+        return changed
+
+    def datanode_data_dirs(self):
+        """
+        Return the DataNode data directories, one per data disk.
+
+        Without dedicated data disks, a single directory under
+        ``hdfs_dir_base`` is used. A DataNode which already stored blocks in
+        the directory shared with the NameNode metadata by earlier versions
+        keeps it, so that its blocks are not lost.
+        """
+        dc = self.hadoop_base.dist_config
+        disks = self.hadoop_base.data_disks()
+        if disks:
+            data_dirs = [disk / 'hadoop/hdfs/data' for disk in disks]
+        else:
+            data_dirs = [dc.path('hdfs_dir_base') / 'cache/hadoop/dfs/data']
+        legacy_dir = dc.path('hdfs_dir_base') / 'cache/hadoop/dfs/name'
+        version = legacy_dir / 'current/VERSION'
+        if version.exists() and 'storageType=DATA_NODE' in version.text():
+            data_dirs.insert(0, legacy_dir)
+        return data_dirs
+
+    def short_circuit_socket(self):
+        """
+        Return the path of the DataNode domain socket used for short-circuit
+        local reads, or None if they are not enabled.
+
+        Short-circuit reads are enabled via the ``dfs_short_circuit_reads``
+        charm config option, and require the libhadoop native library. The
+        socket is kept in the ``hdfs_socket_dir`` dir from dist.yaml, if
+        defined, or ``/var/lib/hadoop-hdfs`` otherwise.
+        """
+        if not self.hadoop_base.charm_config.get('dfs_short_circuit_reads'):
+            return None
+        if not self.hadoop_base.native_libraries().get('hadoop'):
+            hookenv.log('Short-circuit reads require the libhadoop native library, '
+                        'which is not available; they will not be enabled', hookenv.WARNING)
+            return None
+        dc = self.hadoop_base.dist_config
+        if 'hdfs_socket_dir' in dc.dirs:
+            return dc.path('hdfs_socket_dir') / 'dn_socket'
+        return Path('/var/lib/hadoop-hdfs/dn_socket')
 
     def configure_client(self):
         self.configure_hdfs_base(*self._remote("namenode"))
@@ -365,18 +1163,33 @@ class HDFS(object):
             props['hadoop.proxyuser.hue.groups'] = "*"
             props['hadoop.proxyuser.oozie.groups'] = '*'
             props['hadoop.proxyuser.oozie.hosts'] = '*'
-            lzo_installed = unitdata.kv().get('hadoop.lzo.installed')
-            lzo_enabled = hookenv.config().get('compression') == 'lzo'
-            if lzo_installed and lzo_enabled:
-                props['io.compression.codecs'] = ('com.hadoop.compression.lzo.LzoCodec, '
-                                                  'com.hadoop.compression.lzo.LzopCodec')
+            codecs = self.hadoop_base.compression_codecs()
+            codec_classes = [codec_class for name, codec_class in codecs]
+            if 'lzo' in dict(codecs):
+                codec_classes.append('com.hadoop.compression.lzo.LzopCodec')
                 props['io.compression.codec.lzo.class'] = 'com.hadoop.compression.lzo.LzoCodec'
+            props['io.compression.codecs'] = ','.join(codec_classes)
         hdfs_site = dc.path('hadoop_conf') / 'hdfs-site.xml'
         with utils.xmlpropmap_edit_in_place(hdfs_site) as props:
             props['dfs.webhdfs.enabled'] = "true"
             props['dfs.namenode.name.dir'] = dc.path('hdfs_dir_base') / 'cache/hadoop/dfs/name'
-            props['dfs.datanode.data.dir'] = dc.path('hdfs_dir_base') / 'cache/hadoop/dfs/name'
             props['dfs.permissions'] = 'false'  # TODO - secure this hadoop installation!
+            socket = self.short_circuit_socket()
+            if socket:
+                props['dfs.client.read.shortcircuit'] = 'true'
+                props['dfs.domain.socket.path'] = socket
+            else:
+                props.pop('dfs.client.read.shortcircuit', None)
+                props.pop('dfs.domain.socket.path', None)
+            unitdata.kv().set('hdfs.short_circuit.socket', socket)
+            unitdata.kv().flush(True)
+            # the bandwidth and moves are enforced by the DataNodes, the
+            # mover / dispatcher threads by the balancer itself
+            cfg = self.hadoop_base.charm_config
+            props['dfs.datanode.balance.bandwidthPerSec'] = int(cfg.get('dfs_balance_bandwidth', 10485760))
+            props['dfs.datanode.balance.max.concurrent.moves'] = cfg.get('dfs_balance_max_concurrent_moves', 5)
+            props['dfs.balancer.moverThreads'] = cfg.get('dfs_balancer_mover_threads', 1000)
+            props['dfs.balancer.dispatcherThreads'] = cfg.get('dfs_balancer_dispatcher_threads', 200)
 
     def format_namenode(self):
         if unitdata.kv().get('hdfs.namenode.formatted'):
@@ -409,15 +1222,225 @@ class HDFS(object):
         unitdata.kv().set('hdfs.namenode.dirs.created', True)
         unitdata.kv().flush(True)
 
-    def register_slaves(self, slaves=None):
+    def register_slaves(self, slaves=None, racks=None):
+        """
+        Register the DataNodes with the NameNode.
+
+        If the membership changed, the NameNode is refreshed once, at the end
+        of the hook, no matter how many times this is called.
+
+        :param list slaves: Hostnames of all of the DataNodes
+        :param dict racks: Mapping of hostnames and IPs to racks, for rack awareness
+        :returns: A :class:`~jujubigdata.utils.HostsDelta` of the DataNodes
+            that were added and removed
+        """
         if not slaves:  # FIXME hack-around until transition to layers is complete
-            slaves = helpers.all_ready_units('datanode')
-            slaves = [data['hostname'] for slave, data in slaves]
-        self.hadoop_base.register_slaves(slaves)
+            units = helpers.all_ready_units('datanode')
+            slaves = [data['hostname'] for slave, data in units]
+            racks = racks or self.hadoop_base._slave_racks(units)
+        delta = self.hadoop_base.register_slaves(slaves)
+        self.hadoop_base.register_topology(racks, 'datanode')
+        if delta.added or delta.removed:
+            utils.defer_once('hdfs.refresh_nodes', self.refresh_nodes)
+            self.configure_namenode_rpc(len(set(slaves)))
+        existing = set(slaves) - set(delta.added)
+        pending = unitdata.kv().get('hdfs.balancer.pending') or []
+        if delta.removed and pending:
+            unitdata.kv().set('hdfs.balancer.pending', sorted(set(pending) - set(delta.removed)))
+            unitdata.kv().flush(True)
+        if self.hadoop_base.charm_config.get('balancer_auto') and (pending or delta.added and existing):
+            # new DataNodes joined an existing cluster; spread the blocks onto them, once they are live
+            # (deferred callbacks run in reverse order, so this refreshes the nodes itself)
+            utils.defer_once('hdfs.balancer', self.balance_new_datanodes, delta.added if existing else [])
+        excluded = self._excluded_datanodes()
+        for hostname in delta.removed:
+            if hostname not in excluded:
+                hookenv.log('DataNode {} was removed without being decommissioned; '
+                            'its blocks will be re-replicated'.format(hostname), hookenv.WARNING)
+        return delta
+
+    def refresh_nodes(self):
         if utils.jps('NameNode'):
             self.hadoop_base.run('hdfs', 'bin/hdfs', 'dfsadmin', '-refreshNodes')
 
+    def _excluded_datanodes(self):
+        exclude_file = self.hadoop_base.dist_config.path('hadoop_conf') / 'dfs.exclude'
+        return utils.read_hosts_file(exclude_file)
+
+    def decommission_datanodes(self, hosts):
+        """
+        Begin gracefully decommissioning the given DataNodes.
+
+        The hosts are added to the excludes file and the NameNode is refreshed,
+        so that it re-replicates their blocks (throttled by the replication
+        stream limits) before marking them as decommissioned.  Use
+        :meth:`decommission_status` or :meth:`wait_for_decommission` to track
+        the progress.
+
+        :param list hosts: Hostnames of the DataNodes to decommission
+        """
+        delta = self.hadoop_base.exclude_hosts('dfs.exclude', add=hosts)
+        if delta.added:
+            self.refresh_nodes()
+        return delta
+
+    def recommission_datanodes(self, hosts):
+        """
+        Return previously decommissioned DataNodes to service.
+
+        :param list hosts: Hostnames of the DataNodes to recommission
+        """
+        delta = self.hadoop_base.exclude_hosts('dfs.exclude', remove=hosts)
+        if delta.removed:
+            self.refresh_nodes()
+        return delta
+
+    def decommission_status(self, hosts=None):
+        """
+        Report the decommissioning progress of DataNodes, as seen by the NameNode.
+
+        Returns a mapping of each host to a dict containing its ``state``
+        (one of ``in-service``, ``decommissioning``, ``decommissioned``,
+        ``dead``, or ``unknown``) and the number of ``under_replicated_blocks``
+        left to drain.
+
+        A host which the NameNode does not report at all (e.g., because it knows
+        it by another name or address) is ``unknown``, rather than assumed to be
+        safe to remove.
+
+        :param list hosts: Hosts to report on (default: all excluded DataNodes)
+        """
+        dc = self.hadoop_base.dist_config
+        info = utils.read_jmx('localhost', dc.port('nn_webapp_http'),
+                              'Hadoop:service=NameNode,name=NameNodeInfo')
+        nodes = utils.parse_datanode_states(info)
+        if hosts is None:
+            hosts = self._excluded_datanodes()
+        return {host: nodes.get(host, {'state': 'unknown', 'under_replicated_blocks': 0})
+                for host in hosts}
+
+    def wait_for_decommission(self, hosts, timeout=3600, interval=30):
+        """
+        Wait for the given DataNodes to finish decommissioning, reporting the
+        progress via the unit's status.
+
+        Raises :class:`~jujubigdata.utils.TimeoutError` if they have not
+        finished within the timeout.
+        """
+        start = time.time()
+        while True:
+            status = self.decommission_status(hosts)
+            pending = {host: node for host, node in status.items()
+                       if node['state'] in ('in-service', 'decommissioning', 'unknown')}
+            if not pending:
+                hookenv.status_set('maintenance', 'DataNodes decommissioned: {}'.format(
+                    ', '.join(sorted(hosts))))
+                return True
+            progress = ', '.join('{} (not known to the NameNode)'.format(host) if node['state'] == 'unknown'
+                                 else '{} ({} blocks left)'.format(host, node['under_replicated_blocks'])
+                                 for host, node in sorted(pending.items()))
+            hookenv.status_set('maintenance', 'Decommissioning DataNodes: {}'.format(progress))
+            if time.time() - start > timeout:
+                raise utils.TimeoutError('Timed-out decommissioning DataNodes: {}'.format(progress))
+            time.sleep(interval)
+
+    def is_decommissioned(self, host):
+        """
+        Check whether the given DataNode has finished decommissioning, and
+        can therefore be safely removed.
+        """
+        return self.decommission_status([host])[host]['state'] in ('decommissioned', 'dead')
+
+    def start_balancer(self, threshold=None):
+        """
+        Start the HDFS balancer in the background, to move blocks from
+        over-utilized DataNodes onto under-utilized (e.g., newly added) ones.
+
+        The balancing bandwidth is also pushed to the running DataNodes, so
+        that changes to it take effect without restarting them.
+
+        :param threshold: Percentage by which each DataNode's utilization
+            may differ from the cluster's (default: ``balancer_threshold``
+            config option, or 10)
+        :returns: True if the balancer was started, False if it was already running
+        """
+        if not utils.jps('NameNode') or self.balancer_running():
+            return False
+        cfg = self.hadoop_base.charm_config
+        if threshold is None:
+            threshold = cfg.get('balancer_threshold', 10)
+        self._hdfs('dfsadmin', '-setBalancerBandwidth', str(int(cfg.get('dfs_balance_bandwidth', 10485760))))
+        self.hadoop_base.run('hdfs', 'sbin/start-balancer.sh',
+                             '--config',
+                             self.hadoop_base.dist_config.path('hadoop_conf'),
+                             '-threshold', str(threshold))
+        return True
+
+    def balance_new_datanodes(self, hosts=None):
+        """
+        Refresh the NameNode and, if the given new DataNodes, and any still
+        pending from earlier hooks, are live, start the balancer to move
+        blocks onto them.
+
+        This doesn't wait for the DataNodes: if they aren't live yet, they
+        are left pending, and :meth:`register_slaves` tries again in the
+        next hook.
+
+        :param list hosts: Hostnames of the new DataNodes
+        :returns: True if the balancer was started
+        """
+        kv = unitdata.kv()
+        pending = sorted(set(kv.get('hdfs.balancer.pending') or []) | set(hosts or []))
+        if not pending:
+            return False
+        if hosts:
+            self.refresh_nodes()
+        not_live = sorted(host for host, node in self.decommission_status(pending).items()
+                          if node['state'] != 'in-service')
+        if not_live:
+            hookenv.log('Not starting the balancer until the new DataNodes are live: {}'.format(
+                ', '.join(not_live)))
+            kv.set('hdfs.balancer.pending', pending)
+            kv.flush(True)
+            return False
+        kv.unset('hdfs.balancer.pending')
+        kv.flush(True)
+        return self.start_balancer()
+
+    def stop_balancer(self):
+        self.hadoop_base.run('hdfs', 'sbin/stop-balancer.sh',
+                             '--config',
+                             self.hadoop_base.dist_config.path('hadoop_conf'))
+
+    def balancer_running(self):
+        return bool(utils.jps('Balancer'))
+
+    def balancer_status(self):
+        """
+        Report the progress of the most recent balancer run, as parsed from
+        its output.
+
+        Returns a dict containing whether the balancer is ``running``, the
+        ``iteration`` number, the amount of data ``moved``, ``left`` to move,
+        and ``being_moved`` (as reported by the balancer; e.g., ``1.5 GB``),
+        and the last ``message`` it printed (e.g., ``The cluster is balanced.
+        Exiting...``); see :func:`~jujubigdata.utils.parse_balancer_output`.
+        """
+        log_dir = self.hadoop_base.dist_config.path('hdfs_log_dir')
+        outputs = sorted(log_dir.files('hadoop-*-balancer-*.out'), key=lambda f: f.mtime)
+        status = utils.parse_balancer_output(outputs[-1].lines(retain=False) if outputs else [])
+        status['running'] = self.balancer_running()
+        return status
+
     def _hadoop_daemon(self, command, service):
+        if self.hadoop_base.service_backend() == 'systemd':
+            port = {
+                'namenode': self.hadoop_base.dist_config.port('namenode'),
+                'datanode': self.hadoop_base.dist_config.port('dn_webapp_http'),
+                'secondarynamenode': self.hadoop_base.dist_config.port('secondarynamenode'),
+            }.get(service)
+            self.hadoop_base.systemd_daemon(command, service, 'hdfs', 'bin/hdfs', port)
+            return
         self.hadoop_base.run('hdfs', 'sbin/hadoop-daemon.sh',
                              '--config',
                              self.hadoop_base.dist_config.path('hadoop_conf'),
@@ -434,23 +1457,96 @@ class YARN(object):
     def stop_resourcemanager(self):
         self._yarn_daemon('stop', 'resourcemanager')
 
-    def start_resourcemanager(self):
-        if not utils.jps('ResourceManager'):
+    def start_resourcemanager(self, wait=False, timeout=300):
+        if not self.hadoop_base.is_running('resourcemanager', 'ResourceManager'):
             self._yarn_daemon('start', 'resourcemanager')
+            if wait:
+                utils.wait_for(self.resourcemanager_ready, timeout, 'ResourceManager')
 
     def stop_jobhistory(self):
         self._jobhistory_daemon('stop', 'historyserver')
 
-    def start_jobhistory(self):
-        if not utils.jps('JobHistoryServer'):
+    def start_jobhistory(self, wait=False, timeout=300):
+        if not self.hadoop_base.is_running('historyserver', 'JobHistoryServer'):
             self._jobhistory_daemon('start', 'historyserver')
+            if wait:
+                utils.wait_for(self.jobhistory_ready, timeout, 'JobHistoryServer')
 
     def stop_nodemanager(self):
         self._yarn_daemon('stop', 'nodemanager')
 
-    def start_nodemanager(self):
-        if not utils.jps('NodeManager'):
+    def start_nodemanager(self, wait=False, timeout=300):
+        if not self.hadoop_base.is_running('nodemanager', 'NodeManager'):
+            self.ensure_cgroup_hierarchies()
             self._yarn_daemon('start', 'nodemanager')
+            if wait:
+                utils.wait_for(self.nodemanager_ready, timeout, 'NodeManager')
+
+    def remove_nodemanager(self):
+        """
+        Stop the NodeManager for good, e.g., when this unit is no longer
+        related to a ResourceManager, so that a co-located DataNode is no
+        longer tuned to share the unit with it.
+        """
+        self.stop_nodemanager()
+        self._set_nodemanager_role(False)
+
+    def _set_nodemanager_role(self, present):
+        """
+        Record whether this unit runs a NodeManager and, if that changed the
+        tuning of a co-located DataNode, request a rolling restart of the
+        DataNode (see :meth:`HDFS.request_datanode_restart`).
+        """
+        kv = unitdata.kv()
+        if bool(kv.get('yarn.nodemanager.configured')) == present:
+            return
+        kv.set('yarn.nodemanager.configured', present)
+        kv.flush(True)
+        if kv.get('hdfs.datanode.tuning') is None:
+            return  # no DataNode on this unit
+        hdfs = HDFS(self.hadoop_base)
+        if hdfs.configure_datanode_tuning():
+            hdfs.request_datanode_restart()
+
+    def request_nodemanager_restart(self):
+        """
+        Ask the ResourceManager for a turn to restart the NodeManager; see
+        :meth:`restart_nodemanager_when_granted`.
+        """
+        self.hadoop_base.request_restart('yarn.nodemanager.restart.')
+
+    def restart_nodemanager_when_granted(self):
+        """
+        Restart the NodeManager once the ResourceManager grants it a turn, if requested.
+
+        :returns: The state of the restart; see :meth:`HadoopBase.coordinated_restart`
+        """
+        def restart():
+            self.stop_nodemanager()
+            self.start_nodemanager(wait=True)
+        return self.hadoop_base.coordinated_restart('yarn.nodemanager.restart.', 'nodemanager', restart)
+
+    def grant_nodemanager_restarts(self):
+        """
+        Hand out turns to restart to the NodeManagers which asked for one,
+        taking them back once the ResourceManager sees the NodeManager running.
+        """
+        def healthy(host):
+            return self.decommission_status([host])[host] == 'RUNNING'
+        return self.hadoop_base.grant_restart_tokens('yarn.restart.tokens', 'nodemanager', healthy)
+
+    def resourcemanager_ready(self):
+        """
+        Check whether the ResourceManager is accepting RPC connections.
+        """
+        host = hookenv.local_unit().replace('/', '-')
+        return utils.port_open(host, self.hadoop_base.dist_config.port('resourcemanager'))
+
+    def jobhistory_ready(self):
+        return utils.port_open('127.0.0.1', self.hadoop_base.dist_config.port('jobhistory'))
+
+    def nodemanager_ready(self):
+        return self.hadoop_base.is_running('nodemanager', 'NodeManager')
 
     def _remote(self, relation):
         """
@@ -487,8 +1583,91 @@ class YARN(object):
         with utils.xmlpropmap_edit_in_place(yarn_site) as props:
             # 0.0.0.0 will listen on all interfaces, which is what we want on the server
             props['yarn.resourcemanager.webapp.address'] = '0.0.0.0:{}'.format(dc.port('rm_webapp_http'))
+            props['yarn.resourcemanager.nodes.exclude-path'] = dc.path('hadoop_conf') / 'yarn.exclude'
             # TODO: support SSL
             # props['yarn.resourcemanager.webapp.https.address'] = '0.0.0.0:{}'.format(dc.port('rm_webapp_https'))
+        self.hadoop_base.exclude_hosts('yarn.exclude')
+        self.hadoop_base.register_topology()
+        self.configure_scheduler()
+        if helpers:  # FIXME hack-around until transition to layers is complete
+            self.configure_cluster_sizing()
+
+    def configure_scheduler(self):
+        """
+        Configure the Capacity Scheduler queues and scheduling options.
+
+        The queues come from the ``yarn_queues`` charm config option, as a
+        YAML mapping (see :func:`~jujubigdata.utils.capacity_scheduler_queues`),
+        or a single ``default`` queue otherwise.  If it is invalid, the unit is
+        set to blocked and nothing is changed.  Preemption is enabled when
+        there is more than one queue, unless ``yarn_preemption`` is set.
+        Multiple containers are assigned per node heartbeat, unless disabled
+        via ``yarn_multiple_assignments``, and scheduling is done
+        asynchronously if ``yarn_async_scheduling`` is set.
+
+        Queue changes are applied to a running ResourceManager via
+        ``rmadmin -refreshQueues``, once, at the end of the hook.  Changes to
+        preemption or asynchronous scheduling are only read when the
+        ResourceManager starts, so a restart is reported as needed for them.
+
+        :returns: True if the scheduler configuration changed
+        """
+        dc = self.hadoop_base.dist_config
+        cfg = self.hadoop_base.charm_config
+        try:
+            queues = yaml.safe_load(cfg.get('yarn_queues') or '') or {'default': {'capacity': 100}}
+            queue_props = utils.capacity_scheduler_queues(queues)
+        except (yaml.YAMLError, ValueError) as e:
+            hookenv.status_set('blocked', 'Invalid yarn_queues: {}'.format(e))
+            return False
+        leaf_queues = [key for key in queue_props
+                       if key.endswith('.capacity') and key[:-len('.capacity')] + '.queues' not in queue_props]
+        preemption = cfg.get('yarn_preemption')
+        if preemption is None:
+            preemption = len(leaf_queues) > 1
+        multiple_assignments = cfg.get('yarn_multiple_assignments', True)
+        async_scheduling = cfg.get('yarn_async_scheduling', False)
+
+        yarn_site = dc.path('hadoop_conf') / 'yarn-site.xml'
+        with utils.xmlpropmap_edit_in_place(yarn_site) as props:
+            old_site = dict(props)
+            props['yarn.resourcemanager.scheduler.class'] = \
+                'org.apache.hadoop.yarn.server.resourcemanager.scheduler.capacity.CapacityScheduler'
+            props['yarn.resourcemanager.scheduler.monitor.enable'] = utils.normalize_strbool(preemption)
+            if preemption:
+                props['yarn.resourcemanager.scheduler.monitor.policies'] = (
+                    'org.apache.hadoop.yarn.server.resourcemanager.monitor.capacity.'
+                    'ProportionalCapacityPreemptionPolicy')
+            restart_needed = {k: str(v) for k, v in props.items()} != old_site
+
+        capacity_scheduler = dc.path('hadoop_conf') / 'capacity-scheduler.xml'
+        with utils.xmlpropmap_edit_in_place(capacity_scheduler) as props:
+            old_props = dict(props)
+            queue_paths = set(key[len('yarn.scheduler.capacity.'):].rsplit('.', 1)[0] for key in queue_props)
+            for key in list(props):
+                # drop the properties of queues which no longer exist
+                if key.startswith('yarn.scheduler.capacity.root.'):
+                    if key[len('yarn.scheduler.capacity.'):].rsplit('.', 1)[0] not in queue_paths:
+                        del props[key]
+            props.update(queue_props)
+            props['yarn.scheduler.capacity.per-node-heartbeat.multiple-assignments-enabled'] = \
+                utils.normalize_strbool(multiple_assignments)
+            props['yarn.scheduler.capacity.per-node-heartbeat.maximum-container-assignments'] = \
+                cfg.get('yarn_max_assignments_per_heartbeat', -1)
+            async_key = 'yarn.scheduler.capacity.schedule-asynchronously.enable'
+            props[async_key] = utils.normalize_strbool(async_scheduling)
+            changed = {k: str(v) for k, v in props.items()} != old_props
+            restart_needed = restart_needed or old_props.get(async_key, 'false') != props[async_key]
+        if changed:
+            utils.defer_once('yarn.refresh_queues', self.refresh_queues)
+        if restart_needed and utils.jps('ResourceManager'):
+            hookenv.log('Scheduler preemption or asynchronous scheduling changed; '
+                        'restart the ResourceManager to apply them', hookenv.WARNING)
+        return changed or restart_needed
+
+    def refresh_queues(self):
+        if utils.jps('ResourceManager'):
+            self.hadoop_base.run('mapred', 'bin/yarn', 'rmadmin', '-refreshQueues')
 
     def configure_jobhistory(self):
         self.configure_yarn_base(*self._local())
@@ -498,18 +1677,214 @@ class YARN(object):
             # 0.0.0.0 will listen on all interfaces, which is what we want on the server
             props["mapreduce.jobhistory.address"] = "0.0.0.0:{}".format(dc.port('jobhistory'))
             props["mapreduce.jobhistory.webapp.address"] = "0.0.0.0:{}".format(dc.port('jh_webapp_http'))
+        self.configure_job_sizing()
 
-    def configure_nodemanager(self, host=None, port=None, history_http=None, history_ipc=None):
+    def configure_nodemanager(self, host=None, port=None, history_http=None, history_ipc=None,
+                              job_sizing=None, nodes=None):
         if not all([host, port, history_http, history_ipc]):
             # FIXME hack-around until transition to layers is complete
             host, port, history_http, history_ipc = self._remote("nodemanager")
+        if job_sizing is None and helpers:
+            # FIXME hack-around until transition to layers is complete
+            job_sizing, nodes = self._remote_cluster("nodemanager")
         self.configure_yarn_base(host, port, history_http, history_ipc)
+        self.configure_container_sizing()
+        self.configure_job_sizing(job_sizing, nodes)
+        dc = self.hadoop_base.dist_config
+        cfg = self.hadoop_base.charm_config
+        self._set_nodemanager_role(True)
+        local_dirs, log_dirs = self.nodemanager_dirs()
+        utils.ensure_dirs(local_dirs + log_dirs, owner='yarn', group='hadoop', perms=0o755)
+        yarn_site = dc.path('hadoop_conf') / 'yarn-site.xml'
+        with utils.xmlpropmap_edit_in_place(yarn_site) as props:
+            props['yarn.nodemanager.local-dirs'] = ','.join(local_dirs)
+            props['yarn.nodemanager.log-dirs'] = ','.join(log_dirs)
+            # a NodeManager is marked unhealthy once too few of its disks are usable
+            props['yarn.nodemanager.disk-health-checker.min-healthy-disks'] = \
+                cfg.get('yarn_nodemanager_min_healthy_disks', 0.25)
+            props['yarn.nodemanager.disk-health-checker.max-disk-utilization-per-disk-percentage'] = \
+                cfg.get('yarn_nodemanager_max_disk_utilization', 90.0)
+            props['yarn.nodemanager.disk-health-checker.min-free-space-per-disk-mb'] = \
+                cfg.get('yarn_nodemanager_min_free_space_mb', 1024)
+        self.configure_container_isolation()
+
+    def configure_container_isolation(self):
+        """
+        Isolate containers with the LinuxContainerExecutor and cgroups, if
+        enabled via the ``yarn_container_isolation`` charm config option, or
+        go back to the DefaultContainerExecutor otherwise.
+
+        Containers get CPU shares in proportion to their vcores, capped at
+        their share when ``yarn_cpu_limit`` is ``strict`` (rather than
+        ``soft``), and the NodeManager is limited to ``yarn_cpu_percentage``
+        of the CPUs. On Hadoop 2.9 and later, memory limits are enforced by
+        the cgroups, rather than by the NodeManager polling the process trees;
+        earlier versions can only limit CPU, so the polling is kept.
+
+        The cgroup hierarchies don't survive a reboot, so they are recreated
+        before each NodeManager start (see :meth:`ensure_cgroup_hierarchies`)
+        and, with systemd, at boot.
+
+        Only cgroups v1 hierarchies are supported.
+
+        :returns: True if isolation is enabled
+        """
+        dc = self.hadoop_base.dist_config
+        cfg = self.hadoop_base.charm_config
+        yarn_site = dc.path('hadoop_conf') / 'yarn-site.xml'
+        lce_props = [
+            'yarn.nodemanager.linux-container-executor.group',
+            'yarn.nodemanager.linux-container-executor.resources-handler.class',
+            'yarn.nodemanager.linux-container-executor.cgroups.hierarchy',
+            'yarn.nodemanager.linux-container-executor.cgroups.mount',
+            'yarn.nodemanager.linux-container-executor.cgroups.mount-path',
+            'yarn.nodemanager.linux-container-executor.cgroups.strict-resource-usage',
+            'yarn.nodemanager.resource.percentage-physical-cpu-limit',
+        ]
+        memory_props = [
+            'yarn.nodemanager.resource.memory.enabled',
+            'yarn.nodemanager.resource.memory.enforced',
+            'yarn.nodemanager.pmem-check-enabled',
+        ]
+        enabled = cfg.get('yarn_container_isolation')
+        cgroup_root = Path('/sys/fs/cgroup')
+        if enabled and (cgroup_root / 'cgroup.controllers').exists():
+            hookenv.log('Container isolation requires cgroups v1, but this unit uses the '
+                        'unified hierarchy; it will not be enabled', hookenv.ERROR)
+            enabled = False
+        boot_unit = utils.SYSTEMD_UNIT_DIR / 'hadoop-yarn-cgroups.service'
+        if not enabled:
+            with utils.xmlpropmap_edit_in_place(yarn_site) as props:
+                props['yarn.nodemanager.container-executor.class'] = \
+                    'org.apache.hadoop.yarn.server.nodemanager.DefaultContainerExecutor'
+                for prop in lce_props + memory_props:
+                    props.pop(prop, None)
+            if boot_unit.exists():
+                check_call(['systemctl', 'disable', boot_unit.name])
+                boot_unit.remove()
+                check_call(['systemctl', 'daemon-reload'])
+            return False
+
+        # the setuid binary, and its config, must only be writable by root
+        container_executor = dc.path('hadoop') / 'bin/container-executor'
+        container_executor.chown('root', 'hadoop')
+        container_executor.chmod(0o6050)
+        container_executor_cfg = dc.path('hadoop') / 'etc/hadoop/container-executor.cfg'
+        container_executor_cfg.write_lines([
+            '# DO NOT EDIT',
+            '# This file is automatically managed by Juju',
+            'yarn.nodemanager.linux-container-executor.group=hadoop',
+            'banned.users=hdfs,yarn,mapred,bin',
+            'min.user.id={}'.format(cfg.get('yarn_container_min_user_id', 1000)),
+            'allowed.system.users=',
+        ])
+        container_executor_cfg.chown('root', 'hadoop')
+        container_executor_cfg.chmod(0o400)
+        hierarchy = 'hadoop-yarn'
+        memory = self.memory_isolation_supported()
+
+        with utils.xmlpropmap_edit_in_place(yarn_site) as props:
+            props['yarn.nodemanager.container-executor.class'] = \
+                'org.apache.hadoop.yarn.server.nodemanager.LinuxContainerExecutor'
+            props['yarn.nodemanager.linux-container-executor.group'] = 'hadoop'
+            props['yarn.nodemanager.linux-container-executor.resources-handler.class'] = \
+                'org.apache.hadoop.yarn.server.nodemanager.util.CgroupsLCEResourcesHandler'
+            props['yarn.nodemanager.linux-container-executor.cgroups.hierarchy'] = '/' + hierarchy
+            props['yarn.nodemanager.linux-container-executor.cgroups.mount'] = 'false'
+            props['yarn.nodemanager.linux-container-executor.cgroups.mount-path'] = cgroup_root
+            props['yarn.nodemanager.linux-container-executor.cgroups.strict-resource-usage'] = \
+                utils.normalize_strbool(cfg.get('yarn_cpu_limit', 'soft') == 'strict')
+            props['yarn.nodemanager.resource.percentage-physical-cpu-limit'] = cfg.get('yarn_cpu_percentage', 100)
+            if memory:
+                # the cgroups enforce the physical memory limits, which makes the
+                # NodeManager's own (virtual and physical) memory checks redundant
+                props['yarn.nodemanager.resource.memory.enabled'] = 'true'
+                props['yarn.nodemanager.resource.memory.enforced'] = 'true'
+                props['yarn.nodemanager.pmem-check-enabled'] = 'false'
+                props['yarn.nodemanager.vmem-check-enabled'] = 'false'
+            else:
+                # CgroupsLCEResourcesHandler only limits CPU
+                for prop in memory_props:
+                    props.pop(prop, None)
+        hierarchies = self.ensure_cgroup_hierarchies()
+        if Path('/run/systemd/system').exists():
+            utils.install_systemd_unit(boot_unit.name, '\n'.join([
+                '[Unit]',
+                'Description=Create the cgroup hierarchies of the Apache Hadoop NodeManager',
+                'After=local-fs.target',
+                'Before=hadoop-nodemanager.service',
+                '',
+                '[Service]',
+                'Type=oneshot',
+                "ExecStart=/bin/sh -c 'mkdir -p {dirs} && chown yarn:hadoop {dirs}'".format(
+                    dirs=' '.join(hierarchies)),
+                '',
+                '[Install]',
+                'WantedBy=multi-user.target',
+                '']))
+        return True
+
+    def memory_isolation_supported(self):
+        """
+        Check whether the NodeManager can enforce memory limits with cgroups,
+        which needs Hadoop 2.9 or later.
+        """
+        version = [int(part) for part in re.findall(r'\d+', str(self.hadoop_base.dist_config.hadoop_version))[:2]]
+        return version >= [2, 9]
+
+    def ensure_cgroup_hierarchies(self):
+        """
+        Create the cgroup hierarchies the NodeManager puts containers in, if
+        container isolation is enabled, as they are lost on reboot.
+
+        They are found from ``yarn-site.xml``, rather than :func:`unitdata.kv`,
+        as this is called when starting the NodeManager, which may happen in a
+        worker thread (see :class:`Lifecycle`).
+
+        :returns: The list of hierarchies
+        """
+        props = utils.read_xmlpropmap(self.hadoop_base.dist_config.path('hadoop_conf') / 'yarn-site.xml')
+        prefix = 'yarn.nodemanager.linux-container-executor.cgroups.'
+        if not props.get('yarn.nodemanager.container-executor.class', '').endswith('.LinuxContainerExecutor') or \
+                props.get(prefix + 'mount') != 'false':
+            return []
+        controllers = ['cpu']
+        if props.get('yarn.nodemanager.resource.memory.enabled') == 'true':
+            controllers.append('memory')
+        hierarchies = [Path(props[prefix + 'mount-path']) / controller / props[prefix + 'hierarchy'].lstrip('/')
+                       for controller in controllers]
+        return utils.ensure_dirs(hierarchies, owner='yarn', group='hadoop')
+
+    def nodemanager_dirs(self):
+        """
+        Return the NodeManager local (shuffle and spill) and container log
+        directories, one of each per data disk.
+
+        Without dedicated data disks, the local dir is kept under
+        ``hdfs_dir_base`` and the log dir under ``yarn_log_dir``.
 
-    def configure_client(self, host=None, port=None, history_http=None, history_ipc=None):
+        :returns: A tuple of the lists of local dirs and log dirs
+        """
+        dc = self.hadoop_base.dist_config
+        disks = self.hadoop_base.data_disks()
+        if disks:
+            return ([disk / 'hadoop/yarn/local' for disk in disks],
+                    [disk / 'hadoop/yarn/log' for disk in disks])
+        return ([dc.path('hdfs_dir_base') / 'cache/hadoop/yarn/local'],
+                [dc.path('yarn_log_dir') / 'userlogs'])
+
+    def configure_client(self, host=None, port=None, history_http=None, history_ipc=None,
+                         job_sizing=None, nodes=None):
         if not all([host, port, history_http, history_ipc]):
             # FIXME hack-around until transition to layers is complete
             host, port, history_http, history_ipc = self._remote("resourcemanager")
+        if job_sizing is None and helpers:
+            # FIXME hack-around until transition to layers is complete
+            job_sizing, nodes = self._remote_cluster("resourcemanager")
         self.configure_yarn_base(host, port, history_http, history_ipc)
+        # jobs take their settings from the submitting client's mapred-site,
+        # so clients are tuned to the cluster, too
+        self.configure_job_sizing(job_sizing, nodes)
 
     def configure_yarn_base(self, host, port, history_http, history_ipc):
         dc = self.hadoop_base.dist_config
@@ -526,6 +1901,228 @@ class YARN(object):
             if host and history_ipc:
                 props["mapreduce.jobhistory.address"] = "{}:{}".format(host, history_ipc)
             props["mapreduce.framework.name"] = 'yarn'
+        self.configure_compression()
+
+    def configure_compression(self):
+        """
+        Compress job output with the codec named by the ``compression`` charm
+        config option, and map output with the one named by
+        ``map_output_compression`` (default: the same codec).
+
+        Codecs which are unknown or whose native library is unavailable are
+        refused, leaving that output uncompressed.
+        """
+        dc = self.hadoop_base.dist_config
+        cfg = self.hadoop_base.charm_config
+        output_codec = self.hadoop_base.compression_codec(cfg.get('compression'))
+        map_codec = self.hadoop_base.compression_codec(
+            cfg.get('map_output_compression') or cfg.get('compression'))
+        mapred_site = dc.path('hadoop_conf') / 'mapred-site.xml'
+        with utils.xmlpropmap_edit_in_place(mapred_site) as props:
+            if map_codec:
+                props['mapreduce.map.output.compress.codec'] = map_codec
+            else:
+                props.pop('mapreduce.map.output.compress.codec', None)
+            if output_codec:
+                props['mapreduce.output.fileoutputformat.compress'] = 'true'
+                props['mapreduce.output.fileoutputformat.compress.codec'] = output_codec
+                props['mapreduce.output.fileoutputformat.compress.type'] = 'BLOCK'
+            else:
+                props['mapreduce.output.fileoutputformat.compress'] = 'false'
+                props.pop('mapreduce.output.fileoutputformat.compress.codec', None)
+                props.pop('mapreduce.output.fileoutputformat.compress.type', None)
+
+    def configure_container_sizing(self):
+        """
+        Size this NodeManager's resources, and thus the number and size of the
+        containers it runs, to the memory and CPUs of this unit, leaving room
+        for the system and any co-located services (an HBase RegionServer or
+        a DataNode).
+
+        The sizes are published to the ResourceManager, which derives the
+        scheduler limits and MapReduce task sizes from those of all of the
+        NodeManagers (see :meth:`configure_cluster_sizing`).
+
+        The NodeManager's memory and vcores can be overridden via the charm config.
+
+        :returns: The dict of sizes from :func:`~jujubigdata.utils.yarn_container_sizing`
+        """
+        dc = self.hadoop_base.dist_config
+        cfg = self.hadoop_base.charm_config
+        colocated = set((cfg.get('yarn_colocated_services') or '').split())
+        if utils.jps('HRegionServer'):
+            colocated.add('hbase')
+        if utils.jps('DataNode'):
+            colocated.add('datanode')
+        reserved_mb = cfg.get('yarn_reserved_memory_mb')
+        sizing = utils.yarn_container_sizing(
+            utils.get_total_memory_mb(),
+            utils.get_cpu_count(),
+            disks=len(self.hadoop_base.data_disks()) or None,
+            reserved_mb=int(reserved_mb) if reserved_mb else None,
+            hbase='hbase' in colocated,
+            datanode='datanode' in colocated)
+        overrides = {
+            'nodemanager_mb': 'yarn_nodemanager_memory_mb',
+            'nodemanager_vcores': 'yarn_nodemanager_vcores',
+        }
+        for key, option in overrides.items():
+            if cfg.get(option):
+                sizing[key] = int(cfg[option])
+        sizing['container_mb'] = min(sizing['container_mb'], sizing['nodemanager_mb'])
+
+        yarn_site = dc.path('hadoop_conf') / 'yarn-site.xml'
+        with utils.xmlpropmap_edit_in_place(yarn_site) as props:
+            props['yarn.nodemanager.resource.memory-mb'] = sizing['nodemanager_mb']
+            props['yarn.nodemanager.resource.cpu-vcores'] = sizing['nodemanager_vcores']
+        unitdata.kv().set('yarn.container.sizing', sizing)
+        unitdata.kv().flush(True)
+        return sizing
+
+    def configure_cluster_sizing(self, nodes=None):
+        """
+        Set the ResourceManager's scheduler limits, and the MapReduce task
+        sizes which it publishes to its clients, from the sizes of the
+        NodeManagers (see :func:`~jujubigdata.utils.cluster_container_sizing`).
+
+        The scheduler limits can be overridden via the charm config.
+
+        :param list nodes: A dict of the ``nodemanager_mb``, ``container_mb``, and
+            ``nodemanager_vcores`` of each NodeManager (default: as published on
+            the ``nodemanager`` relation)
+        :returns: The dict of sizes, or None if no NodeManager has published its sizes yet
+        """
+        if nodes is None:  # FIXME hack-around until transition to layers is complete
+            nodes = [{
+                'nodemanager_mb': int(data['nodemanager-memory-mb']),
+                'container_mb': int(data['container-memory-mb']),
+                'nodemanager_vcores': int(data['nodemanager-vcores']),
+            } for unit, data in helpers.all_ready_units('nodemanager') if data.get('nodemanager-memory-mb')]
+        sizing = utils.cluster_container_sizing(nodes)
+        if not sizing:
+            return None
+        cfg = self.hadoop_base.charm_config
+        overrides = {
+            'scheduler_min_mb': 'yarn_scheduler_minimum_allocation_mb',
+            'scheduler_max_mb': 'yarn_scheduler_maximum_allocation_mb',
+        }
+        for key, option in overrides.items():
+            if cfg.get(option):
+                sizing[key] = int(cfg[option])
+        yarn_site = self.hadoop_base.dist_config.path('hadoop_conf') / 'yarn-site.xml'
+        with utils.xmlpropmap_edit_in_place(yarn_site) as props:
+            props['yarn.scheduler.minimum-allocation-mb'] = sizing['scheduler_min_mb']
+            props['yarn.scheduler.maximum-allocation-mb'] = sizing['scheduler_max_mb']
+            props['yarn.scheduler.maximum-allocation-vcores'] = sizing['scheduler_max_vcores']
+        return self.configure_job_sizing(sizing)
+
+    def configure_job_sizing(self, sizing=None, nodes=None):
+        """
+        Size the MapReduce tasks of the jobs submitted from this unit, as
+        published by the ResourceManager (see :meth:`configure_cluster_sizing`).
+
+        The task sizes can be overridden via the charm config.
+
+        :param dict sizing: The ``map_mb``, ``reduce_mb``, and ``am_mb`` of the
+            tasks (default: as last configured)
+        :param int nodes: Number of NodeManagers in the cluster, for
+            :meth:`configure_mapreduce_tuning` (default: :meth:`cluster_size`)
+        :returns: The dict of sizes, or None if they are not known yet
+        """
+        if sizing is None:
+            sizing = unitdata.kv().get('yarn.job.sizing')
+        if not sizing:
+            return None
+        cfg = self.hadoop_base.charm_config
+        sizing = dict(sizing)
+        overrides = {
+            'map_mb': 'mapreduce_map_memory_mb',
+            'reduce_mb': 'mapreduce_reduce_memory_mb',
+            'am_mb': 'yarn_app_mapreduce_am_resource_mb',
+        }
+        for key, option in overrides.items():
+            if cfg.get(option):
+                sizing[key] = int(cfg[option])
+        mapred_site = self.hadoop_base.dist_config.path('hadoop_conf') / 'mapred-site.xml'
+        with utils.xmlpropmap_edit_in_place(mapred_site) as props:
+            # leave 20% of each container for non-heap JVM memory
+            props['mapreduce.map.memory.mb'] = sizing['map_mb']
+            props['mapreduce.map.java.opts'] = '-Xmx{}m'.format(int(sizing['map_mb'] * 0.8))
+            props['mapreduce.reduce.memory.mb'] = sizing['reduce_mb']
+            props['mapreduce.reduce.java.opts'] = '-Xmx{}m'.format(int(sizing['reduce_mb'] * 0.8))
+            props['yarn.app.mapreduce.am.resource.mb'] = sizing['am_mb']
+            props['yarn.app.mapreduce.am.command-opts'] = '-Xmx{}m'.format(int(sizing['am_mb'] * 0.8))
+        unitdata.kv().set('yarn.job.sizing', sizing)
+        unitdata.kv().flush(True)
+        self.configure_mapreduce_tuning(nodes)
+        return sizing
+
+    def _remote_cluster(self, relation):
+        """
+        Return the MapReduce task sizes and the number of NodeManagers, as
+        published by the ResourceManager on the given relation.
+        """
+        # FIXME delete when transition to layers is complete
+        unit, data = helpers.any_ready_unit(relation)
+        if not unit:
+            return None, None
+        job_sizing = json.loads(data['job-sizing']) if data.get('job-sizing') else None
+        nodes = int(data['nodemanagers']) if data.get('nodemanagers') else None
+        return job_sizing, nodes
+
+    def cluster_size(self):
+        """
+        Return the number of NodeManagers in the cluster, as known to this
+        unit, from the slaves file on the ResourceManager, or as last
+        recorded otherwise (e.g., as published to clients by the
+        ResourceManager).
+        """
+        slaves_file = self.hadoop_base.dist_config.path('hadoop_conf') / 'slaves'
+        if slaves_file.exists():
+            nodes = len(utils.read_hosts_file(slaves_file))
+            if nodes:
+                return nodes
+        return unitdata.kv().get('yarn.cluster.nodes', 1)
+
+    def configure_mapreduce_tuning(self, nodes=None):
+        """
+        Tune the MapReduce sort, spill, and shuffle settings to the task
+        container sizes and the number of nodes in the cluster.
+
+        Any of the computed properties can be overridden via the
+        ``mapreduce_tuning_overrides`` charm config option, given as a YAML
+        mapping of property names to values.  If it is invalid, the unit is
+        set to blocked and ``mapred-site.xml`` is left unchanged.
+
+        :param int nodes: Number of NodeManagers (default: :meth:`cluster_size`)
+        :returns: The properties set, or None if none were
+        """
+        dc = self.hadoop_base.dist_config
+        cfg = self.hadoop_base.charm_config
+        if nodes is None:
+            nodes = self.cluster_size()
+        unitdata.kv().set('yarn.cluster.nodes', nodes)
+        unitdata.kv().flush(True)
+        sizing = unitdata.kv().get('yarn.job.sizing')
+        if not sizing:
+            return  # the task sizes are not known yet
+        try:
+            overrides = yaml.safe_load(cfg.get('mapreduce_tuning_overrides') or '') or {}
+        except yaml.YAMLError as e:
+            hookenv.status_set('blocked', 'Invalid mapreduce_tuning_overrides: {}'.format(e))
+            return
+        if not isinstance(overrides, dict) or not all(
+                isinstance(key, utils.string_types) and isinstance(value, utils.string_types + (bool, int, float))
+                for key, value in overrides.items()):
+            hookenv.status_set('blocked', 'Invalid mapreduce_tuning_overrides: '
+                                          'must map property names to single values')
+            return
+        tuning = utils.mapreduce_tuning(sizing['map_mb'], sizing['reduce_mb'], sizing['am_mb'], nodes)
+        tuning.update(overrides)
+        mapred_site = dc.path('hadoop_conf') / 'mapred-site.xml'
+        with utils.xmlpropmap_edit_in_place(mapred_site) as props:
+            props.update(tuning)
+        return tuning
 
     def install_demo(self):
         if unitdata.kv().get('yarn.client.demo.installed'):
@@ -540,15 +2137,86 @@ class YARN(object):
         unitdata.kv().set('yarn.client.demo.installed', True)
         unitdata.kv().flush(True)
 
-    def register_slaves(self, slaves=None):
+    def register_slaves(self, slaves=None, racks=None):
+        """
+        Register the NodeManagers with the ResourceManager.
+
+        If the membership changed, the ResourceManager is refreshed once, at
+        the end of the hook, no matter how many times this is called.
+
+        :param list slaves: Hostnames of all of the NodeManagers
+        :param dict racks: Mapping of hostnames and IPs to racks, for rack awareness
+        :returns: A :class:`~jujubigdata.utils.HostsDelta` of the NodeManagers
+            that were added and removed
+        """
         if not slaves:  # FIXME hack-around until transition to layers is complete
-            slaves = helpers.all_ready_units('nodemanager')
-            slaves = [data['hostname'] for slave, data in slaves]
-        self.hadoop_base.register_slaves(slaves)
+            units = helpers.all_ready_units('nodemanager')
+            slaves = [data['hostname'] for slave, data in units]
+            racks = racks or self.hadoop_base._slave_racks(units)
+        delta = self.hadoop_base.register_slaves(slaves)
+        self.hadoop_base.register_topology(racks, 'nodemanager')
+        if helpers:  # FIXME hack-around until transition to layers is complete
+            # NodeManagers may publish their sizes after joining
+            self.configure_cluster_sizing()
+        if delta.added or delta.removed:
+            utils.defer_once('yarn.refresh_nodes', self.refresh_nodes)
+            self.configure_mapreduce_tuning(nodes=len(set(slaves)))
+        return delta
+
+    def refresh_nodes(self):
         if utils.jps('ResourceManager'):
             self.hadoop_base.run('mapred', 'bin/yarn', 'rmadmin', '-refreshNodes')
 
+    def decommission_nodemanagers(self, hosts):
+        """
+        Decommission the given NodeManagers, via the excludes file, so that no
+        new containers are scheduled on them.
+
+        :param list hosts: Hostnames of the NodeManagers to decommission
+        """
+        delta = self.hadoop_base.exclude_hosts('yarn.exclude', add=hosts)
+        if delta.added:
+            self.refresh_nodes()
+        return delta
+
+    def recommission_nodemanagers(self, hosts):
+        """
+        Return previously decommissioned NodeManagers to service.
+
+        :param list hosts: Hostnames of the NodeManagers to recommission
+        """
+        delta = self.hadoop_base.exclude_hosts('yarn.exclude', remove=hosts)
+        if delta.removed:
+            self.refresh_nodes()
+        return delta
+
+    def decommission_status(self, hosts=None):
+        """
+        Report the state of NodeManagers, as seen by the ResourceManager.
+
+        Returns a mapping of each host to its state (e.g., ``RUNNING``,
+        ``DECOMMISSIONING``, ``DECOMMISSIONED``, or ``LOST``), or ``unknown``
+        for hosts the ResourceManager doesn't list, as for
+        :meth:`HDFS.decommission_status`.
+
+        :param list hosts: Hosts to report on (default: all excluded NodeManagers)
+        """
+        dc = self.hadoop_base.dist_config
+        data = utils.read_json('http://localhost:{}/ws/v1/cluster/nodes?states=ALL'.format(
+            dc.port('rm_webapp_http')))
+        nodes = {node['nodeHostName']: node['state']
+                 for node in (data.get('nodes') or {}).get('node', [])}
+        if hosts is None:
+            hosts = utils.read_hosts_file(dc.path('hadoop_conf') / 'yarn.exclude')
+        return {host: nodes.get(host, 'unknown') for host in hosts}
+
     def _yarn_daemon(self, command, service):
+        if self.hadoop_base.service_backend() == 'systemd':
+            port = {
+                'resourcemanager': self.hadoop_base.dist_config.port('resourcemanager'),
+            }.get(service)
+            self.hadoop_base.systemd_daemon(command, service, 'yarn', 'bin/yarn', port)
+            return
         self.hadoop_base.run('yarn', 'sbin/yarn-daemon.sh',
                              '--config',
                              self.hadoop_base.dist_config.path('hadoop_conf'),
@@ -556,7 +2224,129 @@ class YARN(object):
 
     def _jobhistory_daemon(self, command, service):
         # TODO refactor job history to separate class
+        if self.hadoop_base.service_backend() == 'systemd':
+            port = self.hadoop_base.dist_config.port('jobhistory')
+            self.hadoop_base.systemd_daemon(command, service, 'mapred', 'bin/mapred', port)
+            return
         self.hadoop_base.run('mapred', 'sbin/mr-jobhistory-daemon.sh',
                              '--config',
                              self.hadoop_base.dist_config.path('hadoop_conf'),
                              command, service)
+
+
+class Lifecycle(object):
+    """
+    Start, stop, and restart the Hadoop daemons of a unit in the order
+    required by the dependencies between their roles.
+
+    Independent daemons are started concurrently, and dependent ones are
+    only started once the daemons they depend on pass their readiness probes
+    (e.g., the JobHistoryServer once HDFS is out of safe mode), rather than
+    after fixed sleeps.
+
+    Example usage::
+
+        lifecycle = Lifecycle(HDFS(hadoop_base), YARN(hadoop_base))
+        lifecycle.start(['namenode', 'secondarynamenode', 'resourcemanager', 'historyserver'])
+
+    :param HDFS hdfs: HDFS handler, for the HDFS roles
+    :param YARN yarn: YARN handler, for the YARN roles
+    :param int timeout: Seconds to wait for each role to become ready
+    """
+    def __init__(self, hdfs=None, yarn=None, timeout=300):
+        self.timeout = timeout
+        # role: (start, stop, readiness probe, dependencies); roles without a
+        # start are gates, which only wait for a cluster-wide condition
+        self.roles = {}
+        if hdfs:
+            self.roles.update({
+                'namenode': (hdfs.start_namenode, hdfs.stop_namenode, hdfs.namenode_ready, []),
+                'secondarynamenode': (hdfs.start_secondarynamenode, hdfs.stop_secondarynamenode,
+                                      hdfs.secondarynamenode_ready, ['namenode']),
+                'datanode': (hdfs.start_datanode, hdfs.stop_datanode, hdfs.datanode_ready, []),
+                'hdfs-writable': (None, None, hdfs.hdfs_writable, ['namenode', 'datanode']),
+            })
+        if yarn:
+            self.roles.update({
+                'resourcemanager': (yarn.start_resourcemanager, yarn.stop_resourcemanager,
+                                    yarn.resourcemanager_ready, []),
+                'nodemanager': (yarn.start_nodemanager, yarn.stop_nodemanager,
+                                yarn.nodemanager_ready, ['resourcemanager']),
+                'historyserver': (yarn.start_jobhistory, yarn.stop_jobhistory,
+                                  yarn.jobhistory_ready, ['hdfs-writable'] if hdfs else []),
+            })
+
+    def _graph(self, roles):
+        """
+        Return the dependencies of each of the given roles, limited to the
+        given roles and any gates they need.
+        """
+        unknown = set(roles) - set(self.roles)
+        if unknown:
+            raise ValueError('Unknown role{}: {}'.format(
+                's' if len(unknown) > 1 else '', ', '.join(sorted(unknown))))
+        graph = {}
+        pending = list(roles)
+        while pending:
+            role = pending.pop()
+            if role in graph:
+                continue
+            deps = [dep for dep in self.roles[role][3]
+                    if dep in roles or self.roles[dep][0] is None]
+            pending.extend(deps)
+            graph[role] = deps
+        return graph
+
+    def _start(self, role):
+        start, stop, ready, deps = self.roles[role]
+        if start:
+            start(wait=False)
+        utils.wait_for(ready, self.timeout, role)
+
+    def _restart(self, role):
+        start, stop, ready, deps = self.roles[role]
+        if start:
+            stop()
+            start(wait=False)
+        utils.wait_for(ready, self.timeout, role)
+
+    def start(self, roles):
+        """
+        Start the daemons for the given roles, concurrently where possible,
+        and wait for them to be ready.
+
+        :returns: A dict mapping each role (and gate) to the seconds it took
+        """
+        graph = self._graph(roles)
+        return utils.run_steps({
+            role: (functools.partial(self._start, role), deps)
+            for role, deps in graph.items()
+        }, kv_prefix=None, workers=max(1, len(graph)))
+
+    def stop(self, roles):
+        """
+        Stop the daemons for the given roles in the reverse of the order
+        :meth:`start` would start them: each after all of those depending on
+        it, including through gates (e.g., the NameNode after the
+        JobHistoryServer, which waits for HDFS to be writable).
+        """
+        graph = self._graph(roles)
+        return utils.run_steps({
+            # gates have nothing to stop, but keep their place in the order
+            role: (self.roles[role][1] or (lambda: None),
+                   [other for other, deps in graph.items() if role in deps])
+            for role in graph
+        }, kv_prefix=None, workers=max(1, len(graph)))
+
+    def rolling_restart(self, roles):
+        """
+        Restart the daemons for the given roles one at a time, in dependency
+        order, waiting for each to be ready again before moving on.
+
+        :returns: A dict mapping each role (and gate) to the seconds it took
+        """
+        graph = self._graph(roles)
+        return utils.run_steps({
+            role: (functools.partial(self._restart, role), deps)
+            for role, deps in graph.items()
+        }, kv_prefix=None, workers=1)
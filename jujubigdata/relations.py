@@ -14,6 +14,7 @@ import pwd
 import json
 
 from charmhelpers.core import hookenv
+from charmhelpers.core import unitdata
 from charmhelpers.core.charmframework.helpers import Relation, any_ready_unit
 
 from jujubigdata import utils
@@ -69,8 +70,19 @@ class SpecMatchingRelation(Relation):
         data = super(SpecMatchingRelation, self).provide(remote_service, all_ready)
         if self.spec:
             data['spec'] = json.dumps(self.spec)
+        resources_url = utils.resource_server_url()
+        if resources_url:
+            data['resources-url'] = resources_url
         return data
 
+    def register_resource_peers(self):
+        """
+        Record the URLs at which related units with a matching spec (and thus
+        the same resources) are serving their resources.
+        """
+        for unit, data in self.filtered_data().items():
+            utils.update_resource_peer(unit, data.get('resources-url'))
+
     def filtered_data(self, remote_service=None):
         if self.spec and 'spec' not in self.required_keys:
             self.required_keys.append('spec')
@@ -167,9 +179,10 @@ class NameNode(SpecMatchingRelation, EtcHostsRelation):
     required_keys = ['private-address', 'has_slave', 'port', 'webhdfs-port']
     require_slave = True
 
-    def __init__(self, spec=None, port=None, webhdfs_port=None, *args, **kwargs):
+    def __init__(self, spec=None, port=None, webhdfs_port=None, servicerpc_port=None, *args, **kwargs):
         self.port = port  # only needed for provides
         self.webhdfs_port = webhdfs_port  # only needed for provides
+        self.servicerpc_port = servicerpc_port  # only needed for provides
         utils.initialize_kv_host()
         super(NameNode, self).__init__(spec, *args, **kwargs)
 
@@ -181,6 +194,9 @@ class NameNode(SpecMatchingRelation, EtcHostsRelation):
                 'port': self.port,
                 'webhdfs-port': self.webhdfs_port,
             })
+            if self.servicerpc_port:
+                # DataNodes talk to the NameNode on the service RPC port, if any
+                data['servicerpc-port'] = self.servicerpc_port
         return data
 
     def has_slave(self):
@@ -209,6 +225,12 @@ class NameNodeMaster(NameNode, SSHRelation):
     ssh_user = 'hdfs'
     require_slave = False
 
+    def provide(self, remote_service, all_ready):
+        data = super(NameNodeMaster, self).provide(remote_service, all_ready)
+        # the slaves which may restart now, for rolling restarts
+        data['restart-tokens'] = json.dumps(unitdata.kv().get('hdfs.restart.tokens') or [])
+        return data
+
 
 class ResourceManager(SpecMatchingRelation, EtcHostsRelation):
     """
@@ -237,6 +259,10 @@ class ResourceManager(SpecMatchingRelation, EtcHostsRelation):
                 'port': self.port,
                 'historyserver-http': self.historyserver_http,
                 'historyserver-ipc': self.historyserver_ipc,
+                # the MapReduce task sizes which fit the NodeManagers, and how
+                # many there are, for tuning the jobs submitted by clients
+                'job-sizing': json.dumps(unitdata.kv().get('yarn.job.sizing')),
+                'nodemanagers': unitdata.kv().get('yarn.cluster.nodes') or '',
             })
         return data
 
@@ -265,6 +291,12 @@ class ResourceManagerMaster(ResourceManager, SSHRelation):
     ssh_user = 'yarn'
     require_slave = False
 
+    def provide(self, remote_service, all_ready):
+        data = super(ResourceManagerMaster, self).provide(remote_service, all_ready)
+        # the slaves which may restart now, for rolling restarts
+        data['restart-tokens'] = json.dumps(unitdata.kv().get('yarn.restart.tokens') or [])
+        return data
+
 
 class DataNode(SpecMatchingRelation):
     """
@@ -278,6 +310,9 @@ class DataNode(SpecMatchingRelation):
         hostname = hookenv.local_unit().replace('/', '-')
         data.update({
             'hostname': hostname,
+            'rack': utils.get_rack(),
+            'restart-request': unitdata.kv().get('hdfs.datanode.restart.request') or '',
+            'restart-done': unitdata.kv().get('hdfs.datanode.restart.done') or '',
         })
         return data
 
@@ -315,6 +350,16 @@ class NodeManager(Relation):
         hostname = hookenv.local_unit().replace('/', '-')
         data.update({
             'hostname': hostname,
+            'rack': utils.get_rack(),
+            'restart-request': unitdata.kv().get('yarn.nodemanager.restart.request') or '',
+            'restart-done': unitdata.kv().get('yarn.nodemanager.restart.done') or '',
+        })
+        # the ResourceManager sizes the scheduler and the jobs' tasks from these
+        sizing = unitdata.kv().get('yarn.container.sizing') or {}
+        data.update({
+            'nodemanager-memory-mb': sizing.get('nodemanager_mb', ''),
+            'container-memory-mb': sizing.get('container_mb', ''),
+            'nodemanager-vcores': sizing.get('nodemanager_vcores', ''),
         })
         return data
 
@@ -356,10 +401,14 @@ class HadoopPlugin(Relation):
         if hdfs_ready:
             # make sure we can actually reach HDFS
             utils.wait_for_hdfs(300)  # will error if timeout
-        return {
+        data = {
             'hdfs-ready': utils.normalize_strbool(hdfs_ready),
             'yarn-ready': utils.normalize_strbool(yarn_ready),
         }
+        socket = unitdata.kv().get('hdfs.short_circuit.socket')
+        if socket:
+            data['dfs-domain-socket-path'] = socket
+        return data
 
     def is_ready(self):
         if not super(HadoopPlugin, self).is_ready():
@@ -382,6 +431,22 @@ class HadoopPlugin(Relation):
         """
         return self.is_ready()
 
+    def hdfs_client_config(self):
+        """
+        Return the hdfs-site properties the endpoint asks its clients to use,
+        such as those enabling short-circuit local reads.
+        """
+        if not super(HadoopPlugin, self).is_ready():
+            return {}
+        data = self.filtered_data().values()[0]
+        socket = data.get('dfs-domain-socket-path')
+        if not socket:
+            return {}
+        return {
+            'dfs.client.read.shortcircuit': 'true',
+            'dfs.domain.socket.path': socket,
+        }
+
 
 class HadoopREST(Relation):
     """
@@ -612,9 +677,35 @@ class Zookeeper(Relation):
 class Ganglia(Relation):
     relation_name = 'ganglia'
     required_keys = ['private-address']
+    default_port = 8649
 
     def host(self):
         if not self.is_ready():
             return None
         dict = self.filtered_data().values()[0]
         return dict['private-address']
+
+    def port(self):
+        if not self.is_ready():
+            return None
+        dict = list(self.filtered_data().values())[0]
+        return int(dict.get('port') or self.default_port)
+
+    def metrics_sink(self):
+        """
+        Return the ``{sink type: (host, port)}`` of the collector, for
+        :meth:`~jujubigdata.handlers.HadoopBase.configure_metrics`.
+        """
+        if not self.is_ready():
+            return {}
+        return {self.relation_name: (self.host(), self.port())}
+
+
+class Graphite(Ganglia):
+    relation_name = 'graphite'
+    default_port = 2003
+
+
+class StatsD(Ganglia):
+    relation_name = 'statsd'
+    default_port = 8125
@@ -12,17 +12,45 @@
 
 import os
 import re
+import sys
+import math
+import json
 import time
 import yaml
+import random
 import socket
+import hashlib
+import tarfile
+import multiprocessing
+import traceback
 import subprocess
-from contextlib import contextmanager
+from collections import namedtuple
+from contextlib import contextmanager, closing
 from subprocess import check_call, check_output, CalledProcessError
 from xml.etree import ElementTree as ET
 from xml.dom import minidom
+from distutils.spawn import find_executable
 from distutils.util import strtobool as _strtobool
+from multiprocessing.pool import ThreadPool
 from path import Path
-from tempfile import NamedTemporaryFile
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
+
+try:
+    from queue import Queue, Empty
+except ImportError:
+    from Queue import Queue, Empty
+
+try:
+    from urllib.request import urlopen
+    from urllib.parse import urlparse, urljoin
+except ImportError:
+    from urllib2 import urlopen
+    from urlparse import urlparse, urljoin
+
+try:
+    string_types = (basestring,)
+except NameError:
+    string_types = (str,)
 
 from charmhelpers.core import unitdata
 from charmhelpers.core import hookenv
@@ -195,6 +223,33 @@ def re_edit_in_place(filename, subs):
             writer.write(line)
 
 
+def managed_block_edit(filename, name, lines):
+    """
+    Replace, or append, a block of lines in a file, delimited by marker
+    comments, leaving the rest of the file untouched.  Applying the same
+    lines again leaves the file unchanged.
+
+    :param str filename: Name of file to edit
+    :param str name: Name of the block, used in the marker comments
+    :param list lines: Lines of the block (an empty list removes the block)
+    :returns: True if the file was changed
+    """
+    begin = '# BEGIN juju managed: {}'.format(name)
+    end = '# END juju managed: {}'.format(name)
+    path = Path(filename)
+    content = path.lines(retain=False) if path.exists() else []
+    start = stop = len(content)
+    if begin in content:
+        start = content.index(begin)
+        stop = content.index(end, start) + 1 if end in content[start:] else len(content)
+    block = [begin] + list(lines) + [end] if lines else []
+    new_content = content[:start] + block + content[stop:]
+    if new_content == content:
+        return False
+    path.write_lines(new_content)
+    return True
+
+
 @contextmanager
 def xmlpropmap_edit_in_place(filename):
     """
@@ -251,6 +306,98 @@ def xmlpropmap_edit_in_place(filename):
     Path(filename).write_text(prettied)
 
 
+def read_xmlpropmap(filename):
+    """
+    Read the name/value mappings from an XML property map (configuration) file.
+
+    See :func:`xmlpropmap_edit_in_place` for the file format.
+    """
+    root = ET.parse(filename).getroot()
+    return {prop.find('name').text: prop.find('value').text
+            for prop in root.findall('property')}
+
+
+def _file_hash(filename, hash_type='sha1'):
+    digest = hashlib.new(hash_type)
+    with open(filename, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(64 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _same_file(a, b):
+    a, b = Path(a), Path(b)
+    if not (a.isfile() and b.isfile()) or a.size != b.size:
+        return False
+    return a.mtime == b.mtime or _file_hash(a) == _file_hash(b)
+
+
+def sync_config_dir(source, destination, baseline=None, exclude=None):
+    """
+    Incrementally sync a directory of default config files into a managed
+    config directory, preserving any changes that have been made to it.
+
+    A copy of the source files from the previous sync is kept as a baseline.
+    Files whose source is unchanged since then (by size and mtime or hash) are
+    left alone.  Otherwise, changed XML property maps are three-way merged:
+    properties which were changed locally are kept, and all others are updated
+    to the new defaults.  Other changed files are replaced with the new
+    defaults, so any local edits to those must be re-applied.
+
+    :param str source: Directory containing the default config files
+    :param str destination: Managed config directory
+    :param str baseline: Directory in which to keep the baseline copy
+        (default: ``.<name>.orig`` alongside ``destination``)
+    :param list exclude: Relative paths of files which should not be synced
+    :returns: A dict with the number of files ``copied``, ``merged``,
+        ``unchanged``, and ``removed``
+    """
+    source = Path(source)
+    destination = Path(destination)
+    baseline = Path(baseline or destination.parent / ('.%s.orig' % destination.name))
+    exclude = set(exclude or [])
+    stats = {'copied': 0, 'merged': 0, 'unchanged': 0, 'removed': 0}
+    source_files = set(f.relpath(source) for f in source.walkfiles()) - exclude
+    baseline_files = set(f.relpath(baseline) for f in baseline.walkfiles()) if baseline.exists() else set()
+
+    for relpath in sorted(source_files):
+        src, dst, base = source / relpath, destination / relpath, baseline / relpath
+        if dst.exists() and _same_file(src, base):
+            stats['unchanged'] += 1
+        elif dst.exists() and relpath.endswith('.xml'):
+            base_props = read_xmlpropmap(base) if base.exists() else {}
+            their_props = read_xmlpropmap(src)
+            with xmlpropmap_edit_in_place(dst) as props:
+                for name in set(base_props) | set(their_props):
+                    if name in props and props[name] != base_props.get(name):
+                        continue  # changed locally; keep it
+                    if name in base_props and name not in props:
+                        continue  # removed locally; keep it removed
+                    if name in their_props:
+                        props[name] = their_props[name] or ''
+                    else:
+                        del props[name]
+            stats['merged'] += 1
+        elif dst.exists() and not base.exists() and _same_file(src, dst):
+            stats['unchanged'] += 1
+        else:
+            dst.parent.makedirs_p()
+            src.copy2(dst)
+            stats['copied'] += 1
+        base.parent.makedirs_p()
+        src.copy2(base)
+
+    for relpath in sorted(baseline_files - source_files):
+        dst, base = destination / relpath, baseline / relpath
+        if relpath not in exclude and dst.exists() and _same_file(dst, base):
+            dst.remove()
+            stats['removed'] += 1
+        base.remove()
+    hookenv.log('Synced {} into {}: {copied} copied, {merged} merged, {unchanged} unchanged, '
+                '{removed} removed'.format(source, destination, **stats))
+    return stats
+
+
 @contextmanager
 def environment_edit_in_place(filename='/etc/environment'):
     """
@@ -296,6 +443,139 @@ class TimeoutError(Exception):
     pass
 
 
+_deferred = set()
+
+
+def defer_once(key, callback, *args, **kwargs):
+    """
+    Schedule a callback to run once, when the current hook exits.
+
+    Requesting the same ``key`` again before the hook exits is a no-op, which
+    allows multiple events within a single hook (e.g., several slaves joining)
+    to be coalesced into a single (potentially expensive) action.
+
+    Callbacks are run by :func:`charmhelpers.core.hookenv.atexit`, in the
+    reverse order that they were scheduled.  If a callback fails, the error
+    is logged and re-raised, so that the hook fails.
+
+    :param str key: Identifies the action being deferred
+    :param callback: Function to call, with any remaining args
+    :returns: True if the callback was scheduled, False if it already was
+    """
+    if key in _deferred:
+        return False
+    _deferred.add(key)
+
+    def _run():
+        _deferred.discard(key)
+        try:
+            callback(*args, **kwargs)
+        except Exception as e:
+            hookenv.log('Deferred action {} failed: {}'.format(key, e), hookenv.ERROR)
+            raise
+    hookenv.atexit(_run)
+    return True
+
+
+def run_steps(steps, kv_prefix=None, force=False, workers=4, timeout=3600):
+    """
+    Run a dependency graph of named steps, running independent steps
+    concurrently in a pool of threads.
+
+    Each step is a callable which may return a dict of values to be stored
+    in :func:`unitdata.kv` once it completes.  (The kv store may only be used
+    from the thread which created it, so the steps themselves must not use it.)
+
+    If ``kv_prefix`` is given, the duration of each completed step is recorded
+    under ``<kv_prefix><name>``, and steps which have already been recorded
+    are skipped on subsequent runs, unless ``force`` is set.
+
+    If any step fails, no further steps are started and, once the running
+    steps have finished, the first error is re-raised.  If no step finishes
+    within ``timeout`` seconds, :class:`TimeoutError` is raised without
+    waiting for the hung steps.
+
+    Example usage::
+
+        run_steps({
+            'users': (add_users, []),
+            'dirs': (add_dirs, ['users']),
+            'packages': (add_packages, []),
+        }, kv_prefix='charm.install.')
+
+    :param dict steps: Mapping of step names to ``(callable, [dependencies])``
+    :param str kv_prefix: Prefix under which to record completed steps
+    :param bool force: Run all steps, even if they were previously completed
+    :param int workers: Maximum number of steps to run concurrently
+    :param int timeout: Seconds to wait for a running step to finish
+    :returns: A dict mapping the name of each step that was run to its duration
+    """
+    for name, (func, deps) in steps.items():
+        unknown = set(deps) - set(steps)
+        if unknown:
+            raise ValueError('Step {} depends on unknown step{}: {}'.format(
+                name, 's' if len(unknown) > 1 else '', ', '.join(sorted(unknown))))
+    kv = unitdata.kv()
+    done = set()
+    if kv_prefix and not force:
+        done = set(name for name in steps if kv.get(kv_prefix + name) is not None)
+    running = set()
+    durations = {}
+    errors = []
+    results = Queue()
+
+    def _run(name, func):
+        start = time.time()
+        try:
+            values = func()
+        except BaseException as e:
+            hookenv.log('Step {} failed:\n{}'.format(name, traceback.format_exc()), hookenv.ERROR)
+            results.put((name, time.time() - start, None, e))
+        else:
+            results.put((name, time.time() - start, values, None))
+
+    pool = ThreadPool(workers)
+    hung = False
+    try:
+        while len(done) < len(steps):
+            for name in sorted(steps):
+                func, deps = steps[name]
+                if errors or name in done or name in running or not set(deps) <= done:
+                    continue
+                running.add(name)
+                pool.apply_async(_run, (name, func))
+            if not running:
+                if errors:
+                    break
+                raise ValueError('Circular dependency between steps: {}'.format(
+                    ', '.join(sorted(set(steps) - done))))
+            try:
+                name, duration, values, error = results.get(timeout=timeout)
+            except Empty:
+                hung = True
+                raise TimeoutError('Timed-out waiting for step{}: {}'.format(
+                    's' if len(running) > 1 else '', ', '.join(sorted(running))))
+            running.discard(name)
+            if error:
+                errors.append(error)
+                continue
+            hookenv.log('Step {} completed in {:.1f}s'.format(name, duration))
+            durations[name] = duration
+            if values:
+                kv.update(values)
+            if kv_prefix:
+                kv.set(kv_prefix + name, duration)
+            kv.flush(True)
+            done.add(name)
+    finally:
+        pool.close()
+        if not hung:
+            pool.join()
+    if errors:
+        raise errors[0]
+    return durations
+
+
 def read_etc_env():
     """
     Read /etc/environment and return it, along with proxy configuration, as
@@ -388,6 +668,45 @@ def update_etc_hosts(ips_to_names):
     etc_hosts.write_lines(new_lines, append=False)
 
 
+HostsDelta = namedtuple('HostsDelta', ['added', 'removed'])
+
+
+def read_hosts_file(filename):
+    '''
+    Read the hostnames listed in a Hadoop hosts file (e.g., ``slaves``),
+    ignoring blank lines and comments.
+
+    :param str filename: Hosts file to read (need not exist)
+    '''
+    hosts_file = Path(filename)
+    if not hosts_file.exists():
+        return []
+    lines = [line.strip() for line in hosts_file.lines(retain=False)]
+    return [line for line in lines if line and not line.startswith('#')]
+
+
+def write_hosts_file(filename, hosts, header=None):
+    '''
+    Write a sorted, de-duplicated list of hostnames to a Hadoop hosts file.
+
+    The file is only rewritten if the set of hosts has changed, so that
+    callers can avoid needlessly refreshing the master daemons.
+
+    :param str filename: Hosts file to write
+    :param list hosts: Hostnames that should be listed in the file
+    :param list header: Optional comment lines to write before the hosts
+    :returns: A :class:`HostsDelta` of the hosts added to and removed from the file
+    '''
+    hosts_file = Path(filename)
+    new_hosts = sorted(set(h.strip() for h in hosts if h and h.strip()))
+    old_hosts = set(read_hosts_file(hosts_file))
+    delta = HostsDelta(added=sorted(set(new_hosts) - old_hosts),
+                       removed=sorted(old_hosts - set(new_hosts)))
+    if delta.added or delta.removed or not hosts_file.exists():
+        hosts_file.write_lines(list(header or []) + new_hosts)
+    return delta
+
+
 def manage_etc_hosts():
     """
     Manage the /etc/hosts file from the host entries stored in unitdata.kv()
@@ -478,6 +797,36 @@ def wait_for_hdfs(timeout):
     raise TimeoutError('Timed-out waiting for HDFS:\n%s' % output)
 
 
+def port_open(host, port, timeout=2):
+    """
+    Check whether a TCP port is accepting connections.
+    """
+    try:
+        with closing(socket.create_connection((host, int(port)), timeout)):
+            return True
+    except (socket.error, socket.timeout):
+        return False
+
+
+def wait_for(probe, timeout, description, interval=2):
+    """
+    Wait for a readiness probe to return a true value.
+
+    :param callable probe: Probe to call until it returns a true value
+    :param int timeout: Seconds to wait before giving up
+    :param str description: Description of what is being waited for
+    :raises TimeoutError: if the probe did not succeed within ``timeout``
+    """
+    hookenv.log('Waiting for %s' % description, hookenv.DEBUG)
+    start = time.time()
+    while time.time() - start < timeout:
+        if probe():
+            hookenv.log('%s is ready after %.1fs' % (description, time.time() - start), hookenv.DEBUG)
+            return True
+        time.sleep(interval)
+    raise TimeoutError('Timed-out waiting for %s' % description)
+
+
 def wait_for_jps(process_name, timeout):
     hookenv.log('Waiting for jps to see %s' % process_name, hookenv.DEBUG)
     start = time.time()
@@ -489,6 +838,906 @@ def wait_for_jps(process_name, timeout):
     raise TimeoutError('Timed-out waiting for jps process:\n%s' % process_name)
 
 
+def read_json(url, timeout=30):
+    """
+    Fetch and decode a JSON document, such as from one of the Hadoop REST APIs.
+    """
+    with closing(urlopen(url, timeout=timeout)) as fp:
+        return json.loads(fp.read().decode('utf8'))
+
+
+def read_jmx(host, port, query):
+    """
+    Read the attributes of a JMX bean from the ``/jmx`` servlet of a Hadoop
+    daemon's web UI.
+
+    :param str host: Host of the daemon
+    :param int port: Web UI port of the daemon
+    :param str query: Bean to query, e.g. ``Hadoop:service=NameNode,name=NameNodeInfo``
+    :returns: dict of the bean's attributes, or an empty dict if it was not found
+    """
+    data = read_json('http://{}:{}/jmx?qry={}'.format(host, port, query))
+    beans = data.get('beans') or [{}]
+    return beans[0]
+
+
+def parse_datanode_states(info):
+    """
+    Parse the DataNodes' states from the NameNode's ``NameNodeInfo`` JMX bean
+    (see :func:`read_jmx`).
+
+    :param dict info: Attributes of the bean, whose ``LiveNodes``, ``DeadNodes``,
+        and ``DecomNodes`` are JSON-encoded mappings of ``host:port`` to node info
+    :returns: A mapping of each hostname to a dict containing its ``state`` (one
+        of ``in-service``, ``decommissioning``, ``decommissioned``, or ``dead``)
+        and the number of ``under_replicated_blocks`` left to drain
+    """
+    states = {
+        'In Service': 'in-service',
+        'Decommission In Progress': 'decommissioning',
+        'Decommissioned': 'decommissioned',
+    }
+    nodes = {}
+    for name, node in json.loads(info.get('DeadNodes') or '{}').items():
+        nodes[name.split(':')[0]] = {
+            'state': 'decommissioned' if node.get('decommissioned') else 'dead',
+            'under_replicated_blocks': 0,
+        }
+    for name, node in json.loads(info.get('LiveNodes') or '{}').items():
+        nodes[name.split(':')[0]] = {
+            'state': states.get(node.get('adminState'), 'in-service'),
+            'under_replicated_blocks': 0,
+        }
+    for name, node in json.loads(info.get('DecomNodes') or '{}').items():
+        hostname = name.split(':')[0]
+        if hostname in nodes:
+            nodes[hostname]['under_replicated_blocks'] = node.get('underReplicatedBlocks', 0)
+    return nodes
+
+
+def parse_balancer_output(lines):
+    """
+    Parse the progress of a balancer run from its output.
+
+    :param list lines: Lines of the balancer's ``.out`` file
+    :returns: A dict containing the ``iteration`` number, the amount of data
+        ``moved``, ``left`` to move, and ``being_moved`` (e.g., ``1.5 GB``),
+        and the last ``message`` printed (e.g., ``The cluster is balanced.
+        Exiting...``); each is None if not yet reported
+    """
+    status = {
+        'iteration': None,
+        'moved': None,
+        'left': None,
+        'being_moved': None,
+        'message': None,
+    }
+    progress_pat = re.compile(r'^.+?\s+(\d+)\s+([\d.]+ [KMGTPE]?B)\s+([\d.]+ [KMGTPE]?B)'
+                              r'\s+([\d.]+ [KMGTPE]?B)\s*$')
+    for line in lines:
+        match = progress_pat.match(line)
+        if match:
+            iteration, moved, left, being_moved = match.groups()
+            status.update({
+                'iteration': int(iteration),
+                'moved': moved,
+                'left': left,
+                'being_moved': being_moved,
+            })
+        elif line.strip() and not line.startswith(('Time Stamp', 'ulimit')):
+            status['message'] = line.strip()
+    return status
+
+
+# Multi-threaded decompressors (in order of preference), by magic number
+_DECOMPRESSORS = [
+    (b'\x1f\x8b', [['pigz', '-dc']]),
+    (b'BZh', [['pbzip2', '-dc'], ['lbzip2', '-dc']]),
+    (b'\xfd7zXZ\x00', [['pixz', '-d', '-i'], ['xz', '-dc', '-T0']]),
+]
+
+
+def _find_decompressor(archive):
+    with open(archive, 'rb') as fp:
+        magic = fp.read(6)
+    for prefix, commands in _DECOMPRESSORS:
+        if magic.startswith(prefix):
+            for command in commands:
+                if find_executable(command[0]):
+                    return command
+    return None
+
+
+def _extract_file(tf, member, target, entry):
+    """
+    Extract a file from a tar stream, only replacing the target if its
+    contents differ from its manifest entry.
+    """
+    digest = hashlib.sha1()
+    with SpooledTemporaryFile(max_size=32 * 1024 * 1024) as spool:
+        source = tf.extractfile(member)
+        for chunk in iter(lambda: source.read(1024 * 1024), b''):
+            digest.update(chunk)
+            spool.write(chunk)
+        new_entry = {'size': member.size, 'hash': digest.hexdigest()}
+        unchanged = (entry == new_entry and target.isfile() and
+                     not target.islink() and target.size == member.size)
+        if not unchanged:
+            spool.seek(0)
+            target.parent.makedirs_p()
+            partial = target.parent / ('.%s.partial' % target.name)
+            with open(partial, 'wb') as fp:
+                for chunk in iter(lambda: spool.read(1024 * 1024), b''):
+                    fp.write(chunk)
+            os.utime(partial, (member.mtime, member.mtime))
+            target.remove_p()
+            partial.rename(target)
+    target.chmod(member.mode)
+    return new_entry, not unchanged
+
+
+def install_archive(archive, destination, skip_top_level=False, manifest=None):
+    """
+    Extract a tar archive into a destination directory, streaming it through
+    a multi-threaded decompressor (``pigz``, ``pbzip2``, ``pixz``, etc) if one
+    is installed.
+
+    A manifest of the path, size, and hash of every extracted file is
+    written, and on subsequent installs (e.g., re-installs or upgrades) only
+    the files which differ from the manifest are written, and any files which
+    are no longer in the archive are removed.
+
+    Members which would be written outside of the destination, including
+    through symbolic or hard links pointing outside of it, are refused with
+    a :class:`ValueError`.
+
+    :param str archive: Path to the archive
+    :param str destination: Directory into which to extract the archive
+    :param bool skip_top_level: Extract the members under the top-level
+        directory of the archive directly into ``destination``
+    :param str manifest: Path of the manifest (default: ``.manifest.json``
+        in ``destination``)
+    :returns: A dict with the number of files ``written``, ``unchanged``, and ``removed``
+    """
+    destination = Path(destination)
+    manifest = Path(manifest or destination / '.manifest.json')
+    old_manifest = json.loads(manifest.text()) if manifest.exists() else {}
+    new_manifest = {}
+    stats = {'written': 0, 'unchanged': 0, 'removed': 0}
+    decompressor = _find_decompressor(archive)
+    if decompressor:
+        hookenv.log('Extracting {} with {}'.format(archive, decompressor[0]))
+        proc = subprocess.Popen(decompressor + [archive], stdout=subprocess.PIPE)
+        tf = tarfile.open(fileobj=proc.stdout, mode='r|')
+    else:
+        proc = None
+        tf = tarfile.open(archive, mode='r|*')
+
+    def member_path(name):
+        path = name[2:] if name.startswith('./') else name
+        if skip_top_level:
+            if re.match(r'^[^/]+/?$', path):
+                return None  # skip top-level members
+            path = re.sub(r'^[^/]+/', '', path)  # strip top-level container
+        path = path.rstrip('/')
+        if not path or path.startswith('/') or '..' in path.split('/'):
+            raise ValueError('Refusing to extract unsafe path from {}: {}'.format(archive, name))
+        return path
+
+    try:
+        for member in tf:
+            path = member_path(member.name)
+            if path is None:
+                continue
+            target = destination / path
+            if member.isdir():
+                target.makedirs_p()
+                target.chmod(member.mode)
+                continue
+            if member.issym():
+                resolved = os.path.normpath(os.path.join(os.path.dirname(path), member.linkname))
+                if os.path.isabs(member.linkname) or resolved == '..' or resolved.startswith('../'):
+                    raise ValueError('Refusing to extract link out of {} from {}: {} -> {}'.format(
+                        destination, archive, member.name, member.linkname))
+                entry = {'link': member.linkname}
+                changed = old_manifest.get(path) != entry or not target.islink()
+                if changed:
+                    target.parent.makedirs_p()
+                    target.remove_p()
+                    os.symlink(member.linkname, target)
+            elif member.islnk():
+                # hard links refer to an earlier member of the archive
+                link_path = member_path(member.linkname)
+                if link_path not in new_manifest or 'link' in new_manifest[link_path]:
+                    raise ValueError('Refusing to extract hard link to unknown file from {}: {} -> {}'.format(
+                        archive, member.name, member.linkname))
+                entry = new_manifest[link_path]
+                changed = old_manifest.get(path) != entry or not target.isfile()
+                if changed:
+                    target.parent.makedirs_p()
+                    target.remove_p()
+                    os.link(destination / link_path, target)
+            elif member.isfile():
+                entry, changed = _extract_file(tf, member, target, old_manifest.get(path))
+            else:
+                hookenv.log('Skipping special file in {}: {}'.format(archive, member.name), hookenv.WARNING)
+                continue
+            new_manifest[path] = entry
+            stats['written' if changed else 'unchanged'] += 1
+    finally:
+        tf.close()
+        if proc:
+            proc.stdout.close()
+            proc.wait()
+    if proc and proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, decompressor + [archive])
+    for path in set(old_manifest) - set(new_manifest):
+        (destination / path).remove_p()
+        stats['removed'] += 1
+    manifest.write_text(json.dumps(new_manifest, indent=0, sort_keys=True))
+    hookenv.log('Installed {} into {}: {written} written, {unchanged} unchanged, {removed} removed'.format(
+        archive, destination, **stats))
+    return stats
+
+
+def get_total_memory_mb():
+    """
+    Get the total physical memory of this machine, in MB, from ``/proc/meminfo``.
+    """
+    for line in Path('/proc/meminfo').lines(retain=False):
+        if line.startswith('MemTotal:'):
+            return int(line.split()[1]) // 1024
+    raise ValueError('Unable to determine total memory from /proc/meminfo')
+
+
+def get_cpu_count():
+    return multiprocessing.cpu_count()
+
+
+# Memory (GB) to reserve for the system and for a co-located HBase,
+# by total memory (GB), per the commonly used YARN sizing guidelines.
+_RESERVED_MEMORY = [
+    (4, 1, 1),
+    (8, 2, 1),
+    (16, 2, 2),
+    (24, 4, 4),
+    (48, 6, 8),
+    (64, 8, 8),
+    (72, 8, 8),
+    (96, 12, 16),
+    (128, 24, 24),
+    (256, 32, 32),
+    (512, 64, 64),
+]
+
+
+def yarn_container_sizing(total_mb, cores, disks=None, reserved_mb=None, hbase=False, datanode=False):
+    """
+    Compute the YARN container and MapReduce task sizes for a node, using the
+    standard reserved memory and container count heuristics.
+
+    The number of containers is the least of twice the number of cores,
+    1.8 times the number of disks, and the number of minimum sized containers
+    which fit in the memory left after the reservations.
+
+    :param int total_mb: Total memory of the node, in MB
+    :param int cores: Number of CPU cores of the node
+    :param int disks: Number of data disks of the node (default: not a constraint)
+    :param int reserved_mb: Memory to reserve for the system and any
+        co-located services (default: based on ``total_mb``)
+    :param bool hbase: Whether to reserve memory for a co-located HBase
+    :param bool datanode: Whether to reserve memory for a co-located DataNode
+    :returns: A dict of the ``containers`` per node and the ``container_mb``,
+        ``nodemanager_mb``, ``nodemanager_vcores``, ``scheduler_min_mb``,
+        ``scheduler_max_mb``, ``map_mb``, ``reduce_mb``, and ``am_mb``
+    """
+    total_gb = total_mb / 1024.0
+    if reserved_mb is None:
+        for limit_gb, system_gb, hbase_gb in _RESERVED_MEMORY:
+            if total_gb <= limit_gb:
+                break
+        reserved_mb = (system_gb + (hbase_gb if hbase else 0)) * 1024
+        if datanode:
+            reserved_mb += 1024
+    if total_gb < 4:
+        min_container_mb = 256
+    elif total_gb < 8:
+        min_container_mb = 512
+    elif total_gb < 24:
+        min_container_mb = 1024
+    else:
+        min_container_mb = 2048
+    available_mb = max(total_mb - reserved_mb, min_container_mb)
+    containers = min(2 * cores, available_mb // min_container_mb)
+    if disks:
+        containers = min(containers, int(math.ceil(1.8 * disks)))
+    containers = max(1, int(containers))
+    container_mb = max(min_container_mb, available_mb // containers // 128 * 128)
+    nodemanager_mb = containers * container_mb
+    return {
+        'containers': containers,
+        'container_mb': container_mb,
+        'nodemanager_mb': nodemanager_mb,
+        'nodemanager_vcores': cores,
+        'scheduler_min_mb': container_mb,
+        'scheduler_max_mb': nodemanager_mb,
+        'map_mb': container_mb,
+        'reduce_mb': min(2 * container_mb, nodemanager_mb),
+        'am_mb': min(2 * container_mb, nodemanager_mb),
+    }
+
+
+def cluster_container_sizing(nodes):
+    """
+    Compute the scheduler limits and MapReduce task sizes for a cluster, from
+    the sizing of each of its NodeManagers (see :func:`yarn_container_sizing`).
+
+    Tasks are sized to the smallest NodeManager, so that they fit on any of
+    them, while the scheduler allows requests as large as the largest one.
+
+    :param list nodes: A dict of the ``nodemanager_mb``, ``container_mb``, and
+        ``nodemanager_vcores`` of each NodeManager
+    :returns: A dict of the ``scheduler_min_mb``, ``scheduler_max_mb``,
+        ``scheduler_max_vcores``, ``map_mb``, ``reduce_mb``, and ``am_mb``,
+        or None if there are no NodeManagers
+    """
+    if not nodes:
+        return None
+    container_mb = min(node['container_mb'] for node in nodes)
+    smallest_mb = min(node['nodemanager_mb'] for node in nodes)
+    return {
+        'scheduler_min_mb': container_mb,
+        'scheduler_max_mb': max(node['nodemanager_mb'] for node in nodes),
+        'scheduler_max_vcores': max(node['nodemanager_vcores'] for node in nodes),
+        'map_mb': container_mb,
+        'reduce_mb': min(2 * container_mb, smallest_mb),
+        'am_mb': min(2 * container_mb, smallest_mb),
+    }
+
+
+def rpc_handler_count(nodes, minimum=10):
+    """
+    Compute the number of RPC handler threads for a master serving the
+    given number of nodes, using the usual ``20 * ln(nodes)`` rule.
+    """
+    return max(minimum, int(20 * math.log(max(1, nodes))))
+
+
+def datanode_tuning(cores, disks=1, nodemanager=False):
+    """
+    Compute the DataNode transfer, handler, and page cache settings for
+    the given hardware and role.
+
+    :param int cores: Number of CPU cores of the node
+    :param int disks: Number of data disks of the node
+    :param bool nodemanager: Whether a NodeManager is co-located with the
+        DataNode, and thus competes with it for CPU and page cache
+    :returns: A dict of hdfs-site properties
+    """
+    disks = max(1, disks)
+    handlers = cores if nodemanager else 2 * cores
+    return {
+        'dfs.datanode.max.transfer.threads': max(4096, min(16384, 1024 * disks)),
+        'dfs.datanode.handler.count': max(10, min(64, handlers)),
+        'dfs.datanode.sync.behind.writes': 'true',
+        'dfs.datanode.drop.cache.behind.writes': 'true',
+        # leave the page cache to the containers when sharing the node
+        'dfs.datanode.drop.cache.behind.reads': 'true' if nodemanager else 'false',
+    }
+
+
+def mapreduce_tuning(map_mb, reduce_mb, am_mb, nodes=1):
+    """
+    Compute the MapReduce sort, spill, and shuffle settings for the given
+    task container sizes and number of nodes in the cluster.
+
+    :param int map_mb: Size of the map task containers, in MB
+    :param int reduce_mb: Size of the reduce task containers, in MB
+    :param int am_mb: Size of the MapReduce ApplicationMaster container, in MB
+    :param int nodes: Number of NodeManagers in the cluster
+    :returns: A dict of mapred-site properties
+    """
+    nodes = max(1, nodes)
+    map_heap_mb = int(map_mb * 0.8)
+    # the sort buffer takes 40% of the map heap, and is capped by Hadoop at 2047MB
+    sort_mb = max(100, min(2047, int(map_heap_mb * 0.4)))
+    sort_factor = max(10, min(100, sort_mb // 10))
+    parallelcopies = max(5, min(50, int(round(4 * math.log(nodes)))))
+    return {
+        'mapreduce.task.io.sort.mb': sort_mb,
+        'mapreduce.task.io.sort.factor': sort_factor,
+        'mapreduce.map.sort.spill.percent': 0.9 if sort_mb >= 512 else 0.8,
+        'mapreduce.reduce.shuffle.parallelcopies': parallelcopies,
+        'mapreduce.reduce.shuffle.input.buffer.percent': 0.7,
+        'mapreduce.reduce.shuffle.merge.percent': 0.66,
+        # map output only crosses the network when there is more than one node
+        'mapreduce.map.output.compress': 'true' if nodes > 1 else 'false',
+        # uber tasks run inside the AM, so it must be big enough to hold them
+        'mapreduce.job.ubertask.enable': 'true' if am_mb >= max(map_mb, reduce_mb) else 'false',
+        'mapreduce.job.ubertask.maxmaps': 9,
+        'mapreduce.job.ubertask.maxreduces': 1,
+    }
+
+
+# Filesystems which can hold Hadoop data, and mount points which must not
+DATA_FSTYPES = ('ext3', 'ext4', 'xfs', 'btrfs')
+SYSTEM_MOUNTS = ('/', '/boot', '/boot/efi', '/home', '/tmp', '/usr', '/var', '/var/log')
+
+
+def read_mounts(mounts_file='/proc/mounts'):
+    """
+    Read the mounted filesystems, as a list of ``(device, mount_point,
+    fstype, options)`` tuples, where ``options`` is a list.
+    """
+    mounts = []
+    for line in Path(mounts_file).lines(retain=False):
+        fields = line.split()
+        if len(fields) < 4:
+            continue
+        device, mount_point, fstype, options = fields[:4]
+        mounts.append((device, mount_point.replace('\\040', ' '), fstype, options.split(',')))
+    return mounts
+
+
+def read_kernel_choice(filename):
+    """
+    Read the selected value of a kernel setting which lists the choices,
+    such as ``always madvise [never]``.
+    """
+    content = Path(filename).text().strip()
+    match = re.search(r'\[(\w+)\]', content)
+    return match.group(1) if match else content
+
+
+def get_data_mounts(mounts_file='/proc/mounts'):
+    """
+    Discover the mount points of block devices which are eligible to hold
+    Hadoop data.
+
+    Only the first mount of each ``/dev`` device with a supported filesystem
+    (:data:`DATA_FSTYPES`) is considered, and system mount points
+    (:data:`SYSTEM_MOUNTS`) are excluded.
+
+    :param str mounts_file: File listing the mounted filesystems
+    :returns: A sorted list of mount points
+    """
+    mounts = {}
+    for device, mount_point, fstype, options in read_mounts(mounts_file):
+        if not device.startswith('/dev/') or fstype not in DATA_FSTYPES:
+            continue
+        if mount_point in SYSTEM_MOUNTS or mount_point.startswith(('/snap/', '/boot/')):
+            continue
+        mounts.setdefault(device, mount_point)
+    return sorted(mounts.values())
+
+
+def ensure_dirs(paths, owner='root', group='root', perms=0o755):
+    """
+    Create the given directories, and any missing parents, with the given
+    ownership and permissions, as :meth:`DistConfig.add_dirs` does.
+
+    :returns: The list of directories, as :class:`Path` instances
+    """
+    paths = [Path(p) for p in paths]
+    for path in paths:
+        host.mkdir(path, owner=owner, group=group, perms=perms)
+    return paths
+
+
+def parse_checknative(output):
+    """
+    Parse the output of ``hadoop checknative`` into a mapping of each native
+    library (e.g., ``hadoop``, ``snappy``, ``zstd``) to whether it is available.
+    """
+    native = {}
+    for line in output.splitlines():
+        match = re.match(r'^\s*([\w-]+)\s*:\s*(true|false)\b', line)
+        if match:
+            native[match.group(1)] = match.group(2) == 'true'
+    return native
+
+
+# Compression codecs, by name, with the native library each needs (if any)
+COMPRESSION_CODECS = [
+    ('deflate', 'org.apache.hadoop.io.compress.DefaultCodec', None),
+    ('gzip', 'org.apache.hadoop.io.compress.GzipCodec', None),
+    ('bzip2', 'org.apache.hadoop.io.compress.BZip2Codec', None),  # falls back to pure Java
+    ('snappy', 'org.apache.hadoop.io.compress.SnappyCodec', 'snappy'),
+    ('lz4', 'org.apache.hadoop.io.compress.Lz4Codec', 'lz4'),
+    ('zstd', 'org.apache.hadoop.io.compress.ZStandardCodec', 'zstd'),
+    ('lzo', 'com.hadoop.compression.lzo.LzoCodec', None),  # bundled with hadoop-lzo
+]
+
+
+def available_codecs(native, lzo=False):
+    """
+    Return the compression codecs which can be used with the given native
+    libraries, as a list of ``(name, class)`` tuples.
+
+    :param dict native: Availability of the native libraries, as returned
+        by :func:`parse_checknative`
+    :param bool lzo: Whether the separately distributed hadoop-lzo is installed
+    """
+    codecs = []
+    for name, codec_class, library in COMPRESSION_CODECS:
+        if name == 'lzo' and not lzo:
+            continue
+        if library and not (native.get('hadoop') and native.get(library)):
+            continue
+        codecs.append((name, codec_class))
+    return codecs
+
+
+def jvm_heap_mb(daemon, total_mb, blocks=1000000):
+    """
+    Compute the heap size, in MB, for a Hadoop daemon.
+
+    The NameNode (and SecondaryNameNode) heap is scaled to the expected
+    number of blocks, at 1GB per million, and may use up to 3/4 of the
+    memory; the other daemons are sized to their role, and may use up to
+    1/4 of the memory.
+
+    :param str daemon: Name of the daemon, e.g. ``namenode`` or ``nodemanager``
+    :param int total_mb: Total memory of the node, in MB
+    :param int blocks: Expected number of HDFS blocks
+    """
+    if daemon in ('namenode', 'secondarynamenode'):
+        heap_mb = 1024 * int(math.ceil(blocks / 1000000.0))
+        limit_mb = total_mb * 3 // 4
+    else:
+        heap_mb = {
+            'resourcemanager': min(8192, total_mb // 16),
+            'historyserver': min(4096, total_mb // 32),
+        }.get(daemon, 1024)
+        limit_mb = total_mb // 4
+    return max(256, min(max(1024, heap_mb), limit_mb))
+
+
+def jvm_opts(heap_mb, gc='auto', pause_ms=200, gc_log=None, java_version='1.8'):
+    """
+    Build the JVM options for a daemon with the given heap.
+
+    :param int heap_mb: Heap size, in MB
+    :param str gc: Garbage collector: ``g1``, ``parallel``, or ``auto``
+        (G1 for heaps of 4GB or more, ParallelGC otherwise)
+    :param int pause_ms: G1 pause time target, in ms
+    :param str gc_log: File to write the (rotated) GC log to, if any
+    :param str java_version: Java version, which determines the GC logging options
+    """
+    if gc == 'auto':
+        gc = 'g1' if heap_mb >= 4096 else 'parallel'
+    opts = ['-Xms{}m'.format(heap_mb), '-Xmx{}m'.format(heap_mb)]
+    if gc == 'g1':
+        opts += ['-XX:+UseG1GC', '-XX:MaxGCPauseMillis={}'.format(pause_ms)]
+    elif gc == 'parallel':
+        opts += ['-XX:+UseParallelGC']
+    else:
+        raise ValueError('Unknown garbage collector: {}'.format(gc))
+    if gc_log and str(java_version).startswith('1.'):
+        opts += ['-Xloggc:{}'.format(gc_log), '-XX:+PrintGCDetails', '-XX:+PrintGCDateStamps',
+                 '-XX:+UseGCLogFileRotation', '-XX:NumberOfGCLogFiles=10', '-XX:GCLogFileSize=10M']
+    elif gc_log:
+        opts += ['-Xlog:gc*:file={}:time,uptime:filecount=10,filesize=10M'.format(gc_log)]
+    return ' '.join(opts)
+
+
+DEFAULT_RACK = '/default-rack'
+
+# Looks up each host or IP given as an argument in the topology.data file
+# next to it, printing their racks on a single line, as Hadoop expects.
+TOPOLOGY_SCRIPT = """#!/bin/sh
+# DO NOT EDIT
+# This file is automatically managed by Juju
+exec awk -v hosts="$*" -v default={default} \\
+    'BEGIN {{ n = split(hosts, h, " ") }}
+     {{ rack[$1] = $2 }}
+     END {{ for (i = 1; i <= n; i++)
+               printf "%s%s", (i > 1 ? " " : ""), (h[i] in rack ? rack[h[i]] : default)
+           print "" }}' \\
+    "$(dirname "$0")/topology.data"
+""".format(default=DEFAULT_RACK)
+
+
+def normalize_rack(rack):
+    """
+    Turn a rack or availability zone name into a topology path, e.g.
+    ``us-east-1a`` into ``/us-east-1a``.
+    """
+    if not rack or not rack.strip('/'):
+        return DEFAULT_RACK
+    return '/' + rack.strip('/')
+
+
+def get_rack():
+    """
+    Get the rack of this unit, from the ``rack`` charm config option, if
+    set, or the availability zone Juju placed the unit in otherwise.
+    """
+    return normalize_rack(hookenv.config().get('rack') or os.environ.get('JUJU_AVAILABILITY_ZONE'))
+
+
+def parse_rack_mapping(text):
+    """
+    Parse the ``rack_mapping`` charm config option: a YAML mapping of
+    hostnames or IPs to racks.
+
+    :raises ValueError: if it is not valid YAML, or not a mapping of strings
+        to strings
+    """
+    try:
+        mapping = yaml.safe_load(text or '') or {}
+    except yaml.YAMLError as e:
+        raise ValueError('not valid YAML: {}'.format(e))
+    if not isinstance(mapping, dict) or not all(
+            isinstance(value, string_types) for item in mapping.items() for value in item):
+        raise ValueError('must map hostnames or IPs to rack names')
+    return mapping
+
+
+def write_topology(conf_dir, racks):
+    """
+    Write the rack awareness table, replacing any hosts it had before, and the
+    script which looks them up, for ``net.topology.script.file.name``.
+
+    :param str conf_dir: Directory to write ``topology.data`` and ``topology.sh`` to
+    :param dict racks: Mapping of hostnames and IPs to racks
+    :returns: True if the table was changed
+    """
+    conf_dir = Path(conf_dir)
+    table_file = conf_dir / 'topology.data'
+    script_file = conf_dir / 'topology.sh'
+    table = {}
+    if table_file.exists():
+        table = dict(line.split() for line in table_file.lines(retain=False) if len(line.split()) == 2)
+    new_table = {host: normalize_rack(rack) for host, rack in racks.items()}
+    if not script_file.exists() or script_file.text() != TOPOLOGY_SCRIPT:
+        script_file.write_text(TOPOLOGY_SCRIPT)
+        script_file.chmod(0o755)
+    if new_table == table and table_file.exists():
+        return False
+    table_file.write_lines('{} {}'.format(host, rack) for host, rack in sorted(new_table.items()))
+    return True
+
+
+def capacity_scheduler_queues(queues, parent='root'):
+    """
+    Generate the capacity-scheduler.xml properties for a hierarchy of queues.
+
+    Example queues::
+
+        {
+            'default': {'capacity': 40},
+            'analytics': {
+                'capacity': 60,
+                'maximum-capacity': 80,
+                'user-limit-factor': 2,
+                'queues': {
+                    'adhoc': {'capacity': 30},
+                    'etl': {'capacity': 70, 'disable_preemption': True},
+                },
+            },
+        }
+
+    :param dict queues: Mapping of queue names to their ``capacity`` (percent
+        of the parent), optional child ``queues``, and any other queue
+        properties (e.g., ``maximum-capacity`` or ``user-limit-factor``)
+    :param str parent: Path of the parent queue
+    :raises ValueError: if the queues are not a mapping, a queue has no valid
+        capacity, or the capacities of sibling queues don't add up to 100
+    """
+    if not isinstance(queues, dict) or not queues:
+        raise ValueError('Queues under {} must be a mapping of queue names to queues'.format(parent))
+    prefix = 'yarn.scheduler.capacity.'
+    props = {prefix + parent + '.queues': ','.join(sorted(queues))}
+    total = 0
+    for name, queue in sorted(queues.items()):
+        path = '{}.{}'.format(parent, name)
+        if not isinstance(queue, dict) or 'capacity' not in queue:
+            raise ValueError('Queue {} has no capacity'.format(path))
+        queue = dict(queue)
+        try:
+            total += float(queue['capacity'])
+        except (TypeError, ValueError):
+            raise ValueError('Queue {} has an invalid capacity: {}'.format(path, queue['capacity']))
+        children = queue.pop('queues', None)
+        for key, value in queue.items():
+            if isinstance(value, bool):
+                value = normalize_strbool(value)
+            props['{}{}.{}'.format(prefix, path, key)] = value
+        if children:
+            props.update(capacity_scheduler_queues(children, path))
+    if abs(total - 100) > 0.01:
+        raise ValueError('Capacities of the queues under {} add up to {:g}, not 100'.format(parent, total))
+    return props
+
+
+SYSTEMD_UNIT_DIR = Path('/etc/systemd/system')
+
+
+def systemd_unit(description, user, exec_start, group=None, environment=None,
+                 environment_file='/etc/environment', wait_for_port=None, limit_nofile=65536):
+    """
+    Render a systemd service unit for a long running daemon, which is
+    restarted if it fails, and has its CPU and memory use accounted for.
+
+    :param str description: Description of the service
+    :param str user: User to run the daemon as
+    :param str exec_start: Command line which runs the daemon in the foreground
+    :param str group: Group to run the daemon as
+    :param dict environment: Additional env variables
+    :param str environment_file: File to read env variables from (default ``/etc/environment``)
+    :param int wait_for_port: Port which the daemon listens on; if given, the
+        service is not considered started until it accepts connections on it
+    :param int limit_nofile: Maximum number of open files (and processes)
+    """
+    lines = [
+        '# DO NOT EDIT',
+        '# This file is automatically managed by Juju',
+        '[Unit]',
+        'Description={}'.format(description),
+        'Wants=network-online.target',
+        'After=network-online.target',
+        '',
+        '[Service]',
+        'Type=simple',
+        'User={}'.format(user),
+    ]
+    if group:
+        lines.append('Group={}'.format(group))
+    if environment_file:
+        lines.append('EnvironmentFile=-{}'.format(environment_file))
+    for key, value in sorted((environment or {}).items()):
+        lines.append('Environment="{}={}"'.format(key, value))
+    lines.append('ExecStart={}'.format(exec_start))
+    if wait_for_port:
+        # $$ escapes $ from systemd, and %H is the hostname
+        lines.append("ExecStartPost=/bin/bash -c 'for i in $$(seq 1 120); do "
+                     "(exec 3<>/dev/tcp/%H/{}) 2>/dev/null && exit 0; sleep 1; done; exit 1'".format(wait_for_port))
+    lines += [
+        'TimeoutStartSec=180',
+        'Restart=on-failure',
+        'RestartSec=10',
+        # the JVM exits with 128 + SIGTERM when stopped
+        'SuccessExitStatus=143',
+        'LimitNOFILE={}'.format(limit_nofile),
+        'LimitNPROC={}'.format(limit_nofile),
+        'CPUAccounting=yes',
+        'MemoryAccounting=yes',
+        '',
+        '[Install]',
+        'WantedBy=multi-user.target',
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+def install_systemd_unit(name, content):
+    """
+    Install (and enable) a systemd unit, reloading systemd if it changed.
+
+    :param str name: Name of the unit, e.g. ``hadoop-namenode.service``
+    :param str content: Content of the unit, as from :func:`systemd_unit`
+    :returns: True if the unit was changed
+    """
+    unit_file = SYSTEMD_UNIT_DIR / name
+    if unit_file.exists() and unit_file.text() == content:
+        return False
+    unit_file.write_text(content)
+    check_call(['systemctl', 'daemon-reload'])
+    check_call(['systemctl', 'enable', name])
+    return True
+
+
+def systemd_active(name):
+    """
+    Check whether a systemd unit is active.
+    """
+    try:
+        check_call(['systemctl', 'is-active', '--quiet', name])
+        return True
+    except CalledProcessError:
+        return False
+
+
+def restart_tokens(requests, done, granted, healthy, concurrency=1, racks=None):
+    """
+    Decide which slaves may restart, for a rolling restart across a cluster.
+
+    A token is released once its holder reports having restarted for its
+    current request, and the master sees it as healthy again.  Tokens are
+    then granted to the slaves with outstanding requests, in order, up to
+    ``concurrency`` at a time.
+
+    :param dict requests: Mapping of hosts to their outstanding restart request
+    :param dict done: Mapping of hosts to the last request they restarted for
+    :param list granted: Hosts currently holding a token
+    :param callable healthy: Called with a host, to check if it is healthy
+    :param int concurrency: Maximum number of tokens held at once
+    :param dict racks: Mapping of hosts to racks; if given, tokens are only
+        held within a single rack at a time
+    :returns: A sorted list of the hosts holding a token
+    """
+    granted = set(unit_host for unit_host in granted if unit_host in requests)
+    for unit_host in sorted(granted):
+        if done.get(unit_host) == requests[unit_host] and healthy(unit_host):
+            granted.discard(unit_host)
+    pending = sorted(unit_host for unit_host in requests
+                     if done.get(unit_host) != requests[unit_host] and unit_host not in granted)
+    if racks is not None and pending:
+        rack = racks.get(sorted(granted)[0]) if granted else racks.get(pending[0])
+        pending = [unit_host for unit_host in pending if racks.get(unit_host) == rack]
+    while pending and len(granted) < concurrency:
+        granted.add(pending.pop(0))
+    return sorted(granted)
+
+
+METRICS2_PREFIXES = ('namenode', 'secondarynamenode', 'datanode',
+                     'resourcemanager', 'nodemanager', 'jobhistoryserver')
+
+METRICS2_SINKS = {
+    # sink type: (sink class, default port)
+    'ganglia': ('org.apache.hadoop.metrics2.sink.ganglia.GangliaSink31', 8649),
+    'graphite': ('org.apache.hadoop.metrics2.sink.GraphiteSink', 2003),
+    'statsd': ('org.apache.hadoop.metrics2.sink.StatsDSink', 8125),
+}
+
+
+def metrics2_properties(sinks, period=10, filters=None, prefixes=METRICS2_PREFIXES):
+    """
+    Generate the hadoop-metrics2.properties lines which push each daemon's
+    metrics to the given collectors.
+
+    Filters are given per daemon prefix (or ``*`` for all of them), and per
+    filter level (``source``, ``record``, or ``metric``), as glob patterns
+    to include or exclude, e.g.::
+
+        {'datanode': {'metric': {'exclude': '*Info*'}},
+         '*': {'source': {'include': 'jvm|rpc*'}}}
+
+    :param dict sinks: Mapping of sink types (see :data:`METRICS2_SINKS`) to
+        ``(host, port)`` of their collector; a port of None uses the default
+    :param int period: Sampling period, in seconds
+    :param dict filters: Filters to apply to the sinks
+    :param list prefixes: Daemon prefixes to configure sinks for
+    :returns: A list of property lines
+    """
+    filters = filters or {}
+    unknown = set(sinks) - set(METRICS2_SINKS)
+    if unknown:
+        raise ValueError('Unknown metrics sinks: {}'.format(', '.join(sorted(unknown))))
+    for prefix, levels in filters.items():
+        if prefix != '*' and prefix not in prefixes:
+            raise ValueError('Unknown metrics prefix: {}'.format(prefix))
+        for level, patterns in levels.items():
+            if level not in ('source', 'record', 'metric') or set(patterns) - set(['include', 'exclude']):
+                raise ValueError('Invalid metrics filter for {}: {}'.format(prefix, level))
+    lines = ['*.period={}'.format(int(period))]
+    for level in sorted(set(level for levels in filters.values() for level in levels)):
+        lines.append('*.{}.filter.class=org.apache.hadoop.metrics2.filter.GlobFilter'.format(level))
+    for sink, (sink_host, port) in sorted(sinks.items()):
+        sink_class, default_port = METRICS2_SINKS[sink]
+        port = port or default_port
+        lines.append('*.sink.{}.class={}'.format(sink, sink_class))
+        if sink == 'ganglia':
+            lines.append('*.sink.ganglia.supportsparse=true')
+        for prefix in prefixes:
+            option = '{}.sink.{}.'.format(prefix, sink)
+            if sink == 'ganglia':
+                lines.append('{}servers={}:{}'.format(option, sink_host, port))
+            elif sink == 'graphite':
+                lines.append('{}server_host={}'.format(option, sink_host))
+                lines.append('{}server_port={}'.format(option, port))
+                lines.append('{}metrics_prefix={}'.format(option, prefix))
+            elif sink == 'statsd':
+                lines.append('{}server.host={}'.format(option, sink_host))
+                lines.append('{}server.port={}'.format(option, port))
+                lines.append('{}service.name={}'.format(option, prefix))
+            for filter_prefix in ('*', prefix):
+                for level, patterns in sorted(filters.get(filter_prefix, {}).items()):
+                    for kind, pattern in sorted(patterns.items()):
+                        lines.append('{}{}.filter.{}={}'.format(option, level, kind, pattern))
+    return lines
+
+
 def cpu_arch():
     return subprocess.check_output(['uname', '-p']).strip()
 
@@ -497,26 +1746,243 @@ class verify_resources(object):
     """
     Predicate for specific named resources, with useful rendering in the logs.
 
+    Verifying a resource means hashing it, which is slow for large resources,
+    so the path, size, mtime, and inode of each verified resource is cached in
+    :func:`unitdata.kv` and it is only re-verified if those change.  Any
+    missing or invalid resources are fetched concurrently.
+
+    Resources are fetched from the given peers (see :func:`serve_resources`)
+    before falling back to the ``resources_mirror``.  Whatever a peer serves
+    is checked against the hash from ``resources.yaml`` or, if that is a URL,
+    the hash fetched from the origin (the ``resources_mirror``, if set);
+    never against a hash supplied by the peer.
+
     :param str \*which: One or more resource names to fetch & verify.  Defaults to
         all non-optional resources.
+    :param peers: List of peer mirror URLs, or a callable which returns them
+        (e.g., :func:`get_resource_peers`)
+    :param str resources_yaml: Location of the resource definitions
     """
-    def __init__(self, *which):
+    def __init__(self, *which, **kwargs):
         self.which = list(which)
+        self.peers = kwargs.get('peers')
+        self.resources_yaml = kwargs.get('resources_yaml', 'resources.yaml')
+        self._hashes = {}
 
     def __str__(self):
         return '<resources %s>' % ', '.join(map(repr, self.which))
 
-    def __call__(self):
+    def _definition(self, name):
+        with open(self.resources_yaml) as fp:
+            resdefs = yaml.safe_load(fp) or {}
+        return ((resdefs.get('resources') or {}).get(name) or
+                (resdefs.get('optional_resources') or {}).get(name) or {})
+
+    def _origin_hash(self, name, mirror_url):
+        """
+        Return the ``(hash_type, hash)`` of a resource whose hash is given as
+        a URL, fetched from the origin, or None if its hash is given inline.
+        """
+        if name not in self._hashes:
+            definition = self._definition(name)
+            hash_url = definition.get('hash', '')
+            if not urlparse(hash_url).scheme:
+                self._hashes[name] = None
+            else:
+                if mirror_url:  # same layout as jujuresources
+                    hash_url = urljoin(mirror_url, os.path.join(name, os.path.basename(urlparse(hash_url).path)))
+                with closing(urlopen(hash_url, timeout=30)) as fp:
+                    self._hashes[name] = (definition.get('hash_type'), fp.read(8 * 1024).decode('utf8').strip())
+        return self._hashes[name]
+
+    def _valid(self, name, mirror_url):
+        import jujuresources
+        try:
+            origin_hash = self._origin_hash(name, mirror_url)
+        except IOError as e:
+            hookenv.log('Unable to fetch the hash of %s: %s' % (name, e), hookenv.WARNING)
+            return False
+        if origin_hash is None:
+            return not jujuresources.invalid([name], resources_yaml=self.resources_yaml)
+        hash_type, expected = origin_hash
+        path = jujuresources.resource_path(name, resources_yaml=self.resources_yaml)
+        return os.path.isfile(path) and _file_hash(path, hash_type) == expected
+
+    def _fetch_from_peer(self, name, peer_url, mirror_url):
+        import jujuresources
+        path = jujuresources.resource_path(name, resources_yaml=self.resources_yaml)
+        if not path:
+            return False  # not a file (e.g., PyPI)
+        url = urljoin(peer_url, os.path.join(name, os.path.basename(path)))
+        host.mkdir(os.path.dirname(path))
+        try:
+            with closing(urlopen(url, timeout=30)) as res_in, open(path, 'wb') as res_out:
+                for chunk in iter(lambda: res_in.read(1024 * 1024), b''):
+                    res_out.write(chunk)
+        except IOError as e:
+            hookenv.log('Unable to fetch %s from peer %s: %s' % (name, peer_url, e), hookenv.WARNING)
+            return False
+        if not self._valid(name, mirror_url):
+            hookenv.log('Resource %s from peer %s failed verification' % (name, peer_url), hookenv.WARNING)
+            os.remove(path)
+            return False
+        return True
+
+    def _peers(self):
+        """
+        Resolve the peer mirror URLs.  This must be done in the main thread,
+        as :func:`get_resource_peers` reads :func:`unitdata.kv`.
+        """
+        return list((self.peers() if callable(self.peers) else self.peers) or [])
+
+    def _fetch(self, name, mirror_url, peers=()):
+        """
+        Fetch a resource from the peers, if any, falling back to the mirror.
+        The resource's hash is verified regardless of where it came from.
+        """
         import jujuresources
-        result = True
-        if not jujuresources.verify(self.which):
-            mirror_url = hookenv.config('resources_mirror')
+        peers = list(peers)
+        random.shuffle(peers)  # spread the load across the peers
+        for peer_url in peers:
+            if self._fetch_from_peer(name, peer_url, mirror_url):
+                hookenv.log('Fetched %s from peer %s' % (name, peer_url))
+                return True
+        jujuresources.fetch([name], mirror_url=mirror_url, resources_yaml=self.resources_yaml)
+        return self._valid(name, mirror_url)
+
+    def __call__(self):
+        kv = unitdata.kv()
+        unverified = []
+        for name in self.which:
+            signature = self._signature(name)
+            # a resource which was never fetched has no signature, and neither
+            # does an empty cache, so that is always a miss
+            if signature is None or kv.get('resources.verified.%s' % name) != signature:
+                unverified.append(name)
+        if self.which and not unverified:
+            return True
+        if not self.which:
+            import jujuresources
+            unverified = sorted(jujuresources.invalid(resources_yaml=self.resources_yaml))
+        mirror_url = hookenv.config('resources_mirror')
+        missing = []
+        invalid = sorted(name for name in unverified if not self._valid(name, mirror_url))
+        if invalid:
             hookenv.status_set('maintenance', 'Fetching resources')
-            result = jujuresources.fetch(self.which, mirror_url=mirror_url)
-            if not result:
-                missing = jujuresources.invalid(self.which)
+            peers = self._peers()
+            pool = ThreadPool(len(invalid))
+            try:
+                fetched = pool.map(lambda name: self._fetch(name, mirror_url, peers), invalid)
+            finally:
+                pool.close()
+                pool.join()
+            missing = sorted(name for name, ok in zip(invalid, fetched) if not ok)
+            if missing:
                 hookenv.status_set('blocked', 'Unable to fetch required resource%s: %s' % (
                     's' if len(missing) > 1 else '',
                     ', '.join(missing),
                 ))
-        return result
+        for name in set(unverified) - set(missing):
+            kv.set('resources.verified.%s' % name, self._signature(name))
+        kv.flush(True)
+        return not missing
+
+    def _signature(self, name):
+        import jujuresources
+        try:
+            path = jujuresources.resource_path(name, resources_yaml=self.resources_yaml)
+            stat = os.stat(path)
+        except (KeyError, TypeError, OSError):
+            return None  # undefined, not fetched, or not a file (e.g., PyPI)
+        return [path, stat.st_size, stat.st_mtime, stat.st_ino]
+
+
+_RESOURCE_SERVER = """
+import sys
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+HTTPServer((sys.argv[1], int(sys.argv[2])), SimpleHTTPRequestHandler).serve_forever()
+"""
+
+
+def serve_resources(port, directory='resources', address=None):
+    """
+    Serve this unit's fetched resources to peer units over HTTP, so that they
+    don't all have to fetch them from the same mirror.
+
+    The resources are served in the layout expected by the ``mirror_url`` of
+    ``jujuresources.fetch``, by a server which runs in the background, outliving
+    the hook, until :func:`stop_serving_resources` is called.  Peers verify
+    everything they fetch against hashes from the origin, not from this unit.
+
+    :param int port: Port on which to serve the resources
+    :param str directory: Directory into which resources are fetched
+    :param str address: Address on which to serve the resources (default:
+        the unit's private address)
+    """
+    address = address or hookenv.unit_private_ip()
+    kv = unitdata.kv()
+    pid = kv.get('resources.server.pid')
+    if pid and kv.get('resources.server.port') == port and \
+            kv.get('resources.server.address') == address and _pid_running(pid):
+        return
+    stop_serving_resources()
+    with open(os.devnull, 'r+') as devnull:
+        server = subprocess.Popen([sys.executable, '-c', _RESOURCE_SERVER, address, str(port)],
+                                  cwd=directory, stdin=devnull, stdout=devnull, stderr=devnull,
+                                  close_fds=True, preexec_fn=os.setsid)
+    hookenv.log('Serving resources on %s:%s (pid %s)' % (address, port, server.pid))
+    kv.set('resources.server.pid', server.pid)
+    kv.set('resources.server.port', port)
+    kv.set('resources.server.address', address)
+    kv.flush(True)
+
+
+def stop_serving_resources():
+    kv = unitdata.kv()
+    pid = kv.get('resources.server.pid')
+    if pid and _pid_running(pid):
+        os.kill(pid, 15)
+    kv.unset('resources.server.pid')
+    kv.flush(True)
+
+
+def resource_server_url():
+    """
+    Return the URL at which this unit is serving resources to its peers,
+    or ``None`` if it is not.
+    """
+    kv = unitdata.kv()
+    pid = kv.get('resources.server.pid')
+    if not (pid and _pid_running(pid)):
+        return None
+    return 'http://%s:%s/' % (kv.get('resources.server.address') or hookenv.unit_private_ip(),
+                              kv.get('resources.server.port'))
+
+
+def _pid_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+def get_resource_peers():
+    return list(unitdata.kv().getrange('resources.peer.', strip=True).values())
+
+
+def update_resource_peer(unit, url):
+    """
+    Record (or, if ``url`` is ``None``, forget) the URL at which a peer unit
+    is serving resources, for use by :class:`verify_resources`.
+    """
+    unit_kv = unitdata.kv()
+    if url:
+        unit_kv.set('resources.peer.%s' % unit, url)
+    else:
+        unit_kv.unset('resources.peer.%s' % unit)
+    unit_kv.flush(True)
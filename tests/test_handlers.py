@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+# Copyright 2014-2015 Canonical Limited.
+#
+# This file is part of jujubigdata.
+#
+# jujubigdata is free software: you can redistribute it and/or modify
+# it under the terms of the Apache License version 2.0.
+#
+# jujubigdata is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# Apache License for more details.
+
+
+import tempfile
+import threading
+import unittest
+import mock
+from path import Path
+
+from charmhelpers.core import unitdata
+
+from jujubigdata import handlers
+from jujubigdata import utils
+
+
+class KVMixin(object):
+    def patch_kv(self, data=None):
+        """
+        Back :func:`unitdata.kv` with the dict ``self.kv`` for the rest of the test.
+        """
+        self.kv = dict(data or {})
+        patcher = mock.patch.object(handlers.unitdata, 'kv')
+        kv = patcher.start()
+        self.addCleanup(patcher.stop)
+        kv.return_value.get.side_effect = lambda key, default=None: self.kv.get(key, default)
+        kv.return_value.set.side_effect = self.kv.__setitem__
+        kv.return_value.unset.side_effect = lambda key: self.kv.pop(key, None)
+        kv.return_value.update.side_effect = self.kv.update
+        return kv
+
+
+class TestHDFSBalancer(KVMixin, unittest.TestCase):
+    def setUp(self):
+        self.hadoop_base = mock.MagicMock()
+        self.hadoop_base.charm_config = {'balancer_threshold': 5, 'dfs_balance_bandwidth': 1048576}
+        self.hadoop_base.dist_config.path.return_value = '/etc/hadoop/conf'
+        self.hdfs = handlers.HDFS(self.hadoop_base)
+        self.patch_kv()
+
+    @mock.patch.object(handlers.utils, 'jps')
+    def test_start_balancer(self, jps):
+        jps.side_effect = lambda name: ['1234'] if name == 'NameNode' else []
+        self.assertTrue(self.hdfs.start_balancer())
+        self.hadoop_base.run.assert_has_calls([
+            mock.call('hdfs', 'bin/hdfs', 'dfsadmin', '-setBalancerBandwidth', '1048576'),
+            mock.call('hdfs', 'sbin/start-balancer.sh', '--config', '/etc/hadoop/conf', '-threshold', '5'),
+        ])
+
+    @mock.patch.object(handlers.utils, 'jps')
+    def test_start_balancer_running(self, jps):
+        jps.return_value = ['1234']  # NameNode and Balancer
+        self.assertFalse(self.hdfs.start_balancer())
+        self.assertFalse(self.hadoop_base.run.called)
+
+    def test_stop_balancer(self):
+        self.hdfs.stop_balancer()
+        self.hadoop_base.run.assert_called_once_with(
+            'hdfs', 'sbin/stop-balancer.sh', '--config', '/etc/hadoop/conf')
+
+    def test_balance_new_datanodes(self):
+        calls = []
+        self.hdfs.refresh_nodes = mock.Mock(side_effect=lambda: calls.append('refresh'))
+        self.hdfs.decommission_status = mock.Mock(return_value={'dn-3': {'state': 'in-service'}})
+        self.hdfs.start_balancer = mock.Mock(side_effect=lambda: calls.append('balance') or True)
+        self.assertTrue(self.hdfs.balance_new_datanodes(['dn-3']))
+        self.assertEqual(calls, ['refresh', 'balance'])
+        self.assertNotIn('hdfs.balancer.pending', self.kv)
+
+    @mock.patch.object(handlers.hookenv, 'log')
+    def test_balance_new_datanodes_not_live(self, log):
+        self.hdfs.refresh_nodes = mock.Mock()
+        self.hdfs.decommission_status = mock.Mock(return_value={'dn-3': {'state': 'unknown'}})
+        self.hdfs.start_balancer = mock.Mock(return_value=True)
+        # checked once, without waiting, and left pending
+        self.assertFalse(self.hdfs.balance_new_datanodes(['dn-3']))
+        self.assertFalse(self.hdfs.start_balancer.called)
+        self.assertEqual(self.kv['hdfs.balancer.pending'], ['dn-3'])
+        # retried in a later hook
+        self.hdfs.decommission_status.return_value = {'dn-3': {'state': 'in-service'}}
+        self.assertTrue(self.hdfs.balance_new_datanodes([]))
+        self.hdfs.decommission_status.assert_called_with(['dn-3'])
+        self.assertEqual(self.hdfs.refresh_nodes.call_count, 1)
+        self.assertNotIn('hdfs.balancer.pending', self.kv)
+
+    @mock.patch.object(handlers.utils, 'defer_once')
+    def test_register_slaves_retries_pending(self, defer_once):
+        self.hadoop_base.charm_config['balancer_auto'] = True
+        self.hadoop_base.register_slaves.return_value = utils.HostsDelta([], ['dn-4'])
+        self.kv['hdfs.balancer.pending'] = ['dn-3', 'dn-4']
+        self.hdfs._excluded_datanodes = mock.Mock(return_value=['dn-4'])
+        self.hdfs.configure_namenode_rpc = mock.Mock()
+        self.hdfs.register_slaves(['dn-1', 'dn-3'])
+        self.assertEqual(self.kv['hdfs.balancer.pending'], ['dn-3'])
+        defer_once.assert_any_call('hdfs.balancer', self.hdfs.balance_new_datanodes, [])
+
+
+class TestTopology(KVMixin, unittest.TestCase):
+    def setUp(self):
+        self.conf_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(self.conf_dir.rmtree_p)
+        (self.conf_dir / 'core-site.xml').write_text('<configuration></configuration>')
+        self.hadoop_base = mock.MagicMock()
+        self.hadoop_base.charm_config = {'rack_mapping': 'worker-2: /rack9'}
+        self.hadoop_base.dist_config.path.return_value = self.conf_dir
+        self.patch_kv()
+
+    def register_topology(self, *args):
+        return handlers.HadoopBase.register_topology(self.hadoop_base, *args)
+
+    def table(self):
+        return sorted((self.conf_dir / 'topology.data').lines(retain=False))
+
+    def test_register_topology(self):
+        self.assertTrue(self.register_topology({'worker-0': 'rack1', 'worker-2': 'rack1'}, 'datanode'))
+        self.assertTrue(self.register_topology({'worker-1': 'rack2'}, 'nodemanager'))
+        self.assertEqual(self.table(), ['worker-0 /rack1', 'worker-1 /rack2', 'worker-2 /rack9'])
+        # worker-0 departed, and the mapping no longer overrides worker-2
+        self.hadoop_base.charm_config = {}
+        self.assertTrue(self.register_topology({'worker-2': 'rack1'}, 'datanode'))
+        self.assertEqual(self.table(), ['worker-1 /rack2', 'worker-2 /rack1'])
+        self.assertFalse(self.register_topology())
+
+    @mock.patch.object(handlers.hookenv, 'status_set')
+    def test_register_topology_invalid_mapping(self, status_set):
+        self.assertTrue(self.register_topology({'worker-0': 'rack1'}, 'datanode'))
+        for mapping in ('worker-0: [', '- worker-0', 'worker-0: 1', 'worker-0: {rack: rack2}'):
+            self.hadoop_base.charm_config = {'rack_mapping': mapping}
+            self.assertFalse(self.register_topology({'worker-1': 'rack2'}, 'datanode'))
+            self.assertEqual(status_set.call_args[0][0], 'blocked')
+        self.assertEqual(self.table(), ['worker-0 /rack1', 'worker-2 /rack9'])
+
+
+class TestNodeManagerRole(KVMixin, unittest.TestCase):
+    def setUp(self):
+        self.hadoop_base = mock.MagicMock()
+        self.yarn = handlers.YARN(self.hadoop_base)
+        self.patch_kv({'hdfs.datanode.tuning': {'cores': 4, 'disks': 1, 'nodemanager': False}})
+
+    @mock.patch.object(handlers.HDFS, 'request_datanode_restart')
+    @mock.patch.object(handlers.HDFS, 'configure_datanode_tuning')
+    def test_role_change_retunes_datanode(self, configure_datanode_tuning, request_datanode_restart):
+        configure_datanode_tuning.return_value = True
+        self.yarn._set_nodemanager_role(True)
+        self.assertTrue(self.kv['yarn.nodemanager.configured'])
+        request_datanode_restart.assert_called_once_with()
+        # no change, no retuning
+        self.yarn._set_nodemanager_role(True)
+        self.assertEqual(configure_datanode_tuning.call_count, 1)
+        self.yarn.stop_nodemanager = mock.Mock()
+        self.yarn.remove_nodemanager()
+        self.yarn.stop_nodemanager.assert_called_once_with()
+        self.assertFalse(self.kv['yarn.nodemanager.configured'])
+        self.assertEqual(configure_datanode_tuning.call_count, 2)
+
+    @mock.patch.object(handlers.HDFS, 'configure_datanode_tuning')
+    def test_role_change_without_datanode(self, configure_datanode_tuning):
+        del self.kv['hdfs.datanode.tuning']
+        self.yarn._set_nodemanager_role(True)
+        self.assertFalse(configure_datanode_tuning.called)
+
+
+class TestYARNSizing(KVMixin, unittest.TestCase):
+    def setUp(self):
+        self.conf_dir = Path(tempfile.mkdtemp())
+        for name in ('yarn-site.xml', 'mapred-site.xml'):
+            (self.conf_dir / name).write_text('<configuration></configuration>')
+        self.hadoop_base = mock.MagicMock()
+        self.hadoop_base.charm_config = {}
+        self.hadoop_base.dist_config.path.return_value = self.conf_dir
+        self.yarn = handlers.YARN(self.hadoop_base)
+        self.patch_kv()
+
+    def tearDown(self):
+        self.conf_dir.rmtree_p()
+
+    def test_configure_cluster_sizing(self):
+        nodes = [
+            {'nodemanager_mb': 14336, 'container_mb': 1792, 'nodemanager_vcores': 4},
+            {'nodemanager_mb': 57344, 'container_mb': 2048, 'nodemanager_vcores': 16},
+        ]
+        self.yarn.configure_cluster_sizing(nodes)
+        yarn_site = utils.read_xmlpropmap(self.conf_dir / 'yarn-site.xml')
+        self.assertEqual(yarn_site['yarn.scheduler.minimum-allocation-mb'], '1792')
+        self.assertEqual(yarn_site['yarn.scheduler.maximum-allocation-mb'], '57344')
+        self.assertNotIn('yarn.nodemanager.resource.memory-mb', yarn_site)
+        mapred_site = utils.read_xmlpropmap(self.conf_dir / 'mapred-site.xml')
+        self.assertEqual(mapred_site['mapreduce.map.memory.mb'], '1792')
+        self.assertEqual(mapred_site['mapreduce.reduce.memory.mb'], '3584')
+        self.assertEqual(self.kv['yarn.job.sizing']['am_mb'], 3584)
+
+    def test_configure_job_sizing(self):
+        self.assertIsNone(self.yarn.configure_job_sizing())
+        self.hadoop_base.charm_config = {'mapreduce_map_memory_mb': 1024}
+        self.yarn.configure_job_sizing({'map_mb': 2048, 'reduce_mb': 4096, 'am_mb': 4096})
+        mapred_site = utils.read_xmlpropmap(self.conf_dir / 'mapred-site.xml')
+        self.assertEqual(mapred_site['mapreduce.map.memory.mb'], '1024')
+        self.assertEqual(mapred_site['mapreduce.reduce.java.opts'], '-Xmx3276m')
+
+    def test_client_tuning(self):
+        # clients have no slaves file, so they are tuned to the count the ResourceManager publishes
+        self.yarn.configure_job_sizing({'map_mb': 2048, 'reduce_mb': 4096, 'am_mb': 4096}, nodes=20)
+        mapred_site = utils.read_xmlpropmap(self.conf_dir / 'mapred-site.xml')
+        self.assertEqual(mapred_site['mapreduce.map.output.compress'], 'true')
+        self.assertEqual(self.kv['yarn.cluster.nodes'], 20)
+        self.assertEqual(self.yarn.cluster_size(), 20)
+
+    @mock.patch.object(handlers.hookenv, 'status_set')
+    def test_tuning_overrides(self, status_set):
+        self.hadoop_base.charm_config = {'mapreduce_tuning_overrides': 'mapreduce.task.io.sort.mb: 256'}
+        self.yarn.configure_job_sizing({'map_mb': 2048, 'reduce_mb': 4096, 'am_mb': 4096}, nodes=20)
+        mapred_site = utils.read_xmlpropmap(self.conf_dir / 'mapred-site.xml')
+        self.assertEqual(mapred_site['mapreduce.task.io.sort.mb'], '256')
+        self.assertFalse(status_set.called)
+        for overrides in ('mapreduce.task.io.sort.mb: [', '- mapreduce.task.io.sort.mb',
+                          'mapreduce.task.io.sort.mb: {mb: 128}'):
+            self.hadoop_base.charm_config = {'mapreduce_tuning_overrides': overrides}
+            self.assertIsNone(self.yarn.configure_mapreduce_tuning(20))
+            self.assertEqual(status_set.call_args[0][0], 'blocked')
+        self.assertEqual(utils.read_xmlpropmap(self.conf_dir / 'mapred-site.xml'), mapred_site)
+
+
+class TestYARNScheduler(unittest.TestCase):
+    def setUp(self):
+        self.conf_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(self.conf_dir.rmtree_p)
+        for name in ('yarn-site.xml', 'capacity-scheduler.xml'):
+            (self.conf_dir / name).write_text('<configuration></configuration>')
+        self.hadoop_base = mock.MagicMock()
+        self.hadoop_base.charm_config = {}
+        self.hadoop_base.dist_config.path.return_value = self.conf_dir
+        self.yarn = handlers.YARN(self.hadoop_base)
+
+    @mock.patch.object(handlers.utils, 'defer_once')
+    @mock.patch.object(handlers.utils, 'jps')
+    @mock.patch.object(handlers.hookenv, 'log')
+    def test_configure_scheduler(self, log, jps, defer_once):
+        jps.return_value = ['1234']
+        self.assertTrue(self.yarn.configure_scheduler())
+        props = utils.read_xmlpropmap(self.conf_dir / 'capacity-scheduler.xml')
+        self.assertEqual(props['yarn.scheduler.capacity.schedule-asynchronously.enable'], 'false')
+        defer_once.assert_called_once_with('yarn.refresh_queues', self.yarn.refresh_queues)
+        # queue changes are refreshed, without a restart
+        log.reset_mock()
+        self.hadoop_base.charm_config = {'yarn_queues': 'a: {capacity: 50}\nb: {capacity: 50}'}
+        self.assertTrue(self.yarn.configure_scheduler())
+        props = utils.read_xmlpropmap(self.conf_dir / 'yarn-site.xml')
+        self.assertEqual(props['yarn.resourcemanager.scheduler.monitor.enable'], 'true')
+        self.assertIn('restart the ResourceManager', log.call_args[0][0])
+        log.reset_mock()
+        self.hadoop_base.charm_config['yarn_queues'] = 'a: {capacity: 40}\nb: {capacity: 60}'
+        self.assertTrue(self.yarn.configure_scheduler())
+        self.assertFalse(log.called)
+        self.hadoop_base.charm_config['yarn_async_scheduling'] = True
+        self.assertTrue(self.yarn.configure_scheduler())
+        self.assertIn('restart the ResourceManager', log.call_args[0][0])
+        self.assertFalse(self.yarn.configure_scheduler())
+
+    @mock.patch.object(handlers.hookenv, 'status_set')
+    def test_configure_scheduler_invalid_queues(self, status_set):
+        for queues in ('a: {capacity: 50}', 'a: [', 'just a string', 'a: {capacity: lots}'):
+            self.hadoop_base.charm_config = {'yarn_queues': queues}
+            self.assertFalse(self.yarn.configure_scheduler())
+            self.assertEqual(status_set.call_args[0][0], 'blocked')
+        props = utils.read_xmlpropmap(self.conf_dir / 'capacity-scheduler.xml')
+        self.assertEqual(props, {})
+
+
+class TestContainerIsolation(unittest.TestCase):
+    def setUp(self):
+        self.hadoop_base = mock.MagicMock()
+        self.yarn = handlers.YARN(self.hadoop_base)
+
+    def test_memory_isolation_supported(self):
+        for version, supported in (('2.7.1', False), ('2.8.5', False), ('2.9.0', True), ('3.1.1', True)):
+            self.hadoop_base.dist_config.hadoop_version = version
+            self.assertEqual(self.yarn.memory_isolation_supported(), supported, version)
+
+    @mock.patch.object(handlers.utils, 'ensure_dirs')
+    @mock.patch.object(handlers.unitdata, 'kv')
+    def test_start_recreates_hierarchies(self, kv, ensure_dirs):
+        # the NodeManager may be started from a worker thread, which can't use the kv
+        kv.side_effect = AssertionError('kv used while starting the NodeManager')
+        conf_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(conf_dir.rmtree_p)
+        self.hadoop_base.dist_config.path.return_value = conf_dir
+        (conf_dir / 'yarn-site.xml').write_text('<configuration></configuration>')
+        with utils.xmlpropmap_edit_in_place(conf_dir / 'yarn-site.xml') as props:
+            props['yarn.nodemanager.container-executor.class'] = \
+                'org.apache.hadoop.yarn.server.nodemanager.LinuxContainerExecutor'
+            props['yarn.nodemanager.linux-container-executor.cgroups.hierarchy'] = '/hadoop-yarn'
+            props['yarn.nodemanager.linux-container-executor.cgroups.mount'] = 'false'
+            props['yarn.nodemanager.linux-container-executor.cgroups.mount-path'] = '/sys/fs/cgroup'
+        self.hadoop_base.is_running.return_value = False
+        self.yarn._yarn_daemon = mock.Mock()
+        thread = threading.Thread(target=self.yarn.start_nodemanager)
+        thread.start()
+        thread.join()
+        ensure_dirs.assert_called_once_with([Path('/sys/fs/cgroup/cpu/hadoop-yarn')], owner='yarn', group='hadoop')
+        self.yarn._yarn_daemon.assert_called_once_with('start', 'nodemanager')
+
+
+class TestLifecycle(KVMixin, unittest.TestCase):
+    def setUp(self):
+        self.events = []
+        self.hdfs = mock.Mock()
+        self.yarn = mock.Mock()
+        for handler, roles in ((self.hdfs, ['namenode', 'secondarynamenode', 'datanode']),
+                               (self.yarn, ['resourcemanager', 'nodemanager', 'jobhistory'])):
+            for role in roles:
+                setattr(handler, 'start_' + role, self.record('start', role))
+                setattr(handler, 'stop_' + role, self.record('stop', role))
+                setattr(handler, role + '_ready', self.record('ready', role, True))
+        self.hdfs.hdfs_writable = self.record('ready', 'hdfs-writable', True)
+        self.lifecycle = handlers.Lifecycle(self.hdfs, self.yarn, timeout=5)
+        self.patch_kv()
+
+    def record(self, action, role, result=None):
+        def event(*args, **kwargs):
+            self.events.append((action, role))
+            return result
+        return event
+
+    def assertBefore(self, first, second):
+        self.assertIn(first, self.events)
+        self.assertIn(second, self.events)
+        self.assertLess(self.events.index(first), self.events.index(second),
+                        '{} not before {}'.format(first, second))
+
+    def test_start(self):
+        roles = ['namenode', 'datanode', 'resourcemanager', 'nodemanager', 'historyserver']
+        timings = self.lifecycle.start(roles)
+        self.assertEqual(set(timings), set(roles) | {'hdfs-writable'})
+        self.assertBefore(('ready', 'resourcemanager'), ('start', 'nodemanager'))
+        self.assertBefore(('ready', 'namenode'), ('ready', 'hdfs-writable'))
+        self.assertBefore(('ready', 'datanode'), ('ready', 'hdfs-writable'))
+        self.assertBefore(('ready', 'hdfs-writable'), ('start', 'jobhistory'))
+        self.assertNotIn(('stop', 'namenode'), self.events)
+
+    def test_start_unknown_role(self):
+        self.assertRaises(ValueError, self.lifecycle.start, ['namenode', 'zookeeper'])
+
+    def test_stop(self):
+        self.lifecycle.stop(['namenode', 'datanode', 'resourcemanager', 'nodemanager', 'historyserver'])
+        self.assertEqual(len(self.events), 5)
+        self.assertBefore(('stop', 'nodemanager'), ('stop', 'resourcemanager'))
+        # through the hdfs-writable gate
+        self.assertBefore(('stop', 'jobhistory'), ('stop', 'namenode'))
+        self.assertBefore(('stop', 'jobhistory'), ('stop', 'datanode'))
+
+    def test_rolling_restart(self):
+        self.lifecycle.rolling_restart(['namenode', 'secondarynamenode'])
+        self.assertEqual(self.events, [
+            ('stop', 'namenode'), ('start', 'namenode'), ('ready', 'namenode'),
+            ('stop', 'secondarynamenode'), ('start', 'secondarynamenode'), ('ready', 'secondarynamenode'),
+        ])
+
+    @mock.patch.object(handlers.utils, 'ensure_dirs')
+    def test_start_nodemanager_with_kv(self, ensure_dirs):
+        # the daemons start in worker threads, which can't use the unit's kv
+        tmp_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(tmp_dir.rmtree_p)
+        (tmp_dir / 'yarn-site.xml').write_text('<configuration></configuration>')
+        hadoop_base = mock.MagicMock()
+        hadoop_base.dist_config.path.return_value = tmp_dir
+        hadoop_base.is_running.return_value = False
+        yarn = handlers.YARN(hadoop_base)
+        yarn._yarn_daemon = self.record('daemon', 'nodemanager')
+        yarn.nodemanager_ready = self.record('ready', 'nodemanager', True)
+        with mock.patch.object(handlers.unitdata, 'kv', return_value=unitdata.Storage(tmp_dir / 'unit-state.db')):
+            handlers.Lifecycle(yarn=yarn, timeout=5).start(['nodemanager'])
+        self.assertEqual(self.events, [('daemon', 'nodemanager'), ('ready', 'nodemanager')])
+
+
+class TestJVMProfiles(KVMixin, unittest.TestCase):
+    @mock.patch.object(handlers.utils, 'get_total_memory_mb')
+    @mock.patch.object(handlers.utils, 'ensure_dirs')
+    def test_historyserver_gc_log(self, ensure_dirs, get_total_memory_mb):
+        self.patch_kv()
+        tmp_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(tmp_dir.rmtree_p)
+        ensure_dirs.side_effect = lambda paths, **kwargs: [Path(p) for p in paths]
+        get_total_memory_mb.return_value = 16384
+        hadoop_base = mock.MagicMock()
+        hadoop_base.charm_config = {}
+        hadoop_base.dist_config.path.side_effect = lambda key: tmp_dir / key
+        (tmp_dir / 'hadoop_conf').makedirs_p()
+        (tmp_dir / 'hadoop_conf' / 'mapred-env.sh').write_text('')
+        self.assertEqual(handlers.HadoopBase.configure_jvm_profiles(hadoop_base), ['mapred-env.sh'])
+        history_log_dir = tmp_dir / 'yarn_log_dir' / 'mapred'
+        ensure_dirs.assert_called_once_with([history_log_dir], owner='mapred', group='hadoop')
+        self.assertIn(history_log_dir / 'gc-historyserver.log', (tmp_dir / 'hadoop_conf' / 'mapred-env.sh').text())
+
+
+class TestYARNDecommission(unittest.TestCase):
+    @mock.patch.object(handlers.utils, 'read_json')
+    def test_decommission_status(self, read_json):
+        read_json.return_value = {'nodes': {'node': [
+            {'nodeHostName': 'worker-0', 'state': 'DECOMMISSIONED'},
+            {'nodeHostName': 'worker-1', 'state': 'LOST'},
+        ]}}
+        yarn = handlers.YARN(mock.MagicMock())
+        self.assertEqual(yarn.decommission_status(['worker-0', 'worker-1', 'worker-2']), {
+            'worker-0': 'DECOMMISSIONED',
+            'worker-1': 'LOST',
+            'worker-2': 'unknown',
+        })
+
+
+class TestRegisterSlaves(unittest.TestCase):
+    @mock.patch.object(Path, 'chown')
+    @mock.patch.object(handlers.hookenv, 'log')
+    def test_register_slaves_chown(self, log, chown):
+        conf_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(conf_dir.rmtree_p)
+        hadoop_base = mock.MagicMock()
+        hadoop_base.dist_config.path.return_value = conf_dir
+        # a new, empty slaves file is owned like one with slaves in it
+        self.assertEqual(handlers.HadoopBase.register_slaves(hadoop_base, []), ([], []))
+        self.assertTrue((conf_dir / 'slaves').exists())
+        chown.assert_called_once_with('ubuntu', 'hadoop')
+        handlers.HadoopBase.register_slaves(hadoop_base, [])
+        self.assertEqual(chown.call_count, 1)
+        handlers.HadoopBase.register_slaves(hadoop_base, ['worker-0'])
+        self.assertEqual(chown.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -12,12 +12,21 @@
 # Apache License for more details.
 
 
+import io
 import os
+import json
+import socket
+import hashlib
+import tarfile
+import subprocess
 import tempfile
+import threading
 import unittest
 import mock
 from path import Path
 
+from charmhelpers.core import unitdata
+
 from jujubigdata import utils
 
 
@@ -110,6 +119,618 @@ class TestUtils(unittest.TestCase):
         finally:
             tmp_file.remove()
 
+    def test_write_hosts_file(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        tmp_file = Path(filename)
+        try:
+            tmp_file.write_text('# managed\nfoo\nbar\n')
+            delta = utils.write_hosts_file(tmp_file, ['qux', 'foo', 'qux', ''], header=['# managed'])
+            self.assertEqual(delta, (['qux'], ['bar']))
+            self.assertEqual(tmp_file.text(), '# managed\nfoo\nqux\n')
+            with mock.patch.object(Path, 'write_lines') as write_lines:
+                delta = utils.write_hosts_file(tmp_file, ['foo', 'qux'])
+            self.assertEqual(delta, ([], []))
+            self.assertFalse(write_lines.called)
+        finally:
+            tmp_file.remove()
+
+    @mock.patch.object(utils.hookenv, 'log')
+    @mock.patch.object(utils.hookenv, 'atexit')
+    def test_defer_once(self, atexit, log):
+        callback = mock.Mock(side_effect=[None, TestError()])
+        self.assertTrue(utils.defer_once('refresh', callback, 'arg'))
+        self.assertFalse(utils.defer_once('refresh', callback, 'arg'))
+        self.assertEqual(atexit.call_count, 1)
+        atexit.call_args[0][0]()
+        callback.assert_called_once_with('arg')
+        # once run, the action can be scheduled again; failures are re-raised
+        self.assertTrue(utils.defer_once('refresh', callback, 'arg'))
+        self.assertRaises(TestError, atexit.call_args[0][0])
+        self.assertEqual(log.call_args[0][1], utils.hookenv.ERROR)
+
+    def test_read_jmx(self):
+        with mock.patch.object(utils, 'read_json') as read_json:
+            read_json.return_value = {'beans': [{'name': 'Hadoop:service=NameNode,name=NameNodeInfo',
+                                                 'Safemode': ''}]}
+            info = utils.read_jmx('nn', 50070, 'Hadoop:service=NameNode,name=NameNodeInfo')
+            read_json.assert_called_once_with(
+                'http://nn:50070/jmx?qry=Hadoop:service=NameNode,name=NameNodeInfo')
+            self.assertEqual(info['Safemode'], '')
+            read_json.return_value = {'beans': []}
+            self.assertEqual(utils.read_jmx('nn', 50070, 'Hadoop:service=Missing'), {})
+
+    def test_parse_datanode_states(self):
+        info = {
+            'LiveNodes': json.dumps({
+                'dn-0:50010': {'adminState': 'In Service'},
+                'dn-1:50010': {'adminState': 'Decommission In Progress'},
+                'dn-2:50010': {'adminState': 'Decommissioned'},
+            }),
+            'DeadNodes': json.dumps({
+                'dn-3:50010': {'decommissioned': False},
+                'dn-4:50010': {'decommissioned': True},
+            }),
+            'DecomNodes': json.dumps({
+                'dn-1:50010': {'underReplicatedBlocks': 42},
+            }),
+        }
+        nodes = utils.parse_datanode_states(info)
+        self.assertEqual({host: node['state'] for host, node in nodes.items()}, {
+            'dn-0': 'in-service',
+            'dn-1': 'decommissioning',
+            'dn-2': 'decommissioned',
+            'dn-3': 'dead',
+            'dn-4': 'decommissioned',
+        })
+        self.assertEqual(nodes['dn-1']['under_replicated_blocks'], 42)
+        self.assertEqual(utils.parse_datanode_states({}), {})
+
+    def test_parse_balancer_output(self):
+        status = utils.parse_balancer_output([
+            'ulimit -a for user hdfs',
+            'Time Stamp               Iteration#  Bytes Already Moved  Bytes Left To Move  Bytes Being Moved',
+            'Oct 19, 2026 1:00:00 AM           0                  0 B             1.5 GB             256 MB',
+            'Oct 19, 2026 1:00:30 AM           1             256 MB             1.25 GB             256 MB',
+        ])
+        self.assertEqual(status, {
+            'iteration': 1,
+            'moved': '256 MB',
+            'left': '1.25 GB',
+            'being_moved': '256 MB',
+            'message': None,
+        })
+        status = utils.parse_balancer_output(['The cluster is balanced. Exiting...'])
+        self.assertEqual(status['message'], 'The cluster is balanced. Exiting...')
+        self.assertIsNone(status['iteration'])
+
+    @mock.patch.object(utils.hookenv, 'log')
+    @mock.patch.object(utils.unitdata, 'kv')
+    def test_run_steps(self, kv, log):
+        kv.return_value.get.side_effect = lambda key: 1.0 if key == 'test.done' else None
+        order = []
+
+        def step(name, values=None):
+            def _step():
+                order.append(name)
+                return values
+            return _step
+
+        durations = utils.run_steps({
+            'done': (step('done'), []),
+            'first': (step('first'), ['done']),
+            'second': (step('second', {'foo': 'bar'}), ['first']),
+            'other': (step('other'), []),
+        }, kv_prefix='test.')
+        self.assertEqual(sorted(durations.keys()), ['first', 'other', 'second'])
+        self.assertNotIn('done', order)
+        self.assertLess(order.index('first'), order.index('second'))
+        kv.return_value.update.assert_called_once_with({'foo': 'bar'})
+        kv.return_value.set.assert_any_call('test.second', mock.ANY)
+
+    @mock.patch.object(utils.hookenv, 'log')
+    @mock.patch.object(utils.unitdata, 'kv')
+    def test_run_steps_errors(self, kv, log):
+        def fail():
+            raise TestError()
+
+        after = mock.Mock()
+        self.assertRaises(TestError, utils.run_steps, {
+            'fail': (fail, []),
+            'after': (after, ['fail']),
+        })
+        self.assertFalse(after.called)
+        self.assertRaises(ValueError, utils.run_steps, {'a': (after, ['b']), 'b': (after, ['a'])})
+        self.assertRaises(ValueError, utils.run_steps, {'a': (after, ['missing'])})
+
+    @mock.patch.object(utils.hookenv, 'log')
+    @mock.patch.object(utils.unitdata, 'kv')
+    def test_run_steps_hung(self, kv, log):
+        def exit():
+            raise SystemExit(1)
+
+        self.assertRaises(SystemExit, utils.run_steps, {'exit': (exit, [])})
+        release = threading.Event()
+        try:
+            self.assertRaises(utils.TimeoutError, utils.run_steps, {
+                'hang': (release.wait, []),
+            }, timeout=0.1)
+        finally:
+            release.set()
+
+    @mock.patch.object(utils.hookenv, 'status_set')
+    @mock.patch.object(utils.hookenv, 'config')
+    @mock.patch.object(utils.unitdata, 'kv')
+    def test_verify_resources_fresh_unit(self, kv, config, status_set):
+        # nothing fetched or verified yet: neither the file nor the cache has a signature
+        kv.return_value.get.return_value = None
+        config.return_value = 'http://mirror/'
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.yaml') as resources_yaml:
+            resources_yaml.write('resources:\n  foo:\n    url: http://origin/foo.tgz\n'
+                                 '    hash: 0123abcd\n    hash_type: sha256\n')
+            resources_yaml.flush()
+            verify = utils.verify_resources('foo', resources_yaml=resources_yaml.name)
+            with mock.patch('jujuresources.resource_path', side_effect=KeyError('foo')) as resource_path, \
+                    mock.patch('jujuresources.invalid', side_effect=[['foo'], []]) as invalid, \
+                    mock.patch('jujuresources.fetch', return_value=True) as fetch:
+                self.assertTrue(verify())
+        # the cache signature uses the same resources.yaml as the verification
+        resource_path.assert_called_with('foo', resources_yaml=resources_yaml.name)
+        invalid.assert_any_call(['foo'], resources_yaml=resources_yaml.name)
+        fetch.assert_called_once_with(['foo'], mirror_url='http://mirror/', resources_yaml=resources_yaml.name)
+
+    @mock.patch.object(utils.hookenv, 'status_set')
+    @mock.patch.object(utils.hookenv, 'config')
+    @mock.patch.object(utils.hookenv, 'log')
+    @mock.patch.object(utils.unitdata, 'kv')
+    def test_verify_resources_peers(self, kv, log, config, status_set):
+        kv.return_value.get.return_value = None
+        config.return_value = None  # no resources_mirror; the hash comes from the resource's URL
+        tmp_dir = Path(tempfile.mkdtemp())
+        pids = []
+        try:
+            def serve(name, content, hash_content=None):
+                (tmp_dir / name / 'foo').makedirs_p()
+                (tmp_dir / name / 'foo' / 'foo.tgz').write_bytes(content)
+                digest = hashlib.sha256(hash_content or content).hexdigest()
+                (tmp_dir / name / 'foo' / 'foo.tgz.sha256').write_text(digest)
+                sock = socket.socket()
+                sock.bind(('127.0.0.1', 0))
+                port = sock.getsockname()[1]
+                sock.close()
+                utils.serve_resources(port, directory=tmp_dir / name, address='127.0.0.1')
+                pids.append(kv.return_value.set.call_args_list[-3][0][1])
+                utils.wait_for(lambda: utils.port_open('127.0.0.1', port), 10, name, interval=0.1)
+                return 'http://127.0.0.1:{}/'.format(port)
+
+            origin = serve('origin', b'genuine')
+            # the peer serves a tampered file, with a matching hash of its own
+            peer = serve('peer', b'tampered', b'tampered')
+            resources_yaml = tmp_dir / 'resources.yaml'
+            resources_yaml.write_text('\n'.join([
+                'options:',
+                '  output_dir: {}'.format(tmp_dir / 'fetched'),
+                'resources:',
+                '  foo:',
+                '    url: {}foo/foo.tgz'.format(origin),
+                '    hash: {}foo/foo.tgz.sha256'.format(origin),
+                '    hash_type: sha256',
+            ]))
+            fetched = tmp_dir / 'fetched' / 'foo' / 'foo.tgz'
+
+            with mock.patch('jujuresources.resource_path', return_value=fetched), \
+                    mock.patch('jujuresources.fetch') as fetch:
+                # the peer's file fails the origin's hash, so it falls back to the origin
+                verify = utils.verify_resources('foo', peers=[peer], resources_yaml=resources_yaml)
+                self.assertFalse(verify._fetch('foo', None, [peer]))
+                self.assertFalse(fetched.exists())
+                fetch.assert_called_once_with(['foo'], mirror_url=None, resources_yaml=resources_yaml)
+
+                (tmp_dir / 'peer' / 'foo' / 'foo.tgz').write_bytes(b'genuine')
+                fetch.reset_mock()
+                verify = utils.verify_resources('foo', peers=[peer], resources_yaml=resources_yaml)
+                self.assertTrue(verify())
+                self.assertEqual(fetched.bytes(), b'genuine')
+                self.assertFalse(fetch.called)
+                log.assert_any_call('Fetched foo from peer {}'.format(peer))
+        finally:
+            for pid in pids:
+                os.kill(pid, 15)
+            tmp_dir.rmtree_p()
+
+    @mock.patch.object(utils.hookenv, 'status_set')
+    @mock.patch.object(utils.hookenv, 'config')
+    @mock.patch.object(utils.hookenv, 'log')
+    def test_verify_resources_kv_peers(self, log, config, status_set):
+        # the peers come from a real kv, which may only be used by the thread that opened it
+        config.return_value = None
+        tmp_dir = Path(tempfile.mkdtemp())
+        unit_kv = unitdata.Storage(tmp_dir / 'unit-state.db')
+        try:
+            (tmp_dir / 'peer' / 'foo').makedirs_p()
+            (tmp_dir / 'peer' / 'foo' / 'foo.tgz').write_bytes(b'genuine')
+            sock = socket.socket()
+            sock.bind(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+            sock.close()
+            with mock.patch.object(utils.unitdata, 'kv', return_value=unit_kv):
+                utils.serve_resources(port, directory=tmp_dir / 'peer', address='127.0.0.1')
+                utils.wait_for(lambda: utils.port_open('127.0.0.1', port), 10, 'peer', interval=0.1)
+                utils.update_resource_peer('peer/0', 'http://127.0.0.1:{}/'.format(port))
+                resources_yaml = tmp_dir / 'resources.yaml'
+                resources_yaml.write_text('\n'.join([
+                    'resources:',
+                    '  foo:',
+                    '    url: http://origin.invalid/foo.tgz',
+                    '    hash: {}'.format(hashlib.sha256(b'genuine').hexdigest()),
+                    '    hash_type: sha256',
+                ]))
+                fetched = tmp_dir / 'fetched' / 'foo' / 'foo.tgz'
+
+                def invalid(names, **kwargs):
+                    return [] if fetched.exists() else list(names)
+
+                with mock.patch('jujuresources.resource_path', return_value=fetched), \
+                        mock.patch('jujuresources.invalid', side_effect=invalid), \
+                        mock.patch('jujuresources.fetch') as fetch:
+                    verify = utils.verify_resources('foo', peers=utils.get_resource_peers,
+                                                    resources_yaml=resources_yaml)
+                    self.assertTrue(verify())
+                self.assertEqual(fetched.bytes(), b'genuine')
+                self.assertFalse(fetch.called)
+                utils.stop_serving_resources()
+        finally:
+            tmp_dir.rmtree_p()
+
+    @mock.patch.object(utils.hookenv, 'log')
+    def test_install_archive(self, log):
+        tmp_dir = Path(tempfile.mkdtemp())
+        try:
+            src = tmp_dir / 'src'
+            dst = tmp_dir / 'dst'
+            archive = tmp_dir / 'archive.tar.gz'
+
+            def build(files):
+                src.rmtree_p()
+                for name, contents in files.items():
+                    (src / 'top' / name).parent.makedirs_p()
+                    (src / 'top' / name).write_text(contents)
+                with tarfile.open(archive, 'w:gz') as tf:
+                    tf.add(src / 'top', arcname='top')
+
+            build({'bin/hadoop': 'v1', 'lib/a.jar': 'a', 'lib/old.jar': 'old'})
+            stats = utils.install_archive(archive, dst, skip_top_level=True)
+            self.assertEqual(stats, {'written': 3, 'unchanged': 0, 'removed': 0})
+            self.assertEqual((dst / 'bin/hadoop').text(), 'v1')
+
+            build({'bin/hadoop': 'v2', 'lib/a.jar': 'a'})
+            stats = utils.install_archive(archive, dst, skip_top_level=True)
+            self.assertEqual(stats, {'written': 1, 'unchanged': 1, 'removed': 1})
+            self.assertEqual((dst / 'bin/hadoop').text(), 'v2')
+            self.assertFalse((dst / 'lib/old.jar').exists())
+        finally:
+            tmp_dir.rmtree()
+
+    @mock.patch.object(utils.hookenv, 'log')
+    def test_install_archive_links(self, log):
+        tmp_dir = Path(tempfile.mkdtemp())
+        try:
+            archive = tmp_dir / 'archive.tar'
+            dst = tmp_dir / 'dst'
+
+            def build(*members):
+                with tarfile.open(archive, 'w') as tf:
+                    for name, kind, target in members:
+                        info = tarfile.TarInfo(name)
+                        if kind == 'file':
+                            info.size = len(target)
+                            tf.addfile(info, io.BytesIO(target))
+                            continue
+                        info.type = kind
+                        info.linkname = target
+                        tf.addfile(info)
+
+            build(('lib/a.jar', 'file', b'a'),
+                  ('lib/current.jar', tarfile.SYMTYPE, 'a.jar'),
+                  ('share/a.jar', tarfile.LNKTYPE, 'lib/a.jar'))
+            utils.install_archive(archive, dst)
+            self.assertEqual((dst / 'lib/current.jar').text(), 'a')
+            self.assertEqual((dst / 'share/a.jar').text(), 'a')
+
+            for link in [('etc', tarfile.SYMTYPE, '/etc'),
+                         ('lib/up', tarfile.SYMTYPE, '../../outside'),
+                         ('passwd', tarfile.LNKTYPE, '/etc/passwd'),
+                         ('missing', tarfile.LNKTYPE, 'lib/missing.jar')]:
+                build(link, (link[0] + '/file', 'file', b'x'))
+                self.assertRaises(ValueError, utils.install_archive, archive, tmp_dir / 'unsafe')
+            self.assertFalse((tmp_dir / 'outside').exists())
+        finally:
+            tmp_dir.rmtree()
+
+    @mock.patch.object(utils.hookenv, 'log')
+    def test_sync_config_dir(self, log):
+        tmp_dir = Path(tempfile.mkdtemp())
+
+        def site(**props):
+            return '<configuration>{}</configuration>'.format(''.join(
+                '<property><name>{}</name><value>{}</value></property>'.format(k.replace('_', '.'), v)
+                for k, v in sorted(props.items())))
+
+        try:
+            src, dst = tmp_dir / 'src', tmp_dir / 'dst'
+            src.makedirs()
+            (src / 'core-site.xml').write_text(site(a='1', b='1', c='1'))
+            (src / 'hadoop-env.sh').write_text('v1')
+            (src / 'slaves').write_text('localhost')
+            stats = utils.sync_config_dir(src, dst, exclude=['slaves'])
+            self.assertEqual(stats['copied'], 2)
+            self.assertFalse((dst / 'slaves').exists())
+
+            with utils.xmlpropmap_edit_in_place(dst / 'core-site.xml') as props:
+                props['a'] = 'managed'
+                del props['b']
+            stats = utils.sync_config_dir(src, dst, exclude=['slaves'])
+            self.assertEqual(stats['unchanged'], 2)
+
+            (src / 'core-site.xml').write_text(site(a='2', b='2', c='2', d='2'))
+            (src / 'hadoop-env.sh').remove()
+            stats = utils.sync_config_dir(src, dst, exclude=['slaves'])
+            self.assertEqual((stats['merged'], stats['removed']), (1, 1))
+            self.assertEqual(utils.read_xmlpropmap(dst / 'core-site.xml'),
+                             {'a': 'managed', 'c': '2', 'd': '2'})
+            self.assertFalse((dst / 'hadoop-env.sh').exists())
+        finally:
+            tmp_dir.rmtree()
+
+    def test_yarn_container_sizing(self):
+        sizing = utils.yarn_container_sizing(64 * 1024, 16)
+        self.assertEqual((sizing['containers'], sizing['container_mb']), (28, 2048))
+        self.assertEqual(sizing['nodemanager_mb'], 28 * 2048)
+        self.assertEqual(sizing['reduce_mb'], 4096)
+        sizing = utils.yarn_container_sizing(64 * 1024, 16, disks=4)
+        self.assertEqual((sizing['containers'], sizing['container_mb']), (8, 7168))
+        sizing = utils.yarn_container_sizing(2 * 1024, 2)
+        self.assertEqual((sizing['containers'], sizing['container_mb']), (4, 256))
+        self.assertEqual(sizing['scheduler_max_mb'], 1024)
+        # a co-located DataNode shrinks the containers, not just the NodeManager
+        sizing = utils.yarn_container_sizing(16 * 1024, 8, datanode=True)
+        self.assertEqual(sizing['nodemanager_mb'], sizing['containers'] * sizing['container_mb'])
+        self.assertLessEqual(sizing['nodemanager_mb'], 16 * 1024 - 2048 - 1024)
+
+    def test_cluster_container_sizing(self):
+        small = utils.yarn_container_sizing(8 * 1024, 4)
+        large = utils.yarn_container_sizing(64 * 1024, 16)
+        sizing = utils.cluster_container_sizing([large, small])
+        self.assertEqual(sizing['map_mb'], small['container_mb'])
+        self.assertEqual(sizing['scheduler_min_mb'], small['container_mb'])
+        self.assertEqual(sizing['scheduler_max_mb'], large['nodemanager_mb'])
+        self.assertEqual(sizing['scheduler_max_vcores'], 16)
+        self.assertLessEqual(sizing['reduce_mb'], small['nodemanager_mb'])
+        self.assertIsNone(utils.cluster_container_sizing([]))
+
+    def test_mapreduce_tuning(self):
+        tuning = utils.mapreduce_tuning(2048, 4096, 4096, nodes=1)
+        self.assertEqual(tuning['mapreduce.task.io.sort.mb'], 655)
+        self.assertEqual(tuning['mapreduce.task.io.sort.factor'], 65)
+        self.assertEqual(tuning['mapreduce.map.sort.spill.percent'], 0.9)
+        self.assertEqual(tuning['mapreduce.reduce.shuffle.parallelcopies'], 5)
+        self.assertEqual(tuning['mapreduce.map.output.compress'], 'false')
+        self.assertEqual(tuning['mapreduce.job.ubertask.enable'], 'true')
+        tuning = utils.mapreduce_tuning(256, 512, 256, nodes=100)
+        self.assertEqual(tuning['mapreduce.task.io.sort.mb'], 100)
+        self.assertEqual(tuning['mapreduce.map.sort.spill.percent'], 0.8)
+        self.assertEqual(tuning['mapreduce.reduce.shuffle.parallelcopies'], 18)
+        self.assertEqual(tuning['mapreduce.map.output.compress'], 'true')
+        self.assertEqual(tuning['mapreduce.job.ubertask.enable'], 'false')
+
+    def test_get_data_mounts(self):
+        with tempfile.NamedTemporaryFile('w') as mounts:
+            mounts.write('\n'.join([
+                '/dev/sda1 / ext4 rw,relatime 0 0',
+                'proc /proc proc rw 0 0',
+                '/dev/sda2 /boot ext4 rw 0 0',
+                '/dev/sdc1 /mnt/disk2 xfs rw,noatime 0 0',
+                '/dev/sdb1 /mnt/disk1 ext4 rw,noatime 0 0',
+                '/dev/sdb1 /srv/bind ext4 rw,noatime 0 0',
+                '/dev/loop0 /snap/core/1 squashfs ro 0 0',
+                'tmpfs /run tmpfs rw 0 0',
+            ]))
+            mounts.flush()
+            self.assertEqual(utils.get_data_mounts(mounts.name), ['/mnt/disk1', '/mnt/disk2'])
+
+    def test_rpc_handler_count(self):
+        self.assertEqual(utils.rpc_handler_count(1), 10)
+        self.assertEqual(utils.rpc_handler_count(10), 46)
+        self.assertEqual(utils.rpc_handler_count(200), 105)
+
+    def test_datanode_tuning(self):
+        tuning = utils.datanode_tuning(4, disks=1)
+        self.assertEqual(tuning['dfs.datanode.max.transfer.threads'], 4096)
+        self.assertEqual(tuning['dfs.datanode.handler.count'], 10)
+        self.assertEqual(tuning['dfs.datanode.drop.cache.behind.reads'], 'false')
+        tuning = utils.datanode_tuning(24, disks=12, nodemanager=True)
+        self.assertEqual(tuning['dfs.datanode.max.transfer.threads'], 12288)
+        self.assertEqual(tuning['dfs.datanode.handler.count'], 24)
+        # the balancer moves are set with the balancer options, in one place
+        self.assertNotIn('dfs.datanode.balance.max.concurrent.moves', tuning)
+        self.assertEqual(tuning['dfs.datanode.drop.cache.behind.reads'], 'true')
+
+    def test_parse_checknative(self):
+        self.assertEqual(utils.parse_checknative('\n'.join([
+            'Native library checking:',
+            'hadoop:  true /usr/lib/hadoop/lib/native/libhadoop.so.1.0.0',
+            'zlib:    true /lib/x86_64-linux-gnu/libz.so.1',
+            'snappy:  false ',
+            'lz4:     true revision:99',
+            'zstd  :  false ',
+            'openssl: false Cannot load libcrypto.so (libcrypto.so: cannot open shared object file)!',
+        ])), {
+            'hadoop': True,
+            'zlib': True,
+            'snappy': False,
+            'lz4': True,
+            'zstd': False,
+            'openssl': False,
+        })
+
+    def test_available_codecs(self):
+        def names(codecs):
+            return [name for name, codec_class in codecs]
+
+        self.assertEqual(names(utils.available_codecs({})), ['deflate', 'gzip', 'bzip2'])
+        native = {'hadoop': True, 'snappy': True, 'lz4': True, 'zstd': False}
+        self.assertEqual(names(utils.available_codecs(native, lzo=True)),
+                         ['deflate', 'gzip', 'bzip2', 'snappy', 'lz4', 'lzo'])
+        native['hadoop'] = False
+        self.assertEqual(names(utils.available_codecs(native)), ['deflate', 'gzip', 'bzip2'])
+
+    def test_managed_block_edit(self):
+        with tempfile.NamedTemporaryFile('w') as env:
+            env.write('export FOO=1\n')
+            env.flush()
+            self.assertTrue(utils.managed_block_edit(env.name, 'jvm', ['export BAR=2']))
+            self.assertFalse(utils.managed_block_edit(env.name, 'jvm', ['export BAR=2']))
+            self.assertEqual(Path(env.name).lines(retain=False), [
+                'export FOO=1',
+                '# BEGIN juju managed: jvm',
+                'export BAR=2',
+                '# END juju managed: jvm',
+            ])
+            self.assertTrue(utils.managed_block_edit(env.name, 'jvm', ['export BAR=3']))
+            self.assertEqual(Path(env.name).lines(retain=False)[2], 'export BAR=3')
+            self.assertTrue(utils.managed_block_edit(env.name, 'jvm', []))
+            self.assertEqual(Path(env.name).lines(retain=False), ['export FOO=1'])
+
+    def test_jvm_profiles(self):
+        self.assertEqual(utils.jvm_heap_mb('namenode', 64 * 1024, blocks=10000000), 10240)
+        self.assertEqual(utils.jvm_heap_mb('namenode', 4096, blocks=10000000), 3072)
+        self.assertEqual(utils.jvm_heap_mb('resourcemanager', 64 * 1024), 4096)
+        self.assertEqual(utils.jvm_heap_mb('datanode', 2048), 512)
+        self.assertEqual(utils.jvm_opts(1024), '-Xms1024m -Xmx1024m -XX:+UseParallelGC')
+        opts = utils.jvm_opts(8192, gc_log='/var/log/gc.log', java_version='11.0.2')
+        self.assertIn('-XX:+UseG1GC -XX:MaxGCPauseMillis=200', opts)
+        self.assertIn('-Xlog:gc*:file=/var/log/gc.log', opts)
+        self.assertRaises(ValueError, utils.jvm_opts, 1024, gc='cms')
+
+    def test_read_kernel_choice(self):
+        with tempfile.NamedTemporaryFile('w') as thp:
+            thp.write('always defer madvise [never]\n')
+            thp.flush()
+            self.assertEqual(utils.read_kernel_choice(thp.name), 'never')
+
+    def test_write_topology(self):
+        conf_dir = Path(tempfile.mkdtemp())
+        try:
+            self.assertTrue(utils.write_topology(conf_dir, {'worker-0': 'rack1', '10.0.0.1': '/rack1'}))
+            output = subprocess.check_output([conf_dir / 'topology.sh', 'worker-0', '10.0.0.1', 'other'])
+            self.assertEqual(output.decode('utf8').strip(), '/rack1 /rack1 /default-rack')
+            self.assertTrue(utils.write_topology(conf_dir, {'worker-1': 'us-east-1b'}))
+            self.assertFalse(utils.write_topology(conf_dir, {'worker-1': '/us-east-1b'}))
+            output = subprocess.check_output([conf_dir / 'topology.sh', 'worker-0', 'worker-1', '10.0.0.1', 'other'])
+            self.assertEqual(output.decode('utf8').strip(), '/default-rack /us-east-1b /default-rack /default-rack')
+        finally:
+            conf_dir.rmtree_p()
+
+    def test_parse_rack_mapping(self):
+        self.assertEqual(utils.parse_rack_mapping(None), {})
+        self.assertEqual(utils.parse_rack_mapping('worker-0: rack1\n10.0.0.1: /rack2'),
+                         {'worker-0': 'rack1', '10.0.0.1': '/rack2'})
+        for mapping in ('worker-0: [', 'rack1', '- worker-0', 'worker-0: 1', '1: rack1'):
+            self.assertRaises(ValueError, utils.parse_rack_mapping, mapping)
+
+    def test_capacity_scheduler_queues(self):
+        props = utils.capacity_scheduler_queues({
+            'default': {'capacity': 40},
+            'analytics': {
+                'capacity': 60,
+                'user-limit-factor': 2,
+                'queues': {
+                    'adhoc': {'capacity': 30},
+                    'etl': {'capacity': 70, 'disable_preemption': True},
+                },
+            },
+        })
+        self.assertEqual(props, {
+            'yarn.scheduler.capacity.root.queues': 'analytics,default',
+            'yarn.scheduler.capacity.root.default.capacity': 40,
+            'yarn.scheduler.capacity.root.analytics.capacity': 60,
+            'yarn.scheduler.capacity.root.analytics.user-limit-factor': 2,
+            'yarn.scheduler.capacity.root.analytics.queues': 'adhoc,etl',
+            'yarn.scheduler.capacity.root.analytics.adhoc.capacity': 30,
+            'yarn.scheduler.capacity.root.analytics.etl.capacity': 70,
+            'yarn.scheduler.capacity.root.analytics.etl.disable_preemption': 'true',
+        })
+        self.assertRaises(ValueError, utils.capacity_scheduler_queues, {'a': {'capacity': 50}})
+        self.assertRaises(ValueError, utils.capacity_scheduler_queues, {'a': {}})
+
+    def test_systemd_unit(self):
+        unit = utils.systemd_unit('Apache Hadoop namenode', 'hdfs', '/usr/lib/hadoop/bin/hdfs namenode',
+                                  group='hadoop', environment={'HADOOP_ROOT_LOGGER': 'INFO,RFA'},
+                                  wait_for_port=8020).splitlines()
+        self.assertIn('User=hdfs', unit)
+        self.assertIn('Group=hadoop', unit)
+        self.assertIn('EnvironmentFile=-/etc/environment', unit)
+        self.assertIn('Environment="HADOOP_ROOT_LOGGER=INFO,RFA"', unit)
+        self.assertIn('ExecStart=/usr/lib/hadoop/bin/hdfs namenode', unit)
+        self.assertIn('LimitNOFILE=65536', unit)
+        self.assertIn('Restart=on-failure', unit)
+        post = [line for line in unit if line.startswith('ExecStartPost=')]
+        self.assertEqual(len(post), 1)
+        self.assertIn('$$(seq 1 120)', post[0])
+        self.assertIn('/dev/tcp/%H/8020', post[0])
+        unit = utils.systemd_unit('Apache Hadoop nodemanager', 'yarn', '/usr/lib/hadoop/bin/yarn nodemanager')
+        self.assertFalse([line for line in unit.splitlines() if line.startswith(('ExecStartPost=', 'Group='))])
+
+    def test_wait_for(self):
+        probe = mock.Mock(side_effect=[False, False, True])
+        self.assertTrue(utils.wait_for(probe, 5, 'probe', interval=0))
+        self.assertEqual(probe.call_count, 3)
+        self.assertRaises(utils.TimeoutError, utils.wait_for, lambda: False, 0.05, 'never', interval=0.01)
+
+    def test_restart_tokens(self):
+        requests = {'dn-0': '1', 'dn-1': '1', 'dn-2': '1', 'dn-3': '1'}
+        healthy = {'dn-0': True, 'dn-1': True, 'dn-2': True, 'dn-3': True}.get
+        granted = utils.restart_tokens(requests, {}, [], healthy, concurrency=2)
+        self.assertEqual(granted, ['dn-0', 'dn-1'])
+        # dn-0 restarted but is not healthy yet, so it keeps its token
+        granted = utils.restart_tokens(requests, {'dn-0': '1'}, granted, lambda host: False, concurrency=2)
+        self.assertEqual(granted, ['dn-0', 'dn-1'])
+        granted = utils.restart_tokens(requests, {'dn-0': '1'}, granted, healthy, concurrency=2)
+        self.assertEqual(granted, ['dn-1', 'dn-2'])
+        # withdrawn requests release their tokens
+        del requests['dn-1']
+        self.assertEqual(utils.restart_tokens(requests, {'dn-0': '1'}, granted, healthy, concurrency=2),
+                         ['dn-2', 'dn-3'])
+        racks = {'dn-0': '/r1', 'dn-1': '/r2', 'dn-2': '/r1', 'dn-3': '/r2'}
+        requests = {'dn-0': '2', 'dn-1': '2', 'dn-2': '2', 'dn-3': '2'}
+        self.assertEqual(utils.restart_tokens(requests, {}, [], healthy, concurrency=3, racks=racks),
+                         ['dn-0', 'dn-2'])
+        self.assertEqual(utils.restart_tokens(requests, {}, ['dn-1'], healthy, concurrency=3, racks=racks),
+                         ['dn-1', 'dn-3'])
+
+    def test_metrics2_properties(self):
+        lines = utils.metrics2_properties(
+            {'ganglia': ('10.0.0.1', None), 'statsd': ('10.0.0.2', 9125)},
+            period=30,
+            filters={'*': {'source': {'include': 'jvm|rpc*'}},
+                     'datanode': {'metric': {'exclude': '*Info*'}}},
+            prefixes=['namenode', 'datanode'])
+        self.assertEqual(lines[:3], [
+            '*.period=30',
+            '*.metric.filter.class=org.apache.hadoop.metrics2.filter.GlobFilter',
+            '*.source.filter.class=org.apache.hadoop.metrics2.filter.GlobFilter',
+        ])
+        self.assertIn('*.sink.ganglia.class=org.apache.hadoop.metrics2.sink.ganglia.GangliaSink31', lines)
+        self.assertIn('namenode.sink.ganglia.servers=10.0.0.1:8649', lines)
+        self.assertIn('datanode.sink.statsd.server.port=9125', lines)
+        self.assertIn('datanode.sink.statsd.service.name=datanode', lines)
+        self.assertIn('namenode.sink.ganglia.source.filter.include=jvm|rpc*', lines)
+        self.assertIn('datanode.sink.ganglia.metric.filter.exclude=*Info*', lines)
+        self.assertNotIn('namenode.sink.ganglia.metric.filter.exclude=*Info*', lines)
+        self.assertRaises(ValueError, utils.metrics2_properties, {'influx': ('h', 1)})
+        self.assertRaises(ValueError, utils.metrics2_properties, {'ganglia': ('h', 1)},
+                          filters={'datanode': {'context': {'include': 'dfs'}}})
+
 
 if __name__ == '__main__':
     unittest.main()